@@ -4,15 +4,39 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from datetime import datetime
 import numpy as np
-from sklearn.linear_model import LinearRegression
 import argparse
+from migrate_database import require_schema
+import analysis_cache
+import analysis_queries
+import price_models
+from itertools import groupby
 
 # Define your filters here
 MAKE = "Tesla"  # Set to None to see all makes
 MODEL = "Model Y"    # Set to None to see all models for the selected make
 
-def load_car_data(make=None, model=None):
+def connect():
     conn = sqlite3.connect('cars.db')
+    # Reports don't change the schema, older databases are upgraded by the scraper or migrate_database.py
+    require_schema(conn)
+    return conn
+
+# Read cars from the columnar cache in analysis_cache/, switched off with --no-cache
+USE_CACHE = True
+
+def load_car_data(make=None, model=None):
+    conn = connect()
+    
+    df = None
+    if USE_CACHE:
+        try:
+            analysis_cache.refresh(conn, make, model)
+            df = analysis_cache.load(conn, make, model)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Analysis cache unavailable, reading the database: {e}")
+    if df is not None:
+        conn.close()
+        return df.dropna(subset=['price', 'mileage', 'year'], how='all')
     
     # Build the SQL query with optional filters
     query = "SELECT * FROM cars WHERE 1=1"
@@ -24,22 +48,9 @@ def load_car_data(make=None, model=None):
         query += " AND model = ?"
         params.append(model)
     
+    # price, mileage and year are INTEGER columns, missing values are read as NaN
     df = pd.read_sql_query(query, conn, params=params)
-    
-    # Clean and convert data types with better error handling
-    def clean_numeric(x):
-        if pd.isna(x) or x == 'N/A':
-            return None
-        return ''.join(filter(str.isdigit, str(x)))
-    
-    # Clean price and mileage
-    df['price'] = df['price'].apply(clean_numeric)
-    df['mileage'] = df['mileage'].apply(clean_numeric)
-    
-    # Convert to numeric
-    df['price'] = pd.to_numeric(df['price'], errors='coerce')
-    df['mileage'] = pd.to_numeric(df['mileage'], errors='coerce')
-    df['year'] = pd.to_numeric(df['year'], errors='coerce')
+    conn.close()
     
     # Drop rows where all key values are NaN
     df = df.dropna(subset=['price', 'mileage', 'year'], how='all')
@@ -47,10 +58,12 @@ def load_car_data(make=None, model=None):
     return df
 
 def analyze_cars(make=None, model=None):
-    df = load_car_data(make, model)
+    conn = connect()
+    stats = analysis_queries.basic_statistics(conn, make, model)
     
-    if len(df) == 0:
+    if stats['count'] == 0:
         print("No data found in database!")
+        conn.close()
         return
     
     filter_text = ""
@@ -61,17 +74,19 @@ def analyze_cars(make=None, model=None):
     
     # Basic statistics
     print(f"\n=== Basic Statistics{filter_text} ===")
-    print(f"Total cars: {len(df)}")
-    print(f"Average price: {df['price'].mean():,.0f} kr")
-    print(f"Median price: {df['price'].median():,.0f} kr")
-    print(f"Average mileage: {df['mileage'].mean():,.0f} mil")
-    print(f"Average year: {df['year'].mean():.1f}")
+    print(f"Total cars: {stats['count']}")
+    print(f"Average price: {stats['avg_price']:,.0f} kr")
+    print(f"Median price: {stats['median_price']:,.0f} kr")
+    print(f"Average mileage: {stats['avg_mileage']:,.0f} mil")
+    print(f"Average year: {stats['avg_year']:.1f}")
     
     # Only plot if we have data
-    if len(df) > 0:
+    if stats['count'] > 0:
         # Price vs Mileage scatter plot with trendline
         plt.figure(figsize=(10, 6))
-        sns.regplot(data=df.dropna(subset=['price', 'mileage']), 
+        # The points are every car, read from the analysis cache
+        points = load_car_data(make, model).dropna(subset=['price', 'mileage'])
+        sns.regplot(data=points, 
                    x='mileage', y='price', 
                    scatter_kws={'alpha': 0.6},
                    line_kws={'color': 'red'})
@@ -83,8 +98,7 @@ def analyze_cars(make=None, model=None):
         plt.show()
         
         # Average price by year
-        yearly_data = df.groupby('year')['price'].mean().reset_index()
-        yearly_data = yearly_data.dropna()
+        yearly_data = analysis_queries.average_price_by_year(conn, make, model)
         if len(yearly_data) > 0:
             plt.figure(figsize=(10, 6))
             sns.lineplot(data=yearly_data, x='year', y='price')
@@ -97,57 +111,40 @@ def analyze_cars(make=None, model=None):
     
     # Location analysis
     print("\n=== Top Locations ===")
-    location_counts = df['location'].replace('N/A', pd.NA).dropna().value_counts().head(10)
+    location_counts = analysis_queries.location_counts(conn, make, model)
     print(location_counts)
     
     # Most expensive cars
     print("\n=== Top 5 Most Expensive Cars ===")
-    expensive_cars = df.dropna(subset=['price']).nlargest(5, 'price')
+    expensive_cars = analysis_queries.top_cars(conn, 'price', stats['has_missing'], make, model)
     print(expensive_cars[['make', 'model', 'year', 'price', 'mileage', 'location']])
     
     # Newest cars
     print("\n=== Top 5 Newest Cars ===")
-    newest_cars = df.dropna(subset=['year']).nlargest(5, 'year')
+    newest_cars = analysis_queries.top_cars(conn, 'year', stats['has_missing'], make, model)
     print(newest_cars[['make', 'model', 'year', 'price', 'mileage', 'location']])
+    
+    conn.close()
 
 def predict_car_price(make=None, model=None):
-    df = load_car_data(make, model)
-    
-    # Calculate age from year
-    current_year = datetime.now().year
-    df['age'] = current_year - df['year']
+    conn = connect()
+    # Stored per make/model, only retrained when the data changed
+    price_model = price_models.get_model(conn, make, model)
     
-    # Clean data: Remove outliers and invalid entries
-    df = df.dropna(subset=['price', 'mileage', 'age'])
-    
-    # Remove extreme outliers using IQR method
-    def remove_outliers(df, column):
-        Q1 = df[column].quantile(0.25)
-        Q3 = df[column].quantile(0.75)
-        IQR = Q3 - Q1
-        return df[~((df[column] < (Q1 - 1.5 * IQR)) | (df[column] > (Q3 + 1.5 * IQR)))]
-    
-    df = remove_outliers(df, 'price')
-    df = remove_outliers(df, 'mileage')
-    
-    if len(df) < 10:
+    if price_model is None:
         print("Not enough data for reliable prediction")
+        conn.close()
         return
-    
-    # Prepare features
-    X = df[['mileage', 'age']]
-    y = df['price']
-    
-    # Train model
-    model = LinearRegression()
-    model.fit(X, y)
+    conn.close()
+    # The cars to plot, read from the analysis cache
+    df = price_models.training_frame(load_car_data(make, model), price_model.reference_year)
     
     # Print model coefficients
     print("\n=== Price Prediction Model ===")
-    print(f"Base price (intercept): {model.intercept_:,.0f} kr")
-    print(f"Price decrease per mil: {model.coef_[0]:,.0f} kr")
-    print(f"Price decrease per year: {model.coef_[1]:,.0f} kr")
-    print(f"R² score: {model.score(X, y):.3f}")
+    print(f"Base price (intercept): {price_model.intercept:,.0f} kr")
+    print(f"Price decrease per mil: {price_model.mileage_coef:,.0f} kr")
+    print(f"Price decrease per year: {price_model.age_coef:,.0f} kr")
+    print(f"R² score: {price_model.r2:.3f}")
     
     # Interactive prediction
     print("\n=== Price Prediction Calculator ===")
@@ -155,14 +152,12 @@ def predict_car_price(make=None, model=None):
         try:
             mileage = float(input("Enter mileage (mil): "))
             age = float(input("Enter age (years): "))
-            prediction_data = pd.DataFrame([[mileage, age]], columns=['mileage', 'age'])
-            predicted_price = model.predict(prediction_data)[0]
+            predicted_price = price_model.predict(mileage, age)
             print(f"\nPredicted price: {predicted_price:,.0f} kr")
             
             # Calculate prediction interval (simplified)
-            residuals = y - model.predict(X)
-            std_dev = np.std(residuals)
-            print(f"Price range: {(predicted_price - 2*std_dev):,.0f} kr to {(predicted_price + 2*std_dev):,.0f} kr")
+            low, high = price_model.interval(predicted_price)
+            print(f"Price range: {low:,.0f} kr to {high:,.0f} kr")
             
             break
         except ValueError:
@@ -176,7 +171,7 @@ def predict_car_price(make=None, model=None):
     plt.scatter(df['mileage'], df['price'], alpha=0.5)
     mileage_range = np.linspace(df['mileage'].min(), df['mileage'].max(), 100)
     avg_age = df['age'].mean()
-    price_pred = model.predict(np.column_stack([mileage_range, [avg_age] * 100]))
+    price_pred = price_model.predict(mileage_range, avg_age)
     plt.plot(mileage_range, price_pred, 'r-', label='Prediction (avg age)')
     plt.xlabel('Mileage (mil)')
     plt.ylabel('Price (kr)')
@@ -188,7 +183,7 @@ def predict_car_price(make=None, model=None):
     plt.scatter(df['age'], df['price'], alpha=0.5)
     age_range = np.linspace(df['age'].min(), df['age'].max(), 100)
     avg_mileage = df['mileage'].mean()
-    price_pred = model.predict(np.column_stack([[avg_mileage] * 100, age_range]))
+    price_pred = price_model.predict(avg_mileage, age_range)
     plt.plot(age_range, price_pred, 'r-', label='Prediction (avg mileage)')
     plt.xlabel('Age (years)')
     plt.ylabel('Price (kr)')
@@ -199,31 +194,176 @@ def predict_car_price(make=None, model=None):
     plt.show()
 
 def display_inventory_counts():
-    conn = sqlite3.connect('cars.db')
-    
-    model_counts = pd.read_sql_query(
-        "SELECT make, model, COUNT(*) as count FROM cars GROUP BY make, model ORDER BY make, count DESC", 
-        conn
-    )
+    conn = connect()
+    rows = analysis_queries.inventory_counts(conn)
+    conn.close()
     
     print("\n=== Available Cars by Make and Model ===")
-    for make in model_counts['make'].unique():
-        make_models = model_counts[model_counts['make'] == make]
-        total = make_models['count'].sum()
-        print(f"\n{make} (Total: {total}):")
+    for make, make_rows in groupby(rows, key=lambda row: row[0]):
+        make_rows = list(make_rows)
+        make_models = pd.DataFrame([(m, count) for _, m, count, _ in make_rows], columns=['model', 'count'])
+        print(f"\n{make} (Total: {make_rows[0][3]}):")
         print(make_models[['model', 'count']].to_string(index=False))
+
+# Market reports, read from the summary tables that main.py updates after every run
+
+def summary_filter(make=None, model=None, table='s'):
+    where = "WHERE 1=1"
+    params = []
+    if make:
+        where += f" AND {table}.make = ?"
+        params.append(make)
+    if model:
+        where += f" AND {table}.model = ?"
+        params.append(model)
+    return where, params
+
+def days_on_market_report(make=None, model=None):
+    conn = connect()
+    where, params = summary_filter(make, model)
+    report = pd.read_sql_query(f'''
+        SELECT make, model,
+               COUNT(*) FILTER (WHERE removed_run_id IS NULL) AS for_sale,
+               ROUND(AVG(days_on_market) FILTER (WHERE removed_run_id IS NULL), 1) AS avg_days_for_sale,
+               COUNT(*) FILTER (WHERE removed_run_id IS NOT NULL) AS removed,
+               ROUND(AVG(days_on_market) FILTER (WHERE removed_run_id IS NOT NULL), 1) AS avg_days_until_removed,
+               ROUND(MAX(days_on_market), 1) AS max_days
+        FROM car_market_stats s {where}
+        GROUP BY make, model ORDER BY make, model
+    ''', conn, params=params)
+    conn.close()
     
+    print("\n=== Days on Market ===")
+    print(report.to_string(index=False))
+
+def price_drop_report(make=None, model=None, limit=10):
+    conn = connect()
+    where, params = summary_filter(make, model)
+    report = pd.read_sql_query(f'''
+        SELECT make, model, COUNT(*) AS cars,
+               SUM(price_drops > 0) AS cars_with_drops,
+               SUM(price_drops) AS price_drops,
+               SUM(price_increases) AS price_increases,
+               ROUND(AVG(first_price - current_price) FILTER (WHERE current_price < first_price)) AS avg_total_drop
+        FROM car_market_stats s {where}
+        GROUP BY make, model ORDER BY make, model
+    ''', conn, params=params)
+    most_dropped = pd.read_sql_query(f'''
+        SELECT s.make, s.model, s.year, s.first_price, s.current_price, s.price_drops,
+               ROUND(s.days_on_market) AS days, c.title
+        FROM car_market_stats s JOIN cars c ON c.id = s.car_id
+        {where} AND s.removed_run_id IS NULL AND s.price_drops > 0
+        ORDER BY s.price_drops DESC, s.first_price - s.current_price DESC LIMIT ?
+    ''', conn, params=params + [limit])
     conn.close()
+    
+    print("\n=== Price Drops ===")
+    print(report.to_string(index=False))
+    print(f"\n=== Top {limit} Cars For Sale With Most Price Drops ===")
+    print(most_dropped.to_string(index=False))
+
+def model_year_price_report(make=None, model=None):
+    conn = connect()
+    where, params = summary_filter(make, model)
+    report = pd.read_sql_query(f'''
+        SELECT make, model, year, listings, median_price, ROUND(mean_price) AS mean_price, min_price, max_price
+        FROM model_year_prices s {where} ORDER BY make, model, year
+    ''', conn, params=params)
+    conn.close()
+    
+    print("\n=== Median Asking Price per Model Year (cars for sale) ===")
+    print(report.to_string(index=False))
+
+def disappeared_listings_report(make=None, model=None):
+    # Listings the latest full sweep of each make/model found gone
+    conn = connect()
+    where, params = summary_filter(make, model)
+    report = pd.read_sql_query(f'''
+        SELECT s.make, s.model, s.year, s.current_price AS last_price, s.price_drops,
+               ROUND(s.days_on_market) AS days, s.removed_at AS last_seen, c.title, c.url
+        FROM car_market_stats s JOIN cars c ON c.id = s.car_id
+        JOIN (SELECT make, model, MAX(removed_run_id) AS run_id FROM car_market_stats s {where}
+              GROUP BY make, model) latest
+          ON s.make = latest.make AND s.model = latest.model AND s.removed_run_id = latest.run_id
+        ORDER BY s.make, s.model, s.removed_at DESC
+    ''', conn, params=params)
+    conn.close()
+    
+    print("\n=== Listings Gone Since the Previous Full Sweep ===")
+    if len(report) == 0:
+        print("No listings have disappeared")
+    else:
+        print(report.to_string(index=False))
+
+def weekly_price_report(make=None, model=None):
+    # Kept up to date by every run, see price_intervals.py
+    conn = connect()
+    report = analysis_queries.weekly_prices(conn, make, model)
+    conn.close()
+    
+    print("\n=== Asking Price per Week (cars for sale during the week) ===")
+    print(report.to_string(index=False))
+
+def market_snapshot(when, make=None, model=None):
+    # The listings for sale at a point in time with the prices they had then
+    conn = connect()
+    listings = analysis_queries.listings_as_of(conn, when, make, model)
+    conn.close()
+    
+    print(f"\n=== Cars For Sale at {when:%Y-%m-%d %H:%M} ===")
+    if len(listings) == 0:
+        print("No listings")
+        return listings
+    summary = listings.groupby(['make', 'model'])['price'].agg(['count', 'median', 'mean', 'min', 'max']).round()
+    print(summary.to_string())
+    print()
+    print(listings[['make', 'model', 'year', 'mileage', 'price', 'price_since', 'title']].to_string(index=False))
+    return listings
+
+REPORTS = {
+    'days-on-market': days_on_market_report,
+    'price-drops': price_drop_report,
+    'model-year-prices': model_year_price_report,
+    'disappeared': disappeared_listings_report,
+    'weekly-prices': weekly_price_report,
+}
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Analyze car data from the database')
     parser.add_argument('--make', type=str, help='Car manufacturer (e.g. Tesla)')
     parser.add_argument('--model', type=str, help='Car model (e.g. Model Y)')
+    parser.add_argument('--no-cache', action='store_true', help='Read the database directly instead of the analysis cache')
+    parser.add_argument('--predict-batch', type=str, metavar='FILE',
+                        help='Value every car in a CSV or JSONL file of make, model, mileage and year')
+    parser.add_argument('--output', type=str, help='Where to write the --predict-batch results (default: stdout)')
+    parser.add_argument('--report', choices=REPORTS, action='append',
+                        help='Print a market report from the summary tables, can be repeated')
+    parser.add_argument('--as-of', type=datetime.fromisoformat, metavar='"YYYY-MM-DD[ HH:MM]"',
+                        help='List the cars for sale at this time with their prices then (a date is midnight)')
     args = parser.parse_args()
+    
+    USE_CACHE = not args.no_cache
+    
+    if args.predict_batch:
+        conn = connect()
+        cars = price_models.predict_batch(conn, price_models.read_cars(args.predict_batch))
+        conn.close()
+        price_models.write_predictions(cars, args.output)
+        raise SystemExit
 
     # Override global constants if arguments provided
     make = args.make if args.make else MAKE
     model = args.model if args.model else MODEL
+    
+    if args.as_of:
+        market_snapshot(args.as_of, args.make, args.model)
+        raise SystemExit
+    
+    if args.report:
+        # Reports cover every make/model unless one is given
+        for report in args.report:
+            REPORTS[report](args.make, args.model)
+        raise SystemExit
 
     display_inventory_counts()
     predict_car_price(make, model)
@@ -0,0 +1,217 @@
+import os
+import json
+import sqlite3
+from urllib.parse import quote
+import numpy as np
+import pandas as pd
+from migrate_database import get_schema_version, require_schema
+
+# Columnar cache of the cars table for Analysis.py. Every make/model gets a
+# directory with one .npy file per column and a meta.json holding the
+# watermark (highest id, latest last_seen, row count, revision in cars_revisions
+# and schema version) of the data in it.
+# INTEGER columns are stored as int64, or float64 with NaN when they have
+# NULLs, which matches what pandas makes of them. Text columns are stored as
+# int32 codes into a list of distinct values.
+#
+# refresh() appends the rows with a newer id and rewrites the rows with a newer
+# last_seen, instead of reading the whole segment again. Updates that leave
+# last_seen as it was bump the revision, and migrations the schema version, those
+# rows can't be found so the segment is built again. load() memory maps the
+# numeric columns, so the frame uses them without a copy. It returns None when
+# a segment is missing or stale, and load_car_data then reads SQLite instead.
+
+CACHE_DIR = 'analysis_cache'
+CACHE_VERSION = 2
+
+def segment_dir(make, model, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, quote(make, safe=''), quote(model, safe=''))
+
+def table_columns(conn):
+    return [(name, (col_type or '').upper() == 'INTEGER')
+            for _, name, col_type, *_ in conn.execute('PRAGMA table_info(cars)')]
+
+def segments(conn, make=None, model=None):
+    query = "SELECT DISTINCT make, model FROM cars WHERE make IS NOT NULL AND model IS NOT NULL"
+    params = []
+    if make:
+        query += " AND make = ?"
+        params.append(make)
+    if model:
+        query += " AND model = ?"
+        params.append(model)
+    return conn.execute(query + " ORDER BY make, model", params).fetchall()
+
+WATERMARK_KEYS = ('max_id', 'max_last_seen', 'rows', 'revision', 'schema_version')
+
+def segment_watermark(conn, make, model):
+    max_id, max_last_seen, rows, revision = conn.execute('''
+        SELECT MAX(id), MAX(last_seen), COUNT(*),
+               (SELECT revision FROM cars_revisions WHERE make = ? AND model = ?)
+        FROM cars WHERE make = ? AND model = ?
+    ''', (make, model, make, model)).fetchone()
+    return {'max_id': max_id or 0, 'max_last_seen': max_last_seen or '', 'rows': rows,
+            'revision': revision or 0, 'schema_version': get_schema_version(conn)}
+
+def read_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('version') == CACHE_VERSION else None
+
+def write_file(path, name, write):
+    # Written next to the old file and renamed over it, a reader never sees half a file
+    tmp_path = os.path.join(path, 'tmp.' + name)
+    write(tmp_path)
+    os.replace(tmp_path, os.path.join(path, name))
+
+def save_array(path, name, array):
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+    write_file(path, f"{name}.npy", write)
+
+def save_json(path, name, value):
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f)
+    write_file(path, name, write)
+
+def numeric_array(values):
+    if any(v is None for v in values):
+        return np.array([np.nan if v is None else v for v in values], dtype='float64')
+    return np.array(values, dtype='int64')
+
+def encode(values, categories, codes):
+    # None gets code -1, new values are added to the end of categories
+    result = np.empty(len(values), dtype='int32')
+    for i, v in enumerate(values):
+        if v is None:
+            result[i] = -1
+            continue
+        if v not in codes:
+            codes[v] = len(categories)
+            categories.append(v)
+        result[i] = codes[v]
+    return result
+
+def fetch_columns(conn, columns, where, params):
+    names = ', '.join(name for name, _ in columns)
+    rows = conn.execute(f'SELECT {names} FROM cars WHERE make = ? AND model = ? {where} ORDER BY id',
+                        params).fetchall()
+    return {name: [row[i] for row in rows] for i, (name, _) in enumerate(columns)}
+
+def build_segment(conn, make, model, path, columns, watermark):
+    values = fetch_columns(conn, columns, '', (make, model))
+    os.makedirs(path, exist_ok=True)
+    for name, is_integer in columns:
+        if is_integer:
+            save_array(path, name, numeric_array(values[name]))
+        else:
+            categories = []
+            save_array(path, name, encode(values[name], categories, {}))
+            save_json(path, f"{name}.json", categories)
+    save_json(path, 'meta.json', dict(watermark, version=CACHE_VERSION, columns=columns))
+
+def update_segment(conn, make, model, path, meta, watermark):
+    columns = meta['columns']
+    # Rows with a newer last_seen may have a new price or mileage, rows with a newer id are new
+    changed = fetch_columns(conn, columns, 'AND id <= ? AND last_seen > ?',
+                            (make, model, meta['max_id'], meta['max_last_seen']))
+    added = fetch_columns(conn, columns, 'AND id > ?', (make, model, meta['max_id']))
+    
+    ids = np.load(os.path.join(path, 'id.npy'))
+    positions = np.searchsorted(ids, np.array(changed['id'], dtype='int64'))
+    for name, is_integer in columns:
+        array = np.load(os.path.join(path, f"{name}.npy"))
+        if is_integer:
+            changed_values = numeric_array(changed[name])
+            added_values = numeric_array(added[name])
+            # A NULL in the new rows turns an int64 column into float64
+            if 'f' in (array.dtype.kind, changed_values.dtype.kind, added_values.dtype.kind):
+                array = array.astype('float64')
+        else:
+            with open(os.path.join(path, f"{name}.json"), encoding='utf-8') as f:
+                categories = json.load(f)
+            codes = {v: i for i, v in enumerate(categories)}
+            changed_values = encode(changed[name], categories, codes)
+            added_values = encode(added[name], categories, codes)
+            save_json(path, f"{name}.json", categories)
+        array[positions] = changed_values
+        save_array(path, name, np.concatenate([array, added_values]))
+    save_json(path, 'meta.json', dict(watermark, version=CACHE_VERSION, columns=columns))
+    return len(changed['id']), len(added['id'])
+
+def refresh(conn, make=None, model=None, cache_dir=CACHE_DIR):
+    columns = table_columns(conn)
+    for segment_make, segment_model in segments(conn, make, model):
+        path = segment_dir(segment_make, segment_model, cache_dir)
+        watermark = segment_watermark(conn, segment_make, segment_model)
+        meta = read_meta(path)
+        if meta and meta['columns'] == [list(c) for c in columns] and \
+                {k: meta[k] for k in watermark} == watermark:
+            continue
+        
+        # Deleted rows, rows updated in place or a changed table can't be caught up incrementally
+        if meta is None or meta['columns'] != [list(c) for c in columns] or \
+                watermark['max_id'] < meta['max_id'] or watermark['rows'] < meta['rows'] or \
+                watermark['revision'] != meta['revision'] or watermark['schema_version'] != meta['schema_version']:
+            build_segment(conn, segment_make, segment_model, path, columns, watermark)
+            print(f"Analysis cache: built {segment_make} {segment_model} ({watermark['rows']} cars)")
+        else:
+            changed, added = update_segment(conn, segment_make, segment_model, path, meta, watermark)
+            if meta['rows'] + added != watermark['rows']:
+                # Rows were deleted as well as added, or a scrape wrote while we read
+                build_segment(conn, segment_make, segment_model, path, columns,
+                              segment_watermark(conn, segment_make, segment_model))
+            print(f"Analysis cache: {segment_make} {segment_model} {added} new and {changed} updated cars")
+
+def load_segment(path):
+    meta = read_meta(path)
+    if meta is None:
+        return None, None
+    frame = {}
+    for name, is_integer in meta['columns']:
+        array = np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+        if len(array) != meta['rows']:
+            return None, None
+        if is_integer:
+            frame[name] = array
+        else:
+            with open(os.path.join(path, f"{name}.json"), encoding='utf-8') as f:
+                categories = np.array(json.load(f) + [None], dtype=object)
+            frame[name] = categories[array]
+    return pd.DataFrame(frame, copy=False), meta
+
+def load(conn, make=None, model=None, cache_dir=CACHE_DIR):
+    # The cached cars of every matching segment, or None if any of them is missing or stale
+    columns = [list(c) for c in table_columns(conn)]
+    if not (make and model) and conn.execute(
+            'SELECT 1 FROM cars WHERE make IS NULL OR model IS NULL LIMIT 1').fetchone():
+        # Those rows are in no segment
+        return None
+    frames = []
+    for segment_make, segment_model in segments(conn, make, model):
+        frame, meta = load_segment(segment_dir(segment_make, segment_model, cache_dir))
+        if frame is None or meta['columns'] != columns:
+            return None
+        if {k: meta[k] for k in WATERMARK_KEYS} != segment_watermark(conn, segment_make, segment_model):
+            return None
+        frames.append(frame)
+    if not frames:
+        return None
+    if len(frames) == 1:
+        return frames[0]
+    frame = pd.concat(frames, ignore_index=True)
+    if make:
+        # Same order as the make/model index SQLite reads a make through
+        return frame
+    return frame.sort_values('id', kind='stable').reset_index(drop=True)
+
+if __name__ == "__main__":
+    conn = sqlite3.connect('cars.db')
+    require_schema(conn)
+    refresh(conn)
+    conn.close()
@@ -0,0 +1,166 @@
+import pandas as pd
+
+# Queries behind analyze_cars and display_inventory_counts. Filters, aggregates,
+# medians and top-N run in SQLite, only the small results are read into pandas.
+#
+# The results match what the old code computed from SELECT * in pandas: rows
+# with no price, mileage and year are left out, ties are broken by the order
+# SQLite returned the rows in (through the make/model index when a make is
+# given, by id otherwise), and the top-N frames keep that row number as index.
+
+NUMBER_COLUMNS = ('year', 'price', 'mileage')
+TEXT_COLUMNS = ('make', 'model', 'location')
+DISPLAY_COLUMNS = ['make', 'model', 'year', 'price', 'mileage', 'location']
+
+def matching_cars(make=None, model=None, with_position=False):
+    # A WITH clause defining matching and cars_with_data, and its parameters. Numbering
+    # the rows costs a sort, only queries that break ties need it.
+    where = "WHERE 1=1"
+    params = []
+    if make:
+        where += " AND make = ?"
+        params.append(make)
+    if model:
+        where += " AND model = ?"
+        params.append(model)
+    position = ""
+    if with_position:
+        order = "make, model, id" if make else "id"
+        position = f"ROW_NUMBER() OVER (ORDER BY {order}) - 1 AS position,"
+    
+    sql = f'''
+        WITH matching AS (
+            SELECT {position} make, model, year, price, mileage, location
+            FROM cars {where}
+        ), cars_with_data AS (
+            SELECT * FROM matching
+            WHERE price IS NOT NULL OR mileage IS NOT NULL OR year IS NOT NULL
+        )
+    '''
+    return sql, params
+
+def as_float(value):
+    # AVG of no values is NULL, pandas gives NaN
+    return float('nan') if value is None else value
+
+def median(conn, column, make=None, model=None):
+    # Middle value, or the mean of the two middle values, read with LIMIT/OFFSET
+    with_sql, params = matching_cars(make, model)
+    count = conn.execute(f"{with_sql} SELECT COUNT({column}) FROM cars_with_data", params).fetchone()[0]
+    if count == 0:
+        return float('nan')
+    values = conn.execute(f'''
+        {with_sql} SELECT {column} FROM cars_with_data WHERE {column} IS NOT NULL
+        ORDER BY {column} LIMIT ? OFFSET ?
+    ''', params + [2 - count % 2, (count - 1) // 2]).fetchall()
+    return sum(v for v, in values) / len(values)
+
+def basic_statistics(conn, make=None, model=None):
+    with_sql, params = matching_cars(make, model)
+    row = conn.execute(f'''
+        {with_sql}
+        SELECT COUNT(price IS NOT NULL OR mileage IS NOT NULL OR year IS NOT NULL OR NULL),
+               AVG(price), AVG(mileage), AVG(year),
+               COUNT(*) - COUNT(year), COUNT(*) - COUNT(price), COUNT(*) - COUNT(mileage)
+        FROM matching
+    ''', params).fetchone()
+    count, avg_price, avg_mileage, avg_year, *missing = row
+    return {
+        'count': count,
+        'avg_price': as_float(avg_price),
+        'median_price': median(conn, 'price', make, model) if count else float('nan'),
+        'avg_mileage': as_float(avg_mileage),
+        'avg_year': as_float(avg_year),
+        # Columns with a missing value anywhere in the matching rows were float64 in the
+        # frame, even when the rows with no price, mileage and year were dropped later
+        'has_missing': dict(zip(NUMBER_COLUMNS, (m > 0 for m in missing))),
+    }
+
+def price_mileage_points(conn, make=None, model=None):
+    with_sql, params = matching_cars(make, model)
+    return pd.read_sql_query(f'''
+        {with_sql} SELECT mileage, price FROM cars_with_data
+        WHERE price IS NOT NULL AND mileage IS NOT NULL
+    ''', conn, params=params)
+
+def average_price_by_year(conn, make=None, model=None):
+    with_sql, params = matching_cars(make, model)
+    return pd.read_sql_query(f'''
+        {with_sql} SELECT year, AVG(price) AS price FROM cars_with_data
+        WHERE year IS NOT NULL GROUP BY year HAVING AVG(price) IS NOT NULL ORDER BY year
+    ''', conn, params=params)
+
+def location_counts(conn, make=None, model=None, limit=10):
+    # Most common locations, 'N/A' counts as missing
+    with_sql, params = matching_cars(make, model, with_position=True)
+    rows = conn.execute(f'''
+        {with_sql} SELECT location, COUNT(*) AS count FROM cars_with_data
+        WHERE location IS NOT NULL AND location != 'N/A'
+        GROUP BY location ORDER BY count DESC, MIN(position) LIMIT ?
+    ''', params + [limit]).fetchall()
+    return pd.Series([count for _, count in rows], index=pd.Index([loc for loc, _ in rows], name='location'),
+                     name='count', dtype='int64')
+
+def top_cars(conn, column, has_missing, make=None, model=None, limit=5):
+    # The cars with the highest value in column, first seen first on ties
+    with_sql, params = matching_cars(make, model, with_position=True)
+    rows = conn.execute(f'''
+        {with_sql} SELECT position, {', '.join(DISPLAY_COLUMNS)} FROM cars_with_data
+        WHERE {column} IS NOT NULL ORDER BY {column} DESC, position LIMIT ?
+    ''', params + [limit]).fetchall()
+    
+    index = [row[0] for row in rows]
+    data = {}
+    for i, name in enumerate(DISPLAY_COLUMNS, start=1):
+        values = [row[i] for row in rows]
+        if name in TEXT_COLUMNS:
+            data[name] = pd.Series(values, index=index, dtype='str')
+        elif has_missing[name]:
+            data[name] = pd.Series(values, index=index, dtype='float64')
+        else:
+            data[name] = pd.Series(values, index=index, dtype='int64')
+    return pd.DataFrame(data, index=index)
+
+def inventory_counts(conn):
+    # Cars per make and model with the total per make, in display order
+    return conn.execute('''
+        SELECT make, model, COUNT(*) AS count, SUM(COUNT(*)) OVER (PARTITION BY make) AS total
+        FROM cars GROUP BY make, model ORDER BY make, count DESC
+    ''').fetchall()
+
+def listings_as_of(conn, when, make=None, model=None):
+    # Every listing for sale at when with its asking price then, from price_intervals.
+    # Year, mileage and location are the car's latest values.
+    where = "WHERE i.valid_from <= ? AND (i.valid_to IS NULL OR i.valid_to > ?)"
+    params = [when, when]
+    if make:
+        where += " AND i.make = ?"
+        params.append(make)
+    if model:
+        where += " AND i.model = ?"
+        params.append(model)
+    return pd.read_sql_query(f'''
+        SELECT c.id, i.make, i.model, c.year, c.mileage, c.location, i.price, i.valid_from AS price_since,
+               c.title, c.url
+        FROM price_intervals i JOIN cars c ON c.id = i.car_id
+        {where}
+        ORDER BY i.make, i.model, i.price
+    ''', conn, params=params)
+
+def weekly_prices(conn, make=None, model=None, since=None):
+    # The weekly rollups kept by price_intervals.update_weekly_prices
+    where = "WHERE 1=1"
+    params = []
+    if make:
+        where += " AND make = ?"
+        params.append(make)
+    if model:
+        where += " AND model = ?"
+        params.append(model)
+    if since:
+        where += " AND week >= ?"
+        params.append(since)
+    return pd.read_sql_query(f'''
+        SELECT make, model, week, listings, median_price, ROUND(mean_price) AS mean_price, min_price, max_price
+        FROM weekly_prices {where} ORDER BY make, model, week
+    ''', conn, params=params)
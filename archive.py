@@ -0,0 +1,225 @@
+import os
+import gzip
+import json
+import sqlite3
+import hashlib
+from datetime import datetime, timedelta
+
+# Content-addressed archive of every fetched result and detail page.
+#
+# The html is stored once per distinct content, gzip compressed, under
+# objects/<first two hex digits>/<sha256>.html.gz. index.db records every fetch
+# (url, params, fetch time, scraping run) and which content it returned.
+# A ReplaySession serves archived pages to the normal parse/store pipeline, so
+# extraction changes can be backfilled without touching bytbil.com.
+
+class ResponseArchive:
+    def __init__(self, root='archive', max_age_days=None, max_mb=None):
+        self.root = root
+        self.max_age_days = max_age_days
+        self.max_bytes = max_mb * 1024 * 1024 if max_mb else None
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        
+        self.conn = sqlite3.connect(os.path.join(root, 'index.db'))
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT,
+                url TEXT,
+                params TEXT,
+                page INTEGER,
+                fetched_at DATETIME,
+                scraping_run_id INTEGER,
+                make TEXT,
+                model TEXT,
+                sha256 TEXT,
+                size INTEGER,
+                stored_size INTEGER
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_url ON responses(url, fetched_at)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_run ON responses(make, model, scraping_run_id, page)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_sha256 ON responses(sha256)')
+        self.conn.commit()
+
+    def object_path(self, sha256):
+        return os.path.join(self.root, 'objects', sha256[:2], f"{sha256}.html.gz")
+
+    def store(self, kind, url, params, html_content, scraping_run_id=None, make=None, model=None):
+        data = html_content.encode('utf-8')
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.object_path(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        
+        page = int((params or {}).get('Page', 1)) if kind == 'result' else None
+        with self.conn:
+            self.conn.execute('''
+                INSERT INTO responses (kind, url, params, page, fetched_at, scraping_run_id, make, model,
+                                       sha256, size, stored_size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (kind, url, json.dumps(params, sort_keys=True) if params is not None else None, page,
+                  datetime.now(), scraping_run_id, make, model, sha256, len(data), os.path.getsize(path)))
+        return sha256
+
+    def load(self, sha256):
+        with gzip.open(self.object_path(sha256), 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def crawls(self, make, model, since=None):
+        # The archived runs of a search, oldest first: (scraping_run_id, first fetch time)
+        query = '''
+            SELECT scraping_run_id, MIN(fetched_at) FROM responses
+            WHERE kind = 'result' AND make = ? AND model = ?
+        '''
+        params = [make, model]
+        if since:
+            query += ' AND fetched_at >= ?'
+            params.append(since)
+        query += ' GROUP BY scraping_run_id ORDER BY MIN(fetched_at)'
+        return [(run_id, datetime.fromisoformat(started)) for run_id, started in self.conn.execute(query, params)]
+
+    def result_page(self, make, model, scraping_run_id, page):
+        row = self.conn.execute('''
+            SELECT sha256 FROM responses
+            WHERE kind = 'result' AND make = ? AND model = ? AND scraping_run_id IS ? AND page = ?
+            ORDER BY fetched_at DESC LIMIT 1
+        ''', (make, model, scraping_run_id, page)).fetchone()
+        return self.load(row[0]) if row else None
+
+    def detail_page(self, url, scraping_run_id=None):
+        # Prefer the fetch made by the same run, otherwise the latest one
+        row = self.conn.execute('''
+            SELECT sha256 FROM responses
+            WHERE kind = 'detail' AND url = ?
+            ORDER BY scraping_run_id IS ? DESC, fetched_at DESC LIMIT 1
+        ''', (url, scraping_run_id)).fetchone()
+        return self.load(row[0]) if row else None
+
+    def prune(self):
+        # Drop fetches older than max_age_days, then the oldest fetches until the
+        # objects fit in max_bytes, then the objects no fetch refers to any more
+        removed = 0
+        with self.conn:
+            if self.max_age_days:
+                cutoff = datetime.now() - timedelta(days=self.max_age_days)
+                removed += self.conn.execute('DELETE FROM responses WHERE fetched_at < ?', (cutoff,)).rowcount
+            if self.max_bytes:
+                total = self.stored_bytes()
+                while total > self.max_bytes:
+                    oldest = self.conn.execute(
+                        'SELECT id FROM responses ORDER BY fetched_at LIMIT 1000').fetchall()
+                    if not oldest:
+                        break
+                    self.conn.executemany('DELETE FROM responses WHERE id = ?', oldest)
+                    removed += len(oldest)
+                    total = self.stored_bytes()
+        
+        referenced = {row[0] for row in self.conn.execute('SELECT DISTINCT sha256 FROM responses')}
+        deleted_objects = 0
+        objects_dir = os.path.join(self.root, 'objects')
+        for prefix in os.listdir(objects_dir):
+            for name in os.listdir(os.path.join(objects_dir, prefix)):
+                if name.endswith('.html.gz') and name[:-len('.html.gz')] not in referenced:
+                    os.remove(os.path.join(objects_dir, prefix, name))
+                    deleted_objects += 1
+        if removed or deleted_objects:
+            print(f"Archive pruned: {removed} fetches and {deleted_objects} pages removed")
+
+    def stored_bytes(self):
+        row = self.conn.execute(
+            'SELECT SUM(stored_size) FROM (SELECT stored_size FROM responses GROUP BY sha256)').fetchone()
+        return row[0] or 0
+
+    def session(self, session, scraping_run_id, make, model):
+        return ArchivingSession(session, self, scraping_run_id, make, model)
+
+    def close(self):
+        self.conn.close()
+
+# --- Archiving live responses ---
+
+class ArchivingSession:
+    # Wraps an aiohttp session and archives every page that is read with status 200.
+    # Requests with params are result pages, requests without are detail pages.
+    def __init__(self, session, archive, scraping_run_id, make, model):
+        self.session = session
+        self.archive = archive
+        self.scraping_run_id = scraping_run_id
+        self.make = make
+        self.model = model
+
+    def get(self, url, params=None, **kwargs):
+        return ArchivingRequest(self, self.session.get(url, params=params, **kwargs), url, params)
+
+class ArchivingRequest:
+    def __init__(self, owner, request, url, params):
+        self.owner = owner
+        self.request = request
+        self.url = url
+        self.params = params
+
+    async def __aenter__(self):
+        response = await self.request.__aenter__()
+        return ArchivingResponse(self, response)
+
+    async def __aexit__(self, *exc_info):
+        return await self.request.__aexit__(*exc_info)
+
+class ArchivingResponse:
+    def __init__(self, request, response):
+        self.request = request
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+
+    async def text(self):
+        html_content = await self.response.text()
+        if self.status == 200:
+            owner = self.request.owner
+            kind = 'result' if self.request.params is not None else 'detail'
+            owner.archive.store(kind, self.request.url, self.request.params, html_content,
+                                owner.scraping_run_id, owner.make, owner.model)
+        return html_content
+
+# --- Replaying archived responses ---
+
+class ReplaySession:
+    # Stands in for the aiohttp session and answers from one archived run.
+    # Pages that weren't archived get a 404, which ends the pagination.
+    def __init__(self, archive, make, model, scraping_run_id):
+        self.archive = archive
+        self.make = make
+        self.model = model
+        self.scraping_run_id = scraping_run_id
+
+    def get(self, url, params=None, **kwargs):
+        if params is not None:
+            html_content = self.archive.result_page(self.make, self.model, self.scraping_run_id,
+                                                    int(params.get('Page', 1)))
+        else:
+            html_content = self.archive.detail_page(url, self.scraping_run_id)
+        return ReplayResponse(html_content)
+
+    async def close(self):
+        pass
+
+class ReplayResponse:
+    def __init__(self, html_content):
+        self.html_content = html_content
+        self.status = 200 if html_content is not None else 404
+        self.headers = {}
+
+    async def text(self):
+        return self.html_content
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
@@ -0,0 +1,107 @@
+import sqlite3
+import random
+import time
+import os
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+from main import create_tables
+from migrate_database import migrate
+
+# Times the lookups done by the scraper on a synthetic database, before and after
+# the migrations have added the indexes.
+# Run with: python bench_indexes.py --rows 1000000
+
+MAKES = [('Tesla', 'Model Y'), ('Tesla', 'Model 3'), ('Toyota', 'Avensis'), ('Volvo', 'V70'),
+         ('Mercedes-Benz', 'S-Klass'), ('Volkswagen', 'Golf'), ('BMW', '320'), ('Audi', 'A4')]
+
+def registration_number(i):
+    if i % 20 == 0:
+        return None
+    if i % 10 == 0:
+        return '-'
+    return f"{chr(65 + i % 26)}{chr(65 + (i // 26) % 26)}{chr(65 + (i // 676) % 26)}{i % 1000:03d}{i // 17576}"
+
+def populate(conn, rows, history_rows):
+    c = conn.cursor()
+    start = datetime(2025, 1, 1)
+    
+    def car_rows():
+        for i in range(rows):
+            make, model = MAKES[i % len(MAKES)]
+            seen = start + timedelta(minutes=i)
+            yield (f"{make} {model} {i}", make, model, 2005 + i % 20, str(1000 + i % 30000), 'Stockholm',
+                   str(100000 + i % 500000), f"https://www.bytbil.com/stockholms-lan/personbil-{i}",
+                   registration_number(i), seen, seen)
+    
+    c.executemany('''
+        INSERT INTO cars (title, make, model, year, mileage, location, price, url,
+                          registration_number, first_seen, last_seen)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', car_rows())
+    
+    c.executemany('INSERT INTO price_history (car_id, price, timestamp) VALUES (?, ?, ?)',
+                  ((random.randint(1, rows), str(random.randint(50000, 900000)), start + timedelta(minutes=i))
+                   for i in range(history_rows)))
+    conn.commit()
+
+def time_queries(conn, rows, lookups):
+    c = conn.cursor()
+    ids = [random.randint(0, rows - 1) for _ in range(lookups)]
+    ids = [i for i in ids if registration_number(i) not in (None, '-')]
+    
+    queries = {
+        'exists check by url (parse_cars)': (
+            'SELECT id FROM cars WHERE url = ?',
+            [(f"https://www.bytbil.com/stockholms-lan/personbil-{i}",) for i in ids]),
+        'lookup by registration number (store_car)': (
+            "SELECT id, price FROM cars WHERE registration_number = ? AND registration_number NOT IN ('N/A', '-')",
+            [(registration_number(i),) for i in ids]),
+        'price history for a registration number': (
+            '''SELECT ph.price, ph.timestamp
+               FROM price_history ph
+               JOIN cars c ON ph.car_id = c.id
+               WHERE c.registration_number = ? AND c.registration_number NOT IN ('N/A', '-')
+               ORDER BY ph.timestamp DESC''',
+            [(registration_number(i),) for i in ids]),
+    }
+    
+    results = {}
+    for name, (query, params) in queries.items():
+        start = time.perf_counter()
+        for p in params:
+            c.execute(query, p).fetchall()
+        results[name] = (time.perf_counter() - start) / len(params) * 1000
+        plan = ' / '.join(row[-1] for row in c.execute('EXPLAIN QUERY PLAN ' + query, params[0]))
+        print(f"  {name}: {results[name]:.3f} ms per query  [{plan}]")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time scraper lookups before and after the index migrations')
+    parser.add_argument('--rows', type=int, default=1000000, help='Number of synthetic cars')
+    parser.add_argument('--history-rows', type=int, default=300000, help='Number of synthetic price history rows')
+    parser.add_argument('--lookups', type=int, default=20, help='Number of lookups per query')
+    args = parser.parse_args()
+    
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+        create_tables(conn.cursor())
+        
+        print(f"Creating {args.rows} cars and {args.history_rows} price history rows...")
+        populate(conn, args.rows, args.history_rows)
+        
+        print("\nBefore migrations:")
+        before = time_queries(conn, args.rows, args.lookups)
+        
+        start = time.perf_counter()
+        migrate(conn)
+        print(f"Migrations took {time.perf_counter() - start:.1f}s")
+        
+        print("\nAfter migrations:")
+        after = time_queries(conn, args.rows, args.lookups)
+        
+        print("\nSpeedup:")
+        for name in before:
+            print(f"  {name}: {before[name] / after[name]:,.0f}x")
+        conn.close()
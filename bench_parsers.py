@@ -0,0 +1,161 @@
+import os
+import re
+import time
+import random
+import asyncio
+import argparse
+from urllib.parse import urljoin
+from bs4 import BeautifulSoup
+from parsers import BACKENDS, PARSE_MODES, PageParser, parse_result_page, parse_car_details
+import sample_pages
+
+# Checks that every parser backend gives the same output as the original parsing
+# code in main.py, and compares the parse time for result pages and detail pages.
+# Uses saved pages from --fixtures (result pages are the ones with a result-list),
+# or generated pages from sample_pages.py.
+
+# --- The parsing code as it was in main.py, kept as the reference ---
+
+def legacy_clean_text(text):
+    return re.sub(r'(?:&#xA0;|\xa0|\s+)', '', text).strip()
+
+def legacy_parse_result_page(html_content):
+    soup = BeautifulSoup(html_content, 'html.parser')
+    car_list = soup.find('ul', {'class': 'result-list'})
+    if not car_list:
+        return None
+    
+    listings = []
+    for car in car_list.find_all('li', {'class': 'result-list-item'}):
+        price_elem = car.find('span', {'class': 'car-price-main'})
+        if price_elem:
+            price_text = legacy_clean_text(price_elem.text)
+            if any(variant in price_text.lower() for variant in ['/mån', '/månad']):
+                continue
+            price = price_text.replace('kr', '').replace(' ', '')
+        else:
+            continue
+        title_elem = car.find('h3', {'class': 'car-list-header'})
+        if not title_elem or not title_elem.find('a'):
+            continue
+        title = title_elem.find('a').text.strip()
+        url = urljoin('https://www.bytbil.com', title_elem.find('a')['href'])
+        details = car.find('p', {'class': 'uk-text-truncate'})
+        if not details:
+            continue
+        details_text = [d.strip() for d in details.text.split('|')]
+        listings.append({
+            'title': title,
+            'year': legacy_clean_text(details_text[0]),
+            'mileage': legacy_clean_text(details_text[1]).replace('mil', '') if len(details_text) > 1 else 'N/A',
+            'location': legacy_clean_text(details_text[2]) if len(details_text) > 2 else 'N/A',
+            'price': price,
+            'url': url
+        })
+    return listings
+
+def legacy_parse_car_details(html_content):
+    soup = BeautifulSoup(html_content, 'html.parser')
+    more_car_data = {}
+    for label, field in [('Regnr', 'registration_number'), ('Färg', 'color'), ('Drivhjul', 'drive_type'),
+                         ('Växellåda', 'gearbox'), ('Karosseri', 'bodytype')]:
+        elem = soup.find('dt', string=label)
+        if elem and elem.find_next_sibling('dd'):
+            more_car_data[field] = elem.find_next_sibling('dd').text.strip()
+    return more_car_data
+
+# --- Corpus ---
+
+def load_fixtures(path):
+    result_pages, detail_pages = [], []
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.html'):
+            with open(os.path.join(path, name), encoding='utf-8') as f:
+                html_content = f.read()
+            (result_pages if 'result-list' in html_content else detail_pages).append(html_content)
+    return result_pages, detail_pages
+
+def generate_fixtures(result_count, detail_count):
+    rng = random.Random(1)
+    result_pages = []
+    for page in range(result_count):
+        cars = [sample_pages.make_car(page * 25 + i, rng=rng) for i in range(25)]
+        result_pages.append(sample_pages.result_page_html(cars, seed=page))
+    result_pages.append(sample_pages.result_page_html([], seed=result_count))
+    detail_pages = [sample_pages.detail_page_html(sample_pages.make_car(i, rng=rng)) for i in range(detail_count)]
+    return result_pages, detail_pages
+
+def time_parser(parse, pages):
+    start = time.perf_counter()
+    outputs = [parse(page) for page in pages]
+    return (time.perf_counter() - start) / len(pages) * 1000, outputs
+
+def available_backends():
+    backends = []
+    for backend in BACKENDS:
+        try:
+            parse_car_details('<dl><dt>Regnr</dt><dd>ABC123</dd></dl>', backend)
+            backends.append(backend)
+        except RuntimeError as e:
+            print(f"Skipping {backend}: {e}")
+    return backends
+
+async def bench_mode(mode, backend, result_pages, detail_pages, workers):
+    # Parses a stream of pages like a run does, while a ticker measures how long the
+    # event loop is blocked, which is time no download can make progress
+    parser = PageParser(backend, mode, workers)
+    lags = []
+    done = asyncio.Event()
+    
+    async def ticker():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - start - 0.001)
+    
+    ticker_task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    for page in result_pages:
+        await asyncio.gather(parser.result_page(page), *(parser.car_details(d) for d in detail_pages[:5]))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await ticker_task
+    parser.close()
+    
+    for line in parser.summary():
+        print(f"{mode:>8}: {line}")
+    print(f"{mode:>8}: total {elapsed:.2f}s, event loop blocked up to {max(lags) * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare output and speed of the HTML parser backends')
+    parser.add_argument('--fixtures', type=str, help='Directory with saved result and detail pages (*.html)')
+    parser.add_argument('--result-pages', type=int, default=20, help='Number of generated result pages')
+    parser.add_argument('--detail-pages', type=int, default=100, help='Number of generated detail pages')
+    parser.add_argument('--modes', action='store_true', help='Also measure per-page latency in each parse mode')
+    parser.add_argument('--backend', choices=BACKENDS, default='bs4', help='Backend used with --modes')
+    parser.add_argument('--workers', type=int, default=2, help='Workers used with --modes')
+    args = parser.parse_args()
+    
+    if args.fixtures:
+        result_pages, detail_pages = load_fixtures(args.fixtures)
+    else:
+        result_pages, detail_pages = generate_fixtures(args.result_pages, args.detail_pages)
+    print(f"Corpus: {len(result_pages)} result pages, {len(detail_pages)} detail pages")
+    
+    for kind, pages, legacy, parse in [('result pages', result_pages, legacy_parse_result_page, parse_result_page),
+                                       ('detail pages', detail_pages, legacy_parse_car_details, parse_car_details)]:
+        if not pages:
+            continue
+        print(f"\n=== {kind} ===")
+        legacy_ms, expected = time_parser(legacy, pages)
+        print(f"{'original':>10}: {legacy_ms:8.2f} ms/page")
+        for backend in available_backends():
+            ms, outputs = time_parser(lambda page: parse(page, backend), pages)
+            mismatches = sum(1 for a, b in zip(outputs, expected) if a != b)
+            status = 'identical' if mismatches == 0 else f'{mismatches} pages DIFFER'
+            print(f"{backend:>10}: {ms:8.2f} ms/page  {legacy_ms / ms:5.1f}x  {status}")
+    
+    if args.modes:
+        print(f"\n=== Parse modes ({args.backend}, {args.workers} workers) ===")
+        for mode in PARSE_MODES:
+            asyncio.run(bench_mode(mode, args.backend, result_pages, detail_pages, args.workers))
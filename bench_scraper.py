@@ -0,0 +1,327 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+from datetime import datetime
+from urllib.parse import urlsplit
+from aiohttp import web
+import main
+from metrics import disable_metrics
+from memory_profile import peak_rss_mb
+from parsers import BACKENDS, DEFAULT_BACKEND, PARSE_MODES, DEFAULT_PARSE_MODE, PageParser
+from sample_pages import car_path
+from stand_in_server import DEFAULT_PAGE_SIZE, Inventory, StandInServer, create_app
+
+# End-to-end benchmark of run_search against stand_in_server.py, with the delays
+# switched off. Runs the searches twice on a new database: 'new' finds every car
+# for the first time and fetches its detail page, 'known' finds them all again
+# and only reads result pages. With --relist-rate some cars are relisted under a
+# new url in between, and 'known' reports the detail pages it didn't fetch for them.
+# With --lookalike-rate some cars get a lookalike listed next to them, another car
+# with the same title, year and location, and 'known' reports any it took for a
+# relisting of the original (it should be none).
+# Reports pages/s and cars/s and how the time splits
+# between fetching, parsing and the database, and writes the results to JSON so
+# runs can be compared across changes.
+#
+# Fetch time is counted per request from sending it to having read the body,
+# summed over requests, so it can exceed the wall time with --max-inflight > 1.
+
+SEARCHES = [('Tesla', 'Model Y'), ('Toyota', 'Avensis'), ('Mercedes-Benz', 'S-Klass'),
+            ('Tesla', 'Model 3'), ('Tesla', 'Model X'), ('Tesla', 'Model S')]
+
+# --- Timing the scraper's database and HTTP calls ---
+
+class TimedCursor(sqlite3.Cursor):
+    def _timed(self, call, *args):
+        start = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            self.connection.seconds += time.perf_counter() - start
+
+    def execute(self, *args):
+        return self._timed(super().execute, *args)
+
+    def executemany(self, *args):
+        return self._timed(super().executemany, *args)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def __next__(self):
+        return self._timed(super().__next__)
+
+class TimedConnection(sqlite3.Connection):
+    # Adds up the time spent in SQLite: statements, fetching rows and commits
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.seconds = 0.0
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def __exit__(self, *exc_info):
+        # Commit or rollback at the end of a 'with conn:' block
+        start = time.perf_counter()
+        try:
+            return super().__exit__(*exc_info)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+class TimedSession:
+    # Wraps the aiohttp session and times each request until its body is read.
+    # Requests with params are result pages, requests without are detail pages.
+    def __init__(self, session):
+        self.session = session
+        self.seconds = 0.0
+        self.pages = {'result': 0, 'detail': 0}
+        self.errors = 0
+        self.bytes = 0
+
+    def get(self, url, params=None, **kwargs):
+        return TimedRequest(self, self.session.get(url, params=params, **kwargs),
+                            'result' if params is not None else 'detail')
+
+class TimedRequest:
+    def __init__(self, owner, request, kind):
+        self.owner = owner
+        self.request = request
+        self.kind = kind
+        self.start = None
+
+    async def __aenter__(self):
+        self.start = time.perf_counter()
+        response = await self.request.__aenter__()
+        if response.status != 200:
+            # The scraper doesn't read the body of an error
+            self.owner.seconds += time.perf_counter() - self.start
+            self.owner.errors += 1
+        return TimedResponse(self, response)
+
+    async def __aexit__(self, *exc_info):
+        return await self.request.__aexit__(*exc_info)
+
+class TimedResponse:
+    def __init__(self, request, response):
+        self.request = request
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+
+    async def text(self):
+        html_content = await self.response.text()
+        if self.status == 200:
+            owner = self.request.owner
+            owner.seconds += time.perf_counter() - self.request.start
+            owner.pages[self.request.kind] += 1
+            owner.bytes += len(html_content)
+        return html_content
+
+# --- Benchmark ---
+
+async def bench_run(name, base_url, db_path, searches, args):
+    parser = PageParser(args.parser, args.parse_mode, args.parse_workers)
+    conn = main.setup_database(db_path, factory=TimedConnection)
+    conn.seconds = 0.0
+    stop_flag = main.setup_stop_flag()
+    # No delays unless a request rate is given, e.g. to see the slow-down on 429s
+    limiter = main.RateLimiter(args.rate) if args.rate else main.NoDelay()
+    memory_budget = main.MemoryBudget(args.memory_budget * 1024 * 1024) if args.memory_budget else None
+    cars = 0
+    relisted = 0
+
+    async with main.create_session(args.max_inflight + 2) as http_session:
+        session = TimedSession(http_session)
+        start = time.perf_counter()
+        # The scraper prints a line per car, which would be part of the timing on a terminal
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for make, model in searches:
+                counters = await main.run_search(
+                    make, model, max_inflight=args.max_inflight, limiter=limiter,
+                    batch_rows=args.batch_rows, parser=parser, session=session, conn=conn,
+                    stop_flag=stop_flag, base_url=base_url, memory_budget=memory_budget,
+                    relist_threshold=args.relist_threshold)
+                cars += counters['total']
+                relisted += counters.get('relisted', 0)
+        seconds = time.perf_counter() - start
+    conn.close()
+    parser.close()
+
+    pages = session.pages['result'] + session.pages['detail']
+    parse_seconds = sum(parser.seconds.values())
+    return {
+        'name': name,
+        'seconds': seconds,
+        'cars': cars,
+        'result_pages': session.pages['result'],
+        'detail_pages': session.pages['detail'],
+        'http_errors': session.errors,
+        'detail_fetches_avoided': relisted,
+        'megabytes': session.bytes / 1e6,
+        'pages_per_second': pages / seconds,
+        'cars_per_second': cars / seconds,
+        'fetch_seconds': session.seconds,
+        'parse_seconds': parse_seconds,
+        'db_seconds': conn.seconds,
+        # Of the whole process so far, with the in-process server that includes its pages
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def print_run(run):
+    print(f"\n=== {run['name']}: {run['cars']} cars, {run['result_pages']} result pages, "
+          f"{run['detail_pages']} detail pages, {run['http_errors']} errors in {run['seconds']:.2f} s ===")
+    if run['detail_fetches_avoided']:
+        print(f"Detail pages not fetched for relisted cars: {run['detail_fetches_avoided']}")
+    if run.get('lookalikes_linked') is not None:
+        print(f"Lookalike cars linked to the car they look like: {run['lookalikes_linked']}")
+    print(f"Throughput: {run['pages_per_second']:,.1f} pages/s, {run['cars_per_second']:,.1f} cars/s, "
+          f"peak RSS {run['peak_rss_mb']:.1f} MB")
+    for part in ('fetch', 'parse', 'db'):
+        seconds = run[f'{part}_seconds']
+        print(f"  {part:6} {seconds:7.2f} s  {seconds / run['seconds']:6.1%} of wall time")
+
+async def run(args):
+    searches = SEARCHES[:args.searches]
+    runner = None
+    base_url = args.url
+    if not base_url:
+        inventory = Inventory(args.cars, args.page_size, args.seed)
+        for make, model in searches:
+            inventory.prerender(make, model)
+        server = StandInServer(inventory, args.latency, args.jitter, args.error_rate, args.result_error_rate,
+                               args.seed, args.rate_limit, args.retry_after)
+        runner = web.AppRunner(create_app(server))
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/bil"
+
+    temp_dir = None
+    db_path = args.db
+    if not db_path:
+        temp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(temp_dir.name, 'bench.db')
+    lookalike_paths = set()
+    try:
+        runs = [await bench_run('new', base_url, db_path, searches, args)]
+        if (args.relist_rate or args.lookalike_rate) and not args.url:
+            # Some cars come back under a new url before the second run, others get a lookalike
+            for make, model in searches:
+                if args.relist_rate:
+                    inventory.relist(make, model, args.relist_rate, args.seed)
+                if args.lookalike_rate:
+                    lookalike_paths.update(car_path(car) for car in
+                                           inventory.lookalikes(make, model, args.lookalike_rate, args.seed))
+                inventory.prerender(make, model)
+        runs.append(await bench_run('known', base_url, db_path, searches, args))
+        if args.lookalike_rate:
+            with contextlib.closing(sqlite3.connect(db_path)) as conn:
+                linked = [url for url, in conn.execute('SELECT url FROM car_relistings')]
+            runs[-1]['lookalikes_linked'] = sum(urlsplit(url).path in lookalike_paths for url in linked)
+    finally:
+        if runner:
+            await runner.cleanup()
+        if temp_dir:
+            temp_dir.cleanup()
+
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'label': args.label,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'config': {
+            'url': args.url, 'searches': len(searches), 'cars': args.cars, 'page_size': args.page_size,
+            'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+            'result_error_rate': args.result_error_rate, 'rate_limit': args.rate_limit,
+            'retry_after': args.retry_after, 'rate': args.rate, 'retries': args.retries, 'backoff': args.backoff,
+            'max_inflight': args.max_inflight, 'memory_budget': args.memory_budget,
+            'batch_rows': args.batch_rows, 'parser': args.parser, 'parse_mode': args.parse_mode,
+            'parse_workers': args.parse_workers, 'metrics': not args.no_metrics,
+            'relist_rate': args.relist_rate, 'lookalike_rate': args.lookalike_rate,
+            'relist_threshold': args.relist_threshold,
+        },
+        'runs': runs,
+    }
+    for run_result in runs:
+        print_run(run_result)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the scraper end to end against the stand-in server')
+    parser.add_argument('--url', type=str,
+                        help='Search page of a running stand_in_server.py (default: start one in this process)')
+    parser.add_argument('--db', type=str, help='Database to write to (default: a new temporary one)')
+    parser.add_argument('--searches', type=int, default=2, help=f'Number of make/models to scrape (max {len(SEARCHES)})')
+    parser.add_argument('--cars', type=int, default=240, help='Cars per make/model (default: 240)')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE, help='Cars per result page')
+    parser.add_argument('--latency', type=float, default=0.0, help='Average server latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.5, help='Latency varies by this fraction')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of detail pages failing with a 503')
+    parser.add_argument('--result-error-rate', type=float, default=0.0, help='Fraction of result pages failing')
+    parser.add_argument('--rate-limit', type=float, help='Server answers 429 above this many requests per second')
+    parser.add_argument('--retry-after', type=int, help='Retry-After seconds the server sends with 429 and 503')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the inventory, latencies and errors')
+    parser.add_argument('--rate', type=float, help='Requests per minute through the rate limiter (default: no delays)')
+    parser.add_argument('--retries', type=int, default=main.MAX_RETRIES, help='Retries of a failed request')
+    parser.add_argument('--backoff', type=float, default=0.05,
+                        help='First retry waits up to this many seconds, doubled per retry (default: 0.05)')
+    parser.add_argument('--max-inflight', type=int, default=1, help='Detail pages fetched in parallel')
+    parser.add_argument('--memory-budget', type=float,
+                        help='MB of detail pages held in memory at once (default: no cap)')
+    parser.add_argument('--relist-rate', type=float, default=0.0,
+                        help="Fraction of the cars relisted under a new url before the 'known' run")
+    parser.add_argument('--lookalike-rate', type=float, default=0.0,
+                        help="Fraction of the cars that get a lookalike listed next to them before the 'known' run")
+    parser.add_argument('--relist-threshold', type=float, default=main.DEFAULT_RELIST_THRESHOLD,
+                        help='Confidence at which the scraper links a relisted car without its detail page (0: never)')
+    parser.add_argument('--batch-rows', type=int, default=100, help='Cars written per transaction')
+    parser.add_argument('--parser', choices=BACKENDS, default=DEFAULT_BACKEND, help='HTML parser backend')
+    parser.add_argument('--parse-mode', choices=PARSE_MODES, default=DEFAULT_PARSE_MODE, help='Where pages are parsed')
+    parser.add_argument('--parse-workers', type=int, help='Number of parse workers for thread/process mode')
+    parser.add_argument('--no-metrics', action='store_true', help='Switch off the metrics layer in the scraper')
+    parser.add_argument('--label', type=str, help='Free text stored with the results, e.g. the change being measured')
+    parser.add_argument('--output', type=str, default='bench_scraper.json', help='JSON file for the results')
+    args = parser.parse_args()
+
+    if args.searches > len(SEARCHES):
+        parser.error(f"--searches is at most {len(SEARCHES)}")
+    if (args.relist_rate or args.lookalike_rate) and args.url:
+        parser.error("--relist-rate and --lookalike-rate need the in-process server, leave out --url")
+    if args.no_metrics:
+        disable_metrics()
+    main.MAX_RETRIES = args.retries
+    main.BACKOFF_BASE = args.backoff
+    asyncio.run(run(args))
@@ -0,0 +1,95 @@
+import time
+import random
+import asyncio
+import argparse
+import aiohttp
+from aiohttp import web
+from valuation_service import create_app
+
+# Load test for valuation_service.py. Sends valuation requests for the given
+# make/models from a number of concurrent clients and reports throughput and
+# latency percentiles. Without --url a service is started in this process
+# against --db. The first request of each make/model loads or trains its model,
+# the rest are served from the model cache.
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+async def client(session, url, segments, deadline, latencies, errors, rng):
+    while time.perf_counter() < deadline:
+        make, model = rng.choice(segments)
+        params = {'make': make, 'model': model, 'mileage': rng.randint(0, 30000), 'year': rng.randint(2012, 2025)}
+        start = time.perf_counter()
+        try:
+            async with session.get(f"{url}/valuation", params=params) as response:
+                await response.read()
+                if response.status >= 500:
+                    errors.append(response.status)
+                    continue
+        except aiohttp.ClientError as e:
+            errors.append(str(e))
+            continue
+        latencies.append(time.perf_counter() - start)
+
+async def load_test(url, segments, concurrency, seconds, seed):
+    latencies = []
+    errors = []
+    rng = random.Random(seed)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        # Warm up: load every model once, these latencies are not counted
+        for make, model in segments:
+            async with session.get(f"{url}/valuation",
+                                   params={'make': make, 'model': model, 'mileage': 1000, 'year': 2020}) as r:
+                await r.read()
+        
+        start = time.perf_counter()
+        deadline = start + seconds
+        await asyncio.gather(*(client(session, url, segments, deadline, latencies, errors, rng)
+                               for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        
+        async with session.get(f"{url}/status") as r:
+            status = await r.json()
+    
+    latencies.sort()
+    print(f"\n=== Valuation load test: {concurrency} clients, {seconds:.0f} s ===")
+    print(f"Requests: {len(latencies)} ({len(errors)} errors)")
+    print(f"Throughput: {len(latencies) / elapsed:,.0f} requests/s")
+    print(f"Latency p50: {percentile(latencies, 0.50) * 1000:.2f} ms, "
+          f"p95: {percentile(latencies, 0.95) * 1000:.2f} ms, "
+          f"p99: {percentile(latencies, 0.99) * 1000:.2f} ms, "
+          f"max: {(latencies[-1] if latencies else float('nan')) * 1000:.2f} ms")
+    print(f"Model cache: {status['model_cache']}")
+
+async def run(args, segments):
+    if args.url:
+        await load_test(args.url.rstrip('/'), segments, args.concurrency, args.seconds, args.seed)
+        return
+    
+    runner = web.AppRunner(create_app(args.db, args.cache_size))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        await load_test(f"http://127.0.0.1:{port}", segments, args.concurrency, args.seconds, args.seed)
+    finally:
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure throughput and latency of the valuation service')
+    parser.add_argument('--url', type=str, help='Running service to test (default: start one in this process)')
+    parser.add_argument('--db', type=str, default='cars.db', help='Database for the in-process service')
+    parser.add_argument('--cache-size', type=int, default=64, help='Model cache size of the in-process service')
+    parser.add_argument('--segment', action='append', metavar='MAKE/MODEL',
+                        help='Make/model to value, can be repeated (default: Tesla/Model Y)')
+    parser.add_argument('--concurrency', type=int, default=20, help='Number of concurrent clients')
+    parser.add_argument('--seconds', type=float, default=10, help='How long to send requests')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the car values')
+    args = parser.parse_args()
+    
+    segments = [tuple(segment.split('/', 1)) for segment in (args.segment or ['Tesla/Model Y'])]
+    asyncio.run(run(args, segments))
@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from datetime import datetime
+from bench_scraper import SEARCHES, git_revision
+from stand_in_server import DEFAULT_PAGE_SIZE
+
+# Scaling benchmark of crawl_workers.py against stand_in_server.py. Starts the server
+# in its own process, then crawls the searches on a new database with each number of
+# workers in --workers and reports cars/s and the speed-up over the first. Each
+# worker works on --max-inflight jobs at a time (default 1), so the workers are the
+# only parallelism. The time includes starting the worker processes.
+#
+# CPU seconds are those of the crawl's processes (writer and workers) per car. With
+# server latency the speed-up is mostly the workers overlapping their waits for the
+# server. Parsing runs in the workers and storing in the writer, so with --latency 0
+# what is left is parse/store throughput, which only scales with free cores.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"The stand-in server did not start on port {port}")
+
+def crawl(workers, base_url, searches_path, db_path, args):
+    command = [sys.executable, os.path.join(SCRIPT_DIR, 'crawl_workers.py'), '--db', db_path,
+               '--searches', searches_path, '--workers', str(workers), '--max-inflight', str(args.max_inflight),
+               '--rate', '0', '--batch-rows', str(args.batch_rows), '--base-url', base_url]
+    cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.run(command, stdout=devnull, check=True)
+    seconds = time.perf_counter() - start
+    cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_seconds = (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+
+    conn = sqlite3.connect(db_path)
+    cars = conn.execute('SELECT COUNT(*) FROM cars').fetchone()[0]
+    with_details = conn.execute('SELECT COUNT(registration_number) FROM cars').fetchone()[0]
+    incomplete = conn.execute("SELECT COUNT(*) FROM scraping_logs WHERE status != 'completed'").fetchone()[0]
+    conn.close()
+    return {
+        'workers': workers,
+        'seconds': seconds,
+        'cars': cars,
+        'cars_with_details': with_details,
+        'incomplete_runs': incomplete,
+        'cars_per_second': cars / seconds,
+        'cpu_seconds': cpu_seconds,
+        'cpu_ms_per_car': cpu_seconds * 1000 / cars if cars else None,
+    }
+
+def run(args):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(SCRIPT_DIR, 'stand_in_server.py'), '--port', str(port), '--cars', str(args.cars),
+         '--page-size', str(args.page_size), '--latency', str(args.latency), '--seed', str(args.seed)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    runs = []
+    try:
+        wait_for_port(port)
+        base_url = f"http://127.0.0.1:{port}/bil"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            searches_path = os.path.join(temp_dir, 'searches.json')
+            with open(searches_path, 'w', encoding='utf-8') as f:
+                json.dump([{'make': make, 'model': model} for make, model in SEARCHES[:args.searches]], f)
+            for workers in args.workers:
+                db_path = os.path.join(temp_dir, f'workers-{workers}.db')
+                result = crawl(workers, base_url, searches_path, db_path, args)
+                result['speedup'] = result['cars_per_second'] / runs[0]['cars_per_second'] if runs else 1.0
+                runs.append(result)
+                print(f"{workers:3} workers: {result['cars']} cars in {result['seconds']:6.2f} s, "
+                      f"{result['cars_per_second']:6.1f} cars/s, speed-up {result['speedup']:4.2f}, "
+                      f"{result['cpu_ms_per_car']:.1f} ms CPU per car")
+    finally:
+        server.terminate()
+        server.wait()
+
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'label': args.label,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'cpus': os.cpu_count(),
+        'config': {
+            'searches': args.searches, 'cars': args.cars, 'page_size': args.page_size, 'latency': args.latency,
+            'max_inflight': args.max_inflight, 'batch_rows': args.batch_rows, 'seed': args.seed,
+        },
+        'runs': runs,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark crawl_workers.py with more and more worker processes')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='Numbers of workers to crawl with (default: 1 2 4 8)')
+    parser.add_argument('--searches', type=int, default=2, help=f'Number of make/models to scrape (max {len(SEARCHES)})')
+    parser.add_argument('--cars', type=int, default=240, help='Cars per make/model (default: 240)')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE, help='Cars per result page')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Average server latency in seconds (default: 0.05)')
+    parser.add_argument('--max-inflight', type=int, default=1, help='Jobs each worker works on at a time')
+    parser.add_argument('--batch-rows', type=int, default=100, help='Jobs the writer stores per transaction')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the inventory and latencies')
+    parser.add_argument('--label', type=str, help='Free text stored with the results, e.g. the change being measured')
+    parser.add_argument('--output', type=str, default='bench_workers.json', help='JSON file for the results')
+    args = parser.parse_args()
+
+    if args.searches > len(SEARCHES):
+        parser.error(f"--searches is at most {len(SEARCHES)}")
+    run(args)
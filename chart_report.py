@@ -0,0 +1,185 @@
+import os
+import re
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib
+from migrate_database import migrate
+import price_models
+
+# Renders the charts of analyze_cars and predict_car_price for every make/model
+# into an output directory, without a display. Segments are drawn in a process
+# pool with the Agg backend. Above max_points a scatter shows a random sample of
+# the points (or a hexbin of all of them), the trend lines are still fitted on
+# every point, and seaborn's bootstrapped confidence band is only drawn with ci.
+# The price models are brought up to date first (incrementally, see price_models.py)
+# and the workers draw the stored ones, nothing is refit per chart.
+
+DEFAULT_MAX_POINTS = 2000
+DEFAULT_DPI = 100
+
+def use_agg():
+    # In each worker, before pyplot draws anything
+    matplotlib.use('Agg')
+
+def segment_name(make, model):
+    return re.sub(r'[^\w.-]+', '_', f"{make}_{model}").strip('_')
+
+def sample(df, max_points, seed=0):
+    if len(df) <= max_points:
+        return df
+    rng = np.random.default_rng(seed)
+    return df.iloc[np.sort(rng.choice(len(df), max_points, replace=False))]
+
+def scatter(ax, df, x, y, max_points, hexbin):
+    # df is either already sampled or drawn whole as a hexbin
+    if hexbin and len(df) > max_points:
+        ax.hexbin(df[x], df[y], gridsize=50, mincnt=1, cmap='Blues')
+    else:
+        ax.scatter(df[x], df[y], alpha=0.5)
+
+def trend_line(ax, df, x, y, label=None):
+    # Least squares line over every point
+    if len(df) < 2 or df[x].nunique() < 2:
+        return
+    slope, intercept = np.polyfit(df[x].to_numpy(dtype='float64'), df[y].to_numpy(dtype='float64'), 1)
+    xs = np.linspace(df[x].min(), df[x].max(), 100)
+    ax.plot(xs, intercept + slope * xs, 'r-', label=label)
+
+def save(fig, output_dir, file_name, dpi):
+    import matplotlib.pyplot as plt
+
+    # Fixed margins instead of tight_layout, which draws the figure an extra time,
+    # and the fastest PNG compression. Drawing is most of the time of a segment.
+    fig.subplots_adjust(left=0.1, right=0.95, bottom=0.1)
+    fig.savefig(os.path.join(output_dir, file_name), dpi=dpi, pil_kwargs={'compress_level': 1})
+    plt.close(fig)
+    return file_name
+
+def render_segment(db_path, make, model, output_dir, max_points=DEFAULT_MAX_POINTS, hexbin=False, ci=False,
+                   dpi=DEFAULT_DPI):
+    # Writes the charts of one make/model, returns the file names and the time taken
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    import analysis_queries
+
+    start = time.perf_counter()
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        points = analysis_queries.price_mileage_points(conn, make, model)
+        yearly_data = analysis_queries.average_price_by_year(conn, make, model)
+        # Updated by render_all, None for a make/model with too few cars
+        price_model = price_models.load_model(conn, make, model)
+        training = price_models.training_data(conn, make, model, price_model.reference_year) if price_model else None
+    finally:
+        conn.close()
+
+    name = segment_name(make, model)
+    files = []
+    filter_text = f" for {make} {model}"
+
+    if len(points) > 0:
+        fig, ax = plt.subplots(figsize=(10, 6))
+        shown = sample(points, max_points)
+        if ci:
+            sns.regplot(data=shown, x='mileage', y='price', ax=ax, ci=95, n_boot=200,
+                        scatter=not hexbin or len(points) <= max_points,
+                        scatter_kws={'alpha': 0.6}, line_kws={'color': 'red'})
+            if hexbin and len(points) > max_points:
+                scatter(ax, points, 'mileage', 'price', max_points, hexbin)
+        else:
+            scatter(ax, points if hexbin else shown, 'mileage', 'price', max_points, hexbin)
+            trend_line(ax, points, 'mileage', 'price')
+        ax.set_title(f'Price vs Mileage{filter_text}')
+        ax.set_xlabel('Mileage (mil)')
+        ax.set_ylabel('Price (SEK)')
+        files.append(save(fig, output_dir, f"{name}_price_vs_mileage.png", dpi))
+
+    if len(yearly_data) > 0:
+        fig, ax = plt.subplots(figsize=(10, 6))
+        ax.plot(yearly_data['year'], yearly_data['price'], marker='o' if len(yearly_data) < 3 else None)
+        ax.set_title(f'Average Price by Year{filter_text}')
+        ax.set_xlabel('Year')
+        ax.set_ylabel('Average Price (SEK)')
+        files.append(save(fig, output_dir, f"{name}_price_by_year.png", dpi))
+
+    if price_model is not None and len(training) > 0:
+        fig, (left, right) = plt.subplots(1, 2, figsize=(12, 5))
+        shown = training if hexbin else sample(training, max_points)
+        scatter(left, shown, 'mileage', 'price', max_points, hexbin)
+        mileage_range = np.linspace(training['mileage'].min(), training['mileage'].max(), 100)
+        left.plot(mileage_range, price_model.predict(mileage_range, training['age'].mean()), 'r-',
+                  label='Prediction (avg age)')
+        left.set_xlabel('Mileage (mil)')
+        left.set_ylabel('Price (kr)')
+        left.set_title('Price vs Mileage')
+        left.legend()
+
+        scatter(right, shown, 'age', 'price', max_points, hexbin)
+        age_range = np.linspace(training['age'].min(), training['age'].max(), 100)
+        right.plot(age_range, price_model.predict(training['mileage'].mean(), age_range), 'r-',
+                   label='Prediction (avg mileage)')
+        right.set_xlabel('Age (years)')
+        right.set_ylabel('Price (kr)')
+        right.set_title('Price vs Age')
+        right.legend()
+
+        fig.suptitle(f'Price Prediction{filter_text}')
+        fig.subplots_adjust(top=0.88, wspace=0.3)
+        files.append(save(fig, output_dir, f"{name}_prediction.png", dpi))
+
+    return make, model, files, time.perf_counter() - start
+
+def render_all(db_path='cars.db', output_dir='charts', workers=None, max_points=DEFAULT_MAX_POINTS, hexbin=False,
+               ci=False, dpi=DEFAULT_DPI, make=None, model=None):
+    os.makedirs(output_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    # The workers open the database read-only
+    migrate(conn)
+    query = "SELECT DISTINCT make, model FROM cars WHERE make IS NOT NULL AND model IS NOT NULL"
+    params = []
+    if make:
+        query += " AND make = ?"
+        params.append(make)
+    if model:
+        query += " AND model = ?"
+        params.append(model)
+    segments = conn.execute(query + " ORDER BY make, model", params).fetchall()
+
+    start = time.perf_counter()
+    for segment_make, segment_model in segments:
+        price_models.get_model(conn, segment_make, segment_model)
+    conn.close()
+    print(f"Price models up to date in {time.perf_counter() - start:.1f} s")
+
+    images = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=use_agg) as pool:
+        futures = [pool.submit(render_segment, db_path, segment_make, segment_model, output_dir, max_points,
+                               hexbin, ci, dpi)
+                   for segment_make, segment_model in segments]
+        for future in futures:
+            segment_make, segment_model, files, seconds = future.result()
+            images += len(files)
+            print(f"{segment_make} {segment_model}: {len(files)} charts in {seconds:.2f} s")
+
+    print(f"\nWrote {images} charts for {len(segments)} make/models to {output_dir}/ "
+          f"in {time.perf_counter() - start:.1f} s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render the analysis charts of every make/model to image files')
+    parser.add_argument('--db', type=str, default='cars.db', help='Database file (default: cars.db)')
+    parser.add_argument('--output', type=str, default='charts', help='Directory for the images (default: charts)')
+    parser.add_argument('--make', type=str, help='Only this make')
+    parser.add_argument('--model', type=str, help='Only this model')
+    parser.add_argument('--workers', type=int, help='Rendering processes (default: one per CPU)')
+    parser.add_argument('--max-points', type=int, default=DEFAULT_MAX_POINTS,
+                        help=f'Most points drawn in a scatter plot, more are sampled (default: {DEFAULT_MAX_POINTS})')
+    parser.add_argument('--hexbin', action='store_true', help='Draw large scatter plots as hexbins of every point')
+    parser.add_argument('--ci', action='store_true', help="Draw seaborn's bootstrapped confidence band")
+    parser.add_argument('--dpi', type=int, default=DEFAULT_DPI, help=f'Image resolution (default: {DEFAULT_DPI})')
+    args = parser.parse_args()
+
+    render_all(args.db, args.output, args.workers, args.max_points, args.hexbin, args.ci, args.dpi,
+               args.make, args.model)
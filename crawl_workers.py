@@ -0,0 +1,465 @@
+import os
+import json
+import time
+import signal
+import socket
+import sqlite3
+import asyncio
+import argparse
+import multiprocessing
+from datetime import datetime, timedelta
+import main
+from main import (DEFAULT_RATE, MAX_RETRIES, NoDelay, RateLimiter, CarWriter, create_session, setup_database,
+                  setup_stop_flag, request_headers, fetch_result_page, read_result_page, fetch_car_details,
+                  normalize_numbers, find_listing, add_details, first_page_params, paginated_params,
+                  log_scraping_run, reopen_scraping_run, finish_scraping_run, last_full_sweep, load_searches,
+                  random_user_agent, retry_failed_details)
+from listing_index import ListingIndex
+from metrics import new_run_metrics, disable_metrics
+from parsers import BACKENDS, DEFAULT_BACKEND, BASE_URL, PageParser
+
+# Runs the searches with several worker processes coordinated through the crawl_jobs
+# table, on one box or on several sharing the database. A job is a result page or a
+# detail page of a run:
+#   result  fetches and parses a result page (the pagination of run_search). The known
+#           cars of the page are its result (find_listing, as in parse_cars), every new
+#           car becomes a detail job and a page with cars queues the next page.
+#   detail  fetches and parses the detail page of a new car (add_details, as in
+#           parse_cars), the car with its details is its result.
+# Workers lease jobs for LEASE_SECONDS and renew the lease with a heartbeat while they
+# work on them. The jobs of a worker that dies are leased again when the lease expires,
+# a job that fails MAX_JOB_ATTEMPTS times is given up. A finished job keeps its result
+# in the queue ('fetched') until the writer stores it.
+#
+# All cars are written by one writer, the process that started the crawl, with the
+# CarWriter of run_search: batches in one transaction instead of every worker fighting
+# over the write lock. Workers only write their small job updates. When the workers are
+# done, the writer fetches the details that earlier runs failed to get (retry_failed_details),
+# and every run ends with finish_scraping_run like a run of run_search.
+#
+# A worker parses its pages inline on its event loop, so within a worker only the waits
+# for the server overlap. Parsing scales with the number of worker processes, as far as
+# there are free CPU cores, and the writer stores every car alone.
+#
+# Runs are always full sweeps. Incremental runs stop at the first known listings, which
+# needs the pages in order, and relisted cars are only matched by registration number.
+# A crawl that is stopped continues its runs when it is started again with the same searches.
+
+LEASE_SECONDS = 60
+MAX_JOB_ATTEMPTS = 3
+POLL_SECONDS = 0.2
+DB_TIMEOUT = 30  # Seconds a connection waits for the write lock
+
+# --- Job queue ---
+
+def connect(db_path):
+    # The database is in WAL mode (setup_database), reads don't wait for the writer
+    conn = sqlite3.connect(db_path, timeout=DB_TIMEOUT)
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def enqueue_jobs(c, scraping_run_id, jobs):
+    # jobs are (kind, url, page, payload). A job the run already has is not added again,
+    # e.g. a car listed on two pages.
+    c.executemany('''
+        INSERT OR IGNORE INTO crawl_jobs (scraping_run_id, kind, url, page, payload, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(scraping_run_id, kind, url, page, payload, datetime.now()) for kind, url, page, payload in jobs])
+
+def lease_jobs(conn, worker_id, count, lease_seconds=LEASE_SECONDS):
+    # Queued jobs and jobs whose lease expired, result pages first so the pagination
+    # keeps ahead of the detail pages. Returns (id, scraping_run_id, kind, url, page, payload).
+    now = datetime.now()
+    # Looked for first, an idle worker shouldn't take the write lock
+    available = conn.execute('''
+        SELECT 1 FROM crawl_jobs WHERE status = 'queued' OR (status = 'leased' AND lease_expires < ?) LIMIT 1
+    ''', (now,)).fetchone()
+    if not available:
+        return []
+    with conn:
+        conn.execute('''
+            UPDATE crawl_jobs SET status = 'failed', error = 'lease expired', finished_at = ?
+            WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?
+        ''', (now, now, MAX_JOB_ATTEMPTS))
+        return conn.execute('''
+            UPDATE crawl_jobs
+            SET status = 'leased', leased_by = ?, lease_expires = ?, heartbeat_at = ?, attempts = attempts + 1
+            WHERE id IN (SELECT id FROM crawl_jobs
+                         WHERE status = 'queued' OR (status = 'leased' AND lease_expires < ?)
+                         ORDER BY kind = 'detail', id LIMIT ?)
+            RETURNING id, scraping_run_id, kind, url, page, payload
+        ''', (worker_id, now + timedelta(seconds=lease_seconds), now, now, count)).fetchall()
+
+def renew_leases(conn, worker_id, lease_seconds=LEASE_SECONDS):
+    now = datetime.now()
+    with conn:
+        conn.execute('''
+            UPDATE crawl_jobs SET lease_expires = ?, heartbeat_at = ? WHERE status = 'leased' AND leased_by = ?
+        ''', (now + timedelta(seconds=lease_seconds), now, worker_id))
+
+def complete_job(conn, job_id, worker_id, scraping_run_id, result, new_jobs=()):
+    # The result and the jobs it adds are written together. A worker that lost its
+    # lease drops the result, the job was given to another worker.
+    with conn:
+        c = conn.cursor()
+        c.execute('''
+            UPDATE crawl_jobs SET status = 'fetched', result = ?, finished_at = ?, lease_expires = NULL
+            WHERE id = ? AND status = 'leased' AND leased_by = ?
+        ''', (json.dumps(result), datetime.now(), job_id, worker_id))
+        if c.rowcount == 0:
+            return False
+        enqueue_jobs(c, scraping_run_id, new_jobs)
+    return True
+
+def release_job(conn, job_id, worker_id, error=None):
+    # Back in the queue, or failed after MAX_JOB_ATTEMPTS. Without an error the worker
+    # is stopping and the attempt doesn't count.
+    with conn:
+        conn.execute('''
+            UPDATE crawl_jobs
+            SET status = CASE WHEN ? IS NOT NULL AND attempts >= ? THEN 'failed' ELSE 'queued' END,
+                attempts = attempts - (? IS NULL), error = COALESCE(?, error), leased_by = NULL,
+                lease_expires = NULL
+            WHERE id = ? AND status = 'leased' AND leased_by = ?
+        ''', (error, MAX_JOB_ATTEMPTS, error, error, job_id, worker_id))
+
+def queue_busy(conn):
+    # Jobs that are waiting or being worked on, and may still add jobs
+    return conn.execute("SELECT 1 FROM crawl_jobs WHERE status IN ('queued', 'leased') LIMIT 1").fetchone() is not None
+
+def run_has_jobs(conn, scraping_run_id):
+    return conn.execute('''
+        SELECT 1 FROM crawl_jobs WHERE scraping_run_id = ? AND status IN ('queued', 'leased', 'fetched') LIMIT 1
+    ''', (scraping_run_id,)).fetchone() is not None
+
+# --- Workers: fetch and parse ---
+
+def result_page_params(search, page):
+    # First page uses different param format, subsequent pages use paginated format
+    if page == 1:
+        return first_page_params(search['make'], search['model'], search.get('filters'))
+    return dict(paginated_params(search['make'], search['model'], search.get('filters')), Page=str(page))
+
+def listing_index(conn, indexes, make, model):
+    # Loaded once per make/model by each worker. Cars the writer stored since are not in it,
+    # a miss falls back to the database as in parse_cars.
+    if (make, model) not in indexes:
+        indexes[make, model] = ListingIndex.load(conn, make, model)
+    return indexes[make, model]
+
+async def handle_result_page(conn, job, session, headers, limiter, parser, indexes):
+    job_id, scraping_run_id, kind, base_url, page, payload = job
+    search = json.loads(payload)
+    html_content = await fetch_result_page(session, base_url, result_page_params(search, page), headers, page,
+                                           limiter)
+    page_listings = await read_result_page(html_content, parser, base_url) if html_content else None
+    html_content = None
+
+    index = listing_index(conn, indexes, search['make'], search['model'])
+    known, new_jobs = [], []
+    for car_data in page_listings or ():
+        if find_listing(conn, car_data, search['make'], search['model'], index) is not None:
+            known.append(car_data)
+        else:
+            new_jobs.append(('detail', car_data['url'], 0, json.dumps(car_data)))
+    if page_listings:
+        new_jobs.append(('result', base_url, page + 1, payload))
+    return {'cars': len(page_listings or ()), 'listings': known}, new_jobs
+
+async def handle_detail(job, session, headers, limiter, parser):
+    car_data = json.loads(job[5])
+    add_details(car_data, await fetch_car_details(session, job[3], headers, limiter, parser))
+    return car_data, ()
+
+def request_limiter(url, limiter):
+    # Without a rate only other sites (e.g. stand_in_server.py) go without delays,
+    # a request to bytbil.com waits for a human like delay as in main.py
+    if isinstance(limiter, NoDelay) and url.startswith(BASE_URL):
+        return None
+    return limiter
+
+async def run_worker(db_path, worker_id, rate=None, max_inflight=4, parser_backend=DEFAULT_BACKEND,
+                     lease_seconds=LEASE_SECONDS):
+    # Works on up to max_inflight jobs at a time until the queue is empty or it is stopped.
+    # Jobs are parsed inline, the workers are the parallelism.
+    conn = connect(db_path)
+    stop_flag = setup_stop_flag()
+    limiter = RateLimiter(rate) if rate else NoDelay()
+    parser = PageParser(parser_backend)
+    headers = request_headers()
+    running = {}  # task -> job
+    indexes = {}  # (make, model) -> ListingIndex
+    jobs_done = 0
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(lease_seconds / 4)
+            renew_leases(conn, worker_id, lease_seconds)
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    print(f"Worker {worker_id} started")
+    try:
+        async with create_session(max_inflight + 1) as session:
+            while not stop_flag.is_set():
+                if len(running) < max_inflight:
+                    for job in lease_jobs(conn, worker_id, max_inflight - len(running), lease_seconds):
+                        if job[2] == 'result':
+                            handler = handle_result_page(conn, job, session, headers,
+                                                         request_limiter(job[3], limiter), parser, indexes)
+                        else:
+                            handler = handle_detail(job, session, headers, request_limiter(job[3], limiter), parser)
+                        running[asyncio.create_task(handler)] = job
+                if not running:
+                    if not queue_busy(conn):
+                        break
+                    await asyncio.sleep(POLL_SECONDS)
+                    continue
+
+                finished, _ = await asyncio.wait(running, timeout=POLL_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    job = running.pop(task)
+                    try:
+                        result, new_jobs = task.result()
+                    except Exception as e:
+                        # FetchFailed of a result page, or a page the parser couldn't read
+                        print(f"Worker {worker_id}: {job[2]} job {job[0]} failed: {e}")
+                        release_job(conn, job[0], worker_id, str(e) or type(e).__name__)
+                        continue
+                    if complete_job(conn, job[0], worker_id, job[1], result, new_jobs):
+                        jobs_done += 1
+    finally:
+        heartbeat_task.cancel()
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        # Unfinished jobs go back to the queue right away instead of waiting for the lease
+        for job in running.values():
+            release_job(conn, job[0], worker_id)
+        parser.close()
+        conn.close()
+    print(f"Worker {worker_id} finished {jobs_done} jobs")
+    return jobs_done
+
+def worker_process(db_path, options):
+    # Entry point of the worker processes started by run_crawl
+    main.MAX_RETRIES = options['max_retries']
+    main.USER_AGENTS.extend(options['user_agents'])
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    asyncio.run(run_worker(db_path, worker_id, options['rate'], options['max_inflight'], options['parser'],
+                           options['lease_seconds']))
+
+# --- Writer: stores what the workers fetched ---
+
+def start_runs(conn, searches, base_url, batch_rows):
+    # A new run for every search, or its unfinished run if that still has jobs
+    runs = {}
+    for search in searches:
+        search_params = first_page_params(search['make'], search['model'], search.get('filters'))
+        row = conn.execute('''
+            SELECT runs.id FROM scraping_logs runs
+            WHERE runs.search_params = ? AND runs.status IN ('running', 'interrupted')
+              AND EXISTS (SELECT 1 FROM crawl_jobs jobs WHERE jobs.scraping_run_id = runs.id
+                          AND jobs.status IN ('queued', 'leased', 'fetched'))
+            ORDER BY runs.id DESC LIMIT 1
+        ''', (str(search_params),)).fetchone()
+        resumed = row is not None
+        if resumed:
+            scraping_run_id = row[0]
+            reopen_scraping_run(conn, scraping_run_id)
+            print(f"Continuing run {scraping_run_id} of {search['make']} {search['model']}")
+        else:
+            scraping_run_id = log_scraping_run(conn, search_params)
+            with conn:
+                enqueue_jobs(conn.cursor(), scraping_run_id, [('result', base_url, 1, json.dumps(search))])
+
+        run_started = conn.execute('SELECT timestamp FROM scraping_logs WHERE id = ?', (scraping_run_id,)).fetchone()[0]
+        metrics = new_run_metrics(scraping_run_id, search['make'], search['model'], conn if resumed else None)
+        index = ListingIndex.load(conn, search['make'], search['model'])
+        runs[scraping_run_id] = {
+            'search': search,
+            'run_started': datetime.fromisoformat(str(run_started)),
+            'previous_full': last_full_sweep(conn, search_params),
+            'metrics': metrics,
+            'writer': CarWriter(conn, scraping_run_id, batch_rows, index=index, metrics=metrics),
+            'counters': {'total': 0, 'new': 0, 'updated': 0},
+        }
+    return runs
+
+def store_fetched(conn, runs, batch_rows):
+    # Stores the results of up to batch_rows fetched jobs, oldest first. A crash before
+    # they are marked done stores them again, which only updates the same cars.
+    if not runs:
+        return 0
+    c = conn.cursor()
+    c.execute(f'''
+        SELECT id, scraping_run_id, kind, result FROM crawl_jobs
+        WHERE status = 'fetched' AND scraping_run_id IN ({', '.join('?' * len(runs))})
+        ORDER BY id LIMIT ?
+    ''', (*runs, batch_rows))
+    jobs = c.fetchall()
+
+    for job_id, scraping_run_id, kind, result in jobs:
+        run = runs[scraping_run_id]
+        result = json.loads(result)
+        cars = result['listings'] if kind == 'result' else [result]
+        for car_data in cars:
+            normalize_numbers(car_data, run['counters'])
+            run['writer'].add(car_data)
+            run['counters']['total'] += 1
+    for run in runs.values():
+        # As the writer found them, a detail job may be a car known by its registration number
+        run['writer'].flush()
+        run['counters']['new'] = run['writer'].inserted
+        run['counters']['updated'] = run['writer'].updated
+
+    with conn:
+        conn.executemany("UPDATE crawl_jobs SET status = 'done', result = NULL WHERE id = ?",
+                         [(job[0],) for job in jobs])
+    return len(jobs)
+
+def finish_run(conn, scraping_run_id, run):
+    # The run has no jobs left. It is complete unless a job failed: a failed result page
+    # hides the pages after it and a failed detail page a car.
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM crawl_jobs WHERE scraping_run_id = ? AND status = 'failed'", (scraping_run_id,))
+    failed = c.fetchone()[0]
+    # The last result page is the one without cars
+    c.execute('''
+        SELECT MAX(page) - 1 FROM crawl_jobs WHERE scraping_run_id = ? AND kind = 'result' AND status = 'done'
+    ''', (scraping_run_id,))
+    pages_fetched = c.fetchone()[0]
+    c.execute('SELECT COUNT(*) FROM cars WHERE scraping_run_id = ?', (scraping_run_id,))
+    total_cars = c.fetchone()[0]
+    with conn:
+        # Failed jobs are kept to see what went wrong
+        conn.execute("DELETE FROM crawl_jobs WHERE scraping_run_id = ? AND status = 'done'", (scraping_run_id,))
+
+    # The counters are this crawl's, a continued run's metrics hold the earlier part
+    search = run['search']
+    finish_scraping_run(conn, scraping_run_id, search['make'], search['model'], 'full', run['run_started'],
+                        failed == 0, search.get('filters'), run['previous_full'], total_cars, pages_fetched, None,
+                        run['counters'], {}, run['metrics'])
+    print(f"Total cars in run {scraping_run_id}: {total_cars}, {pages_fetched} result pages")
+    if failed:
+        print(f"{failed} jobs failed, the run is incomplete (see crawl_jobs)")
+
+def retry_details(conn, finished, base_url, rate, parser_backend):
+    # Fetches the details of cars that earlier runs stored without them, as run_search does.
+    # The writer does it once the workers are done, so the requests stay within rate.
+    async def retry():
+        stop_flag = setup_stop_flag()
+        limiter = request_limiter(base_url, RateLimiter(rate) if rate else NoDelay())
+        parser = PageParser(parser_backend)
+        headers = request_headers()
+        try:
+            async with create_session(2) as session:
+                for scraping_run_id, run in finished:
+                    if stop_flag.is_set():
+                        break
+                    await retry_failed_details(conn, session, headers, limiter, parser, run['metrics'],
+                                               run['search']['make'], run['search']['model'], scraping_run_id,
+                                               stop_flag)
+                    run['metrics'].save(conn)
+        finally:
+            parser.close()
+
+    asyncio.run(retry())
+
+def run_crawl(db_path, searches, workers=2, base_url=None, rate=DEFAULT_RATE, max_inflight=4, batch_rows=100,
+              parser=DEFAULT_BACKEND, lease_seconds=LEASE_SECONDS, max_retries=MAX_RETRIES):
+    # Starts the worker processes and stores their results until every run is finished.
+    # rate is shared by the workers on this box, workers=0 leaves the jobs to workers
+    # started elsewhere with --worker. Every box has a rate of its own, the site gets the sum.
+    conn = setup_database(db_path)
+    base_url = base_url or f"{BASE_URL}/bil"
+    runs = start_runs(conn, searches, base_url, batch_rows)
+
+    # The user agents are sampled once here, fake_useragent takes most of a second to load
+    random_user_agent()
+    options = {'rate': rate / workers if rate and workers else None, 'max_inflight': max_inflight,
+               'parser': parser, 'lease_seconds': lease_seconds, 'max_retries': max_retries,
+               'user_agents': main.USER_AGENTS}
+    # Spawned, a forked worker would share this process's database connection
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=worker_process, args=(db_path, options)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    finished = []
+    try:
+        while runs:
+            stored = store_fetched(conn, runs, batch_rows)
+            for scraping_run_id in [run_id for run_id in runs if not run_has_jobs(conn, run_id)]:
+                run = runs.pop(scraping_run_id)
+                finish_run(conn, scraping_run_id, run)
+                finished.append((scraping_run_id, run))
+            if stored:
+                continue
+            if processes and not any(process.is_alive() for process in processes):
+                print("Every worker has stopped, the unfinished runs continue when the crawl is started again")
+                break
+            time.sleep(POLL_SECONDS)
+    except KeyboardInterrupt:
+        # Ctrl-C reaches the workers too, they put their jobs back in the queue
+        print("\nStopping the crawl, the unfinished runs continue when it is started again")
+        finished = []
+    finally:
+        # A second Ctrl-C must not leave the workers' results behind
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for process in processes:
+            process.join()
+        store_fetched(conn, runs, batch_rows * 100)
+        with conn:
+            conn.executemany("UPDATE scraping_logs SET status = 'interrupted' WHERE id = ?",
+                             [(run_id,) for run_id in runs])
+        if finished:
+            retry_details(conn, finished, base_url, rate, parser)
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scrape bytbil.com with several worker processes sharing a job queue')
+    parser.add_argument('--db', type=str, default='cars.db', help='Database with the job queue (default cars.db)')
+    parser.add_argument('--make', type=str, help='Car manufacturer')
+    parser.add_argument('--model', type=str, help='Car model')
+    parser.add_argument('--searches', type=str,
+                        help='JSON or TOML file with the searches to run (make, model and optional filters)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Worker processes on this box (default: one per CPU)')
+    parser.add_argument('--worker', action='store_true',
+                        help="Only work on the queue, e.g. on another box, the crawl's writer stores the results. "
+                             "--rate is this box's own, on top of the other boxes'")
+    parser.add_argument('--max-inflight', type=int, default=4, help='Jobs a worker works on at a time (default 4)')
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                        help=f'Requests per minute of all the workers on this box (default {DEFAULT_RATE}). Every box '
+                             'started with --worker has a rate of its own, the site gets the sum. 0 for no delays, '
+                             'only with --base-url')
+    parser.add_argument('--batch-rows', type=int, default=100, help='Jobs stored per transaction (default 100)')
+    parser.add_argument('--parser', choices=BACKENDS, default=DEFAULT_BACKEND, help='HTML parser backend')
+    parser.add_argument('--lease-seconds', type=int, default=LEASE_SECONDS,
+                        help=f'A job of a worker that stops renewing it is given to another after this (default {LEASE_SECONDS})')
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES, help='Retries of a failed request')
+    parser.add_argument('--base-url', type=str,
+                        help=f'Search page to scrape (default {BASE_URL}/bil, e.g. http://127.0.0.1:8081/bil for stand_in_server.py)')
+    parser.add_argument('--no-metrics', action='store_true', help='Do not store metrics of the runs')
+    args = parser.parse_args()
+    if not args.rate and not args.base_url:
+        parser.error('--rate 0 only goes without delays against --base-url, bytbil.com needs a rate')
+    if args.no_metrics:
+        disable_metrics()
+
+    start_time = time.time()
+    if args.worker:
+        main.MAX_RETRIES = args.retries
+        asyncio.run(run_worker(args.db, f"{socket.gethostname()}:{os.getpid()}", args.rate or None,
+                               args.max_inflight, args.parser, args.lease_seconds))
+    else:
+        if args.make and args.model:
+            searches = [{'make': args.make, 'model': args.model}]
+        elif args.searches:
+            searches = load_searches(args.searches)
+        else:
+            parser.error('give --make and --model or --searches')
+        run_crawl(args.db, searches, args.workers, args.base_url, args.rate, args.max_inflight, args.batch_rows,
+                  args.parser, args.lease_seconds, args.retries)
+    print(f"Done in {time.time() - start_time:.1f} s")
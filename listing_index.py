@@ -0,0 +1,203 @@
+import hashlib
+import sys
+from array import array
+from bisect import bisect_left
+
+# Compact in-memory index of the cars of the make/model being scraped, loaded once
+# at the start of a run so the per-car exists check, change detection and price
+# history decision don't need a round trip to the database.
+#
+# Urls and registration numbers are stored as 64 bit hashes in sorted arrays,
+# which keeps a 500k car make at roughly 24 bytes per car. Cars added during the
+# run go into small dicts. A miss is not authoritative, callers fall back to the
+# database, so cars of other makes and relisted cars are still found.
+
+PRICE_UNKNOWN = -1
+
+def key_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+def price_to_int(price):
+    # Prices are integers in the database, a missing price can't be compared
+    return price if isinstance(price, int) else PRICE_UNKNOWN
+
+def is_registration_number(registration_number):
+    return registration_number is not None and registration_number not in ('N/A', '-')
+
+def sorted_hash_array(pairs):
+    pairs.sort()
+    return array('q', (h for h, _ in pairs)), array('q', (car_id for _, car_id in pairs))
+
+class ListingIndex:
+    def __init__(self, rows=()):
+        url_pairs = []
+        regnr_pairs = []
+        self.car_ids = array('q')
+        self.prices = array('q')
+        self.new_urls = {}
+        self.new_regnrs = {}
+        
+        for car_id, url, registration_number, price in rows:
+            if url:
+                url_pairs.append((key_hash(url), car_id))
+            if is_registration_number(registration_number):
+                regnr_pairs.append((key_hash(registration_number), car_id))
+            self.car_ids.append(car_id)
+            self.prices.append(price_to_int(price))
+        
+        self.url_hashes, self.url_ids = sorted_hash_array(url_pairs)
+        self.regnr_hashes, self.regnr_ids = sorted_hash_array(regnr_pairs)
+
+    @classmethod
+    def load(cls, conn, make, model):
+        rows = conn.execute('''
+            SELECT id, url, registration_number, price FROM cars
+            WHERE make = ? AND model = ?
+            ORDER BY id
+        ''', (make, model))
+        return cls(rows)
+
+    def __len__(self):
+        return len(self.car_ids)
+
+    def memory_bytes(self):
+        arrays = (self.url_hashes, self.url_ids, self.regnr_hashes, self.regnr_ids, self.car_ids, self.prices)
+        return (sum(a.buffer_info()[1] * a.itemsize for a in arrays) +
+                sys.getsizeof(self.new_urls) + sys.getsizeof(self.new_regnrs))
+
+    def _lookup(self, hashes, ids, new_keys, key):
+        h = key_hash(key)
+        if h in new_keys:
+            return new_keys[h]
+        i = bisect_left(hashes, h)
+        if i < len(hashes) and hashes[i] == h:
+            return ids[i]
+        return None
+
+    def id_for_url(self, url):
+        return self._lookup(self.url_hashes, self.url_ids, self.new_urls, url)
+
+    def id_for_registration_number(self, registration_number):
+        if not is_registration_number(registration_number):
+            return None
+        return self._lookup(self.regnr_hashes, self.regnr_ids, self.new_regnrs, registration_number)
+
+    def price(self, car_id):
+        i = bisect_left(self.car_ids, car_id)
+        if i < len(self.car_ids) and self.car_ids[i] == car_id:
+            return self.prices[i]
+        return PRICE_UNKNOWN
+
+    def find(self, car_data):
+        # Same order as the database lookup: registration number first, then url.
+        # Returns (id, price) like the SELECT, or None if the index can't answer.
+        car_id = self.id_for_registration_number(car_data.get('registration_number'))
+        if car_id is None:
+            car_id = self.id_for_url(car_data['url'])
+        if car_id is None:
+            return None
+        price = self.price(car_id)
+        if price == PRICE_UNKNOWN:
+            return None
+        return car_id, price
+
+    def set_price(self, car_id, price):
+        i = bisect_left(self.car_ids, car_id)
+        if i < len(self.car_ids) and self.car_ids[i] == car_id:
+            self.prices[i] = price_to_int(price)
+
+    def add(self, car_id, url, registration_number, price):
+        # New cars get higher ids than everything loaded, so the id array stays sorted
+        if url:
+            self.new_urls[key_hash(url)] = car_id
+        if is_registration_number(registration_number):
+            self.new_regnrs[key_hash(registration_number)] = car_id
+        if self.car_ids and car_id <= self.car_ids[-1]:
+            self.set_price(car_id, price)
+        else:
+            self.car_ids.append(car_id)
+            self.prices.append(price_to_int(price))
+
+# --- Relisting candidates ---
+
+# Dealers relist cars under a new url. A listing with an unknown url is matched
+# against the cars of the make/model that were seen in the last RELIST_WINDOW_DAYS
+# but not yet in this run, before its detail page is fetched. The fingerprint is
+# the normalized title, year and location, and candidates with the same fingerprint
+# are scored on mileage and price band:
+#   mileage  same -> 1, down to 0 at MILEAGE_TOLERANCE mil more. Less mileage -> 0,
+#            an odometer doesn't go back. Unknown on either side -> 0.5.
+#   price    within PRICE_BAND of the old price -> 1, down to 0 at PRICE_TOLERANCE,
+#            relisted cars often come back a little cheaper
+# confidence = 0.6 * mileage + 0.4 * price, divided by the number of candidates that
+# score at least 0.5, since two lookalike cars can't be told apart from the listing.
+# A match is only held until the end of a full sweep: if the run saw the candidate
+# under any url, or another listing matched it too, it is a different car after all.
+
+RELIST_WINDOW_DAYS = 30
+MILEAGE_TOLERANCE = 500
+PRICE_BAND = 0.02
+PRICE_TOLERANCE = 0.20
+
+def fingerprint(title, year, location):
+    text = '|'.join(' '.join(str(value).lower().split()) for value in (title, year, location))
+    return key_hash(text)
+
+def closeness(new, old, band, tolerance):
+    return max(0.0, min(1.0, 1 - (new - old - band) / (tolerance - band)))
+
+def mileage_score(new, old):
+    if not isinstance(new, int) or not isinstance(old, int):
+        return 0.5
+    if new < old:
+        return 0.0
+    return closeness(new, old, 0, MILEAGE_TOLERANCE)
+
+def price_score(new, old):
+    if not isinstance(new, int) or not isinstance(old, int) or old <= 0:
+        return 0.5
+    return closeness(abs(new - old) / old, 0, PRICE_BAND, PRICE_TOLERANCE)
+
+class RelistIndex:
+    def __init__(self, rows=()):
+        self.candidates = {}  # fingerprint -> [(car_id, mileage, price)]
+        for car_id, title, year, mileage, location, price in rows:
+            self.candidates.setdefault(fingerprint(title, year, location), []).append((car_id, mileage, price))
+        self.seen_ids = set()
+        self.held = []
+
+    @classmethod
+    def load(cls, conn, make, model, run_started, window_days=RELIST_WINDOW_DAYS):
+        # Cars this run has not updated yet, a resumed run has updated some of them
+        rows = conn.execute('''
+            SELECT id, title, year, mileage, location, price FROM cars
+            WHERE make = ? AND model = ? AND last_seen >= datetime(?, ?) AND last_seen < ?
+        ''', (make, model, run_started, f'-{window_days} days', run_started))
+        return cls(rows)
+
+    def __len__(self):
+        return sum(len(cars) for cars in self.candidates.values())
+
+    def seen(self, car_id):
+        # The car is listed under its own url, it isn't the old listing of another one
+        self.seen_ids.add(car_id)
+
+    def hold(self, car_data):
+        self.held.append(car_data)
+
+    def take_held(self):
+        held, self.held = self.held, []
+        return held
+
+    def match(self, car_data):
+        # (car_id, confidence) of the best candidate, or None
+        scored = [(0.6 * mileage_score(car_data['mileage'], mileage) + 0.4 * price_score(car_data['price'], price),
+                   car_id)
+                  for car_id, mileage, price in self.candidates.get(
+                      fingerprint(car_data['title'], car_data['year'], car_data['location']), ())
+                  if car_id not in self.seen_ids]
+        plausible = [item for item in scored if item[0] >= 0.5]
+        if not plausible:
+            return None
+        score, car_id = max(plausible)
+        return car_id, score / len(plausible)
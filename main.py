@@ -1,28 +1,35 @@
 import requests
-from bs4 import BeautifulSoup
-import re
 import time
 import random
 import asyncio
 import aiohttp
 from fake_useragent import UserAgent
 import sqlite3
-from datetime import datetime
-from urllib.parse import urljoin
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import argparse
 import signal
+import json
+import tomllib
+import contextlib
+from collections import Counter, OrderedDict, deque
+from migrate_database import migrate
+from listing_index import ListingIndex, RelistIndex, price_to_int
+from archive import ResponseArchive, ReplaySession
+from market_summary import update_market_summary
+from price_intervals import CLOSE_PRICE_INTERVAL_SQL, OPEN_PRICE_INTERVAL_SQL, open_new_car_intervals
+from metrics import NoMetrics, new_run_metrics, disable_metrics, serve_metrics
+from memory_profile import MemoryProfiler, NoProfiler, peak_rss_mb
+from parsers import BACKENDS, DEFAULT_BACKEND, PARSE_MODES, DEFAULT_PARSE_MODE, BASE_URL, PageParser, clean_text
 
 # This program fetches data from bytbil.com and stores the information in a sqlite db.
 # Written by Niklas Förstberg, 2025 
-#
-# Todo: Check memory useage och se om man kan optimera det.
-# Todo: Add functionality to scrape for several different makes in the same run
 
 # Use this query to find price history for a car
 # SELECT ph.price, ph.timestamp 
 # FROM price_history ph 
 # JOIN cars c ON ph.car_id = c.id 
-# WHERE c.registration_number = ?
+# WHERE c.registration_number = ? AND c.registration_number NOT IN ('N/A', '-')
 # ORDER BY ph.timestamp DESC
 
 async def human_like_delay():
@@ -34,14 +41,275 @@ async def human_like_delay():
     print(f"Sleeping for {delay} seconds")
     await asyncio.sleep(delay)
 
-def clean_text(text):
-    # Remove HTML entities and all whitespace including non-breaking spaces
-    return re.sub(r'(?:&#xA0;|\xa0|\s+)', '', text).strip()
+# Average request rate of human_like_delay, used when running several requests in parallel
+DEFAULT_RATE = 14
 
-def setup_database():
-    conn = sqlite3.connect('cars.db')
-    c = conn.cursor()
+class RateLimiter:
+    # Token bucket shared by every request towards bytbil.com, so the average
+    # request rate stays polite no matter how many requests are in flight.
+    # Requests are granted round robin between owners (one per search), so
+    # concurrent searches get a fair share of the budget.
+    def __init__(self, rate_per_minute, burst=1, jitter=0.5, max_slowdown=8):
+        self.interval = 60.0 / rate_per_minute
+        self.base_interval = self.interval
+        self.max_slowdown = max_slowdown
+        self.paused_until = 0.0
+        self.burst = burst
+        self.jitter = jitter
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.waiting = OrderedDict()  # owner -> queue of waiting requests
+        self.dispatcher = None
+
+    def for_owner(self, owner):
+        return OwnedRateLimiter(self, owner)
+
+    async def acquire(self, owner=None):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(owner, deque()).append(future)
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self._dispatch())
+        await future
+        
+        # Add some noise after the grant so requests don't arrive like clockwork
+        # without lowering the average rate
+        await asyncio.sleep(random.uniform(0, self.jitter * self.interval))
+
+    def pushed_back(self, retry_after=None):
+        # The server answered 429 or 503: halve the rate (down to 1/max_slowdown of the
+        # configured one) and hold every request until Retry-After has passed
+        self.interval = min(self.interval * 2, self.base_interval * self.max_slowdown)
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        print(f"Server pushed back, slowing down to {60 / self.interval:.1f} requests per minute")
+
+    def succeeded(self):
+        # Win the rate back gradually, 5% of the configured rate per successful request
+        if self.interval > self.base_interval:
+            self.interval = max(self.base_interval, 1 / (1 / self.interval + 0.05 / self.base_interval))
+
+    async def _dispatch(self):
+        while self.waiting:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+            self.updated = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) * self.interval)
+                continue
+            
+            # Serve the owner that has waited longest, then move it to the back
+            owner, queue = next(iter(self.waiting.items()))
+            future = queue.popleft()
+            if queue:
+                self.waiting.move_to_end(owner)
+            else:
+                del self.waiting[owner]
+            if not future.done():  # Cancelled requests don't use a token
+                self.tokens -= 1
+                future.set_result(None)
+
+class OwnedRateLimiter:
+    # A search's handle on the shared RateLimiter
+    def __init__(self, limiter, owner):
+        self.limiter = limiter
+        self.owner = owner
+
+    @property
+    def interval(self):
+        return self.limiter.interval
+
+    async def acquire(self):
+        await self.limiter.acquire(self.owner)
+
+    def pushed_back(self, retry_after=None):
+        self.limiter.pushed_back(retry_after)
+
+    def succeeded(self):
+        self.limiter.succeeded()
+
+class NoDelay:
+    # Stands in for the rate limiter when no request goes to bytbil.com, e.g. in replay mode
+    interval = 0
+
+    def for_owner(self, owner):
+        return self
+
+    async def acquire(self):
+        pass
+
+    def pushed_back(self, retry_after=None):
+        pass
+
+    def succeeded(self):
+        pass
+
+class MemoryBudget:
+    # Caps the detail pages held in memory at once, fetched and not yet parsed, across
+    # all searches. A page reserves the size of the largest page read so far before it
+    # is requested and gives it back once it is parsed. A page always gets through
+    # when nothing else is reserved, so a budget below one page still makes progress.
+    def __init__(self, max_bytes, page_bytes=256 * 1024):
+        self.max_bytes = max_bytes
+        self.page_bytes = page_bytes
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+    def page_read(self, size):
+        self.page_bytes = max(self.page_bytes, size)
+
+    @contextlib.asynccontextmanager
+    async def reserve(self):
+        size = self.page_bytes
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.used == 0 or self.used + size <= self.max_bytes)
+            self.used += size
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.used -= size
+                self.condition.notify_all()
+
+class NoBudget:
+    # Stands in for MemoryBudget when there is no budget
+    def page_read(self, size):
+        pass
+
+    @contextlib.asynccontextmanager
+    async def reserve(self):
+        yield
+
+async def polite_delay(limiter=None, metrics=None):
+    # Without a shared rate limiter every request waits for a human like delay
+    metrics = metrics or NoMetrics()
+    with metrics.timer('delay_seconds'):
+        if limiter is None:
+            await human_like_delay()
+        else:
+            await limiter.acquire()
+
+# --- HTTP: one connection pool, retries with backoff ---
+
+# Responses worth another try, 429 and 503 may say how long to wait in Retry-After
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+BACKOFF_BASE = 2.0  # Seconds, doubled for every retry
+BACKOFF_MAX = 120.0
+
+# Bodies are read in chunks and a page above this size is dropped as soon as it gets
+# there, instead of buffering whatever the server sends. A page below it is still
+# held whole before it is parsed.
+MAX_PAGE_BYTES = 5 * 1024 * 1024
+READ_CHUNK_BYTES = 64 * 1024
+
+class FetchFailed(Exception):
+    # Every attempt at a page failed, as opposed to the page not being there (None)
+    pass
+
+class PageTooLarge(aiohttp.ClientPayloadError):
+    pass
+
+class CappedResponse(aiohttp.ClientResponse):
+    # response.text() reads the body through read(), which stops at MAX_PAGE_BYTES
+    async def read(self):
+        if self._body is None:
+            if self.content_length is not None and self.content_length > MAX_PAGE_BYTES:
+                self.close()
+                raise PageTooLarge(f"{self.content_length // 1024} KB page, the limit is {MAX_PAGE_BYTES // 1024} KB")
+            chunks = []
+            size = 0
+            try:
+                async for chunk in self.content.iter_chunked(READ_CHUNK_BYTES):
+                    size += len(chunk)
+                    if size > MAX_PAGE_BYTES:
+                        raise PageTooLarge(f"page above the limit of {MAX_PAGE_BYTES // 1024} KB")
+                    chunks.append(chunk)
+            except BaseException:
+                self.close()
+                raise
+            self._body = b''.join(chunks)
+        return await super().read()
+
+def create_session(max_connections=10):
+    # Requests are seconds apart with the polite delays, so idle connections are kept
+    # for longer than aiohttp's default 15 s and reused instead of reconnecting
+    connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_connections,
+                                     keepalive_timeout=60, ttl_dns_cache=300)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60, connect=15),
+                                 response_class=CappedResponse)
+
+def retry_after_seconds(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_seconds(retry, retry_after=None):
+    # Full jitter up to the exponential bound, but at least as long as the server asked for
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** retry))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, BACKOFF_MAX))
+    return delay
+
+async def fetch_page(session, url, headers, limiter=None, metrics=None, page='detail', params=None, delay=True):
+    # GET with up to MAX_RETRIES retries on connection errors and RETRY_STATUSES.
+    # Returns the html, None when the page isn't there (e.g. 404) and raises
+    # FetchFailed when every attempt failed.
+    metrics = metrics or NoMetrics()
+    reason = None
+    retry_after = None
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            wait = backoff_seconds(attempt - 1, retry_after)
+            print(f"Retrying {page} page in {wait:.1f} seconds ({reason})")
+            metrics.count('retries_total', page=page)
+            with metrics.timer('backoff_seconds'):
+                await asyncio.sleep(wait)
+        if delay or attempt:
+            await polite_delay(limiter, metrics)
+        
+        metrics.count('http_requests_total', page=page)
+        start = time.perf_counter()
+        retry_after = None
+        try:
+            async with session.get(url, params=params, headers=headers) as response:
+                metrics.count('http_responses_total', status=response.status)
+                if response.status == 200:
+                    html_content = await response.text()
+                    metrics.observe('fetch_seconds', time.perf_counter() - start, page=page)
+                    if limiter:
+                        limiter.succeeded()
+                    return html_content
+                
+                reason = f"status {response.status}"
+                if response.status not in RETRY_STATUSES:
+                    print(f"Error fetching {page} page: {response.status}")
+                    return None
+                if response.status in (429, 503):
+                    retry_after = retry_after_seconds(response.headers.get('Retry-After'))
+                    if limiter:
+                        limiter.pushed_back(retry_after)
+        except PageTooLarge as e:
+            print(f"Error fetching {page} page: {e}")
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.count('http_errors_total', page=page)
+            reason = str(e) or type(e).__name__
     
+    print(f"Error fetching {page} page: giving up after {MAX_RETRIES + 1} attempts ({reason})")
+    raise FetchFailed(reason)
+
+def create_tables(c):
     # Create cars table
     c.execute('''
         CREATE TABLE IF NOT EXISTS cars (
@@ -50,9 +318,9 @@ def setup_database():
             make TEXT,
             model TEXT,
             year INTEGER,
-            mileage TEXT,
+            mileage INTEGER,
             location TEXT,
-            price TEXT,
+            price INTEGER,
             registration_number TEXT,
             color TEXT,
             drive_type TEXT,
@@ -80,76 +348,196 @@ def setup_database():
         CREATE TABLE IF NOT EXISTS price_history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             car_id INTEGER,
-            price TEXT,
+            price INTEGER,
             timestamp DATETIME,
             FOREIGN KEY (car_id) REFERENCES cars(id)
         )
     ''')
+
+def setup_database(db_path='cars.db', factory=sqlite3.Connection):
+    conn = sqlite3.connect(db_path, factory=factory)
+    c = conn.cursor()
+    create_tables(c)
+    
+    # WAL makes each commit a cheap append instead of a full journal sync
+    c.execute('PRAGMA journal_mode=WAL')
+    c.execute('PRAGMA synchronous=NORMAL')
+    c.execute('PRAGMA cache_size=-20000')  # 20 MB
     
     conn.commit()
+    
+    # Bring older databases up to the current schema (indexes etc.)
+    migrate(conn)
     return conn
 
-async def fetch_car_details(session, url, headers):
-    await human_like_delay()
-    
+async def fetch_car_details(session, url, headers, limiter=None, parser=None, metrics=None, budget=None):
+    # None when the page could not be fetched or read, the car then goes to the retry queue.
+    # A page that isn't there any more has no details to retry: {}.
+    parser = parser or PageParser()
+    metrics = metrics or NoMetrics()
+    budget = budget or NoBudget()
+    async with budget.reserve():
+        try:
+            html_content = await fetch_page(session, url, headers, limiter, metrics, 'detail')
+        except FetchFailed:
+            return None
+        if html_content is None:
+            return {}
+        budget.page_read(len(html_content))
+        
+        try:
+            # Registration number, color, drive type, gearbox and bodytype
+            with metrics.timer('parse_seconds', page='detail'):
+                return await parser.car_details(html_content)
+        except Exception as e:
+            print(f"Error reading car details: {e}")
+            return None
+
+async def fetch_car_details_bounded(semaphore, session, url, headers, limiter, parser, metrics=None, budget=None):
+    # Caps the number of detail requests in flight at the same time
+    async with semaphore:
+        return await fetch_car_details(session, url, headers, limiter, parser, metrics, budget)
+
+async def wait_unless_stopped(task, stop_flag):
+    # Wait for a detail fetch, but give up as soon as the run is being stopped
+    stop_waiter = asyncio.create_task(stop_flag.wait())
     try:
-        async with session.get(url, headers=headers) as response:
-            if response.status != 200:
-                print(f"Error fetching car details: {response.status}")
-                return None
-            
-            html_content = await response.text()
-            soup = BeautifulSoup(html_content, 'html.parser')
-            
-            more_car_data = {}
-            
-            # Find registration number
-            reg_elem = soup.find('dt', string='Regnr')
-            if reg_elem and reg_elem.find_next_sibling('dd'):
-                more_car_data['registration_number'] = reg_elem.find_next_sibling('dd').text.strip()
-            
-            # Find color
-            color_elem = soup.find('dt', string='Färg')
-            if color_elem and color_elem.find_next_sibling('dd'):
-                more_car_data['color'] = color_elem.find_next_sibling('dd').text.strip()
-            
-            # Find drive type
-            drive_elem = soup.find('dt', string='Drivhjul')
-            if drive_elem and drive_elem.find_next_sibling('dd'):
-                more_car_data['drive_type'] = drive_elem.find_next_sibling('dd').text.strip()
-            
-            # Find gearbox
-            gearbox_elem = soup.find('dt', string='Växellåda')
-            if gearbox_elem and gearbox_elem.find_next_sibling('dd'):
-                more_car_data['gearbox'] = gearbox_elem.find_next_sibling('dd').text.strip()
-            
-            # Find bodytype
-            bodytype_elem = soup.find('dt', string='Karosseri')
-            if bodytype_elem and bodytype_elem.find_next_sibling('dd'):
-                more_car_data['bodytype'] = bodytype_elem.find_next_sibling('dd').text.strip()
-            
-            return more_car_data
-            
-    except Exception as e:
-        print(f"Error fetching car details: {e}")
-        return None
+        await asyncio.wait({task, stop_waiter}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stop_waiter.cancel()
+    if task.done() and not task.cancelled():
+        return task.result()
+    return None
 
-def store_car(conn, car_data, c, scraping_run_id):
+def to_integer(text):
+    # '15 072', '89 900kr' -> 15072, 89900. None if the text is not a number.
+    cleaned = clean_text(text).replace('kr', '').replace('mil', '')
+    return int(cleaned) if cleaned.isascii() and cleaned.isdigit() else None
+
+def normalize_numbers(car_data, counters):
+    # Price, mileage and year are stored as integers. Values that are there but can't
+    # be read are counted and kept in car_data['rejects'], the car is stored with them
+    # logged in ingest_rejects. Missing values ('N/A') are not.
+    for field in ('price', 'mileage', 'year'):
+        raw_value = car_data[field]
+        car_data[field] = to_integer(raw_value)
+        if car_data[field] is None and raw_value not in ('N/A', ''):
+            counters['unparseable'] = counters.get('unparseable', 0) + 1
+            print(f" -- Could not read {field} '{raw_value}' for {car_data['url']}")
+            car_data.setdefault('rejects', []).append((field, raw_value))
 
+def reject_values(car_data, scraping_run_id, now):
+    return [(scraping_run_id, car_data['url'], field, raw_value, now) for field, raw_value in car_data.get('rejects', ())]
+
+def has_registration_number(car_data):
+    return (car_data.get('registration_number') is not None and 
+            car_data.get('registration_number') != 'N/A' and 
+            car_data.get('registration_number') != '-')
+
+def find_existing_car(c, car_data, index=None):
+    # The in-memory index answers for the cars of the make/model being scraped
+    if index:
+        result = index.find(car_data)
+        if result:
+            return result
+    
     # Check if car already exists, first by car registration number
     # We already checked this in parse_cars, but a car might have been relisted with a new URL
-    if (car_data.get('registration_number') is not None and 
-        car_data.get('registration_number') != 'N/A' and 
-        car_data.get('registration_number') != '-'):
-        
-        c.execute('SELECT id, price FROM cars WHERE registration_number = ?', 
-                 (car_data['registration_number'],))
-        result = c.fetchone()
-    else:
-        #check by url if no car reg
-        c.execute('SELECT id, price FROM cars WHERE url = ?', 
-                 (car_data['url'],))
+    if has_registration_number(car_data):
+        # The NOT IN term lets SQLite use the partial index on real registration numbers
+        c.execute('''
+            SELECT id, price FROM cars
+            WHERE registration_number = ? AND registration_number NOT IN ('N/A', '-')
+        ''', (car_data['registration_number'],))
         result = c.fetchone()
+        if result:
+            return result
+    
+    #check by url if no car reg, or no car with that reg (url is unique)
+    c.execute('SELECT id, price FROM cars WHERE url = ?', 
+             (car_data['url'],))
+    return c.fetchone()
+
+# Update only the fields we have
+UPDATE_CAR_SQL = '''
+    UPDATE cars SET title=?, make=?, model=?, year=?, mileage=?, location=?, price=?,
+                    last_seen=?, scraping_run_id=?
+    WHERE id=?
+'''
+
+INSERT_CAR_SQL = '''
+    INSERT INTO cars (
+        title, make, model, year, mileage, location, price, url, 
+        registration_number, color, drive_type, gearbox, bodytype,
+        first_seen, last_seen, scraping_run_id
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+INSERT_PRICE_HISTORY_SQL = '''
+    INSERT INTO price_history (car_id, price, timestamp)
+    VALUES (?, ?, ?)
+'''
+
+# The previous url is read before the car gets the new one
+RECORD_RELISTING_SQL = '''
+    INSERT OR REPLACE INTO car_relistings (url, car_id, previous_url, matched_by, confidence, scraping_run_id, linked_at)
+    SELECT ?, id, url, ?, ?, ?, ? FROM cars WHERE id = ? AND url != ?
+'''
+
+LINK_URL_SQL = '''
+    UPDATE cars SET url = ? WHERE id = ? AND NOT EXISTS (SELECT 1 FROM cars WHERE url = ?)
+'''
+
+INSERT_REJECT_SQL = '''
+    INSERT INTO ingest_rejects (table_name, scraping_run_id, url, field, raw_value, timestamp)
+    VALUES ('cars', ?, ?, ?, ?, ?)
+'''
+
+QUEUE_DETAIL_RETRY_SQL = '''
+    INSERT INTO detail_retry_queue (url, make, model, attempts, first_failed, last_attempt, scraping_run_id)
+    VALUES (?, ?, ?, 1, ?, ?, ?)
+    ON CONFLICT (url) DO UPDATE SET
+        attempts = attempts + 1, last_attempt = excluded.last_attempt, scraping_run_id = excluded.scraping_run_id
+'''
+
+def car_update_values(car_data, car_id, scraping_run_id, now):
+    return (
+        car_data['title'],
+        car_data['make'],
+        car_data['model'],
+        car_data['year'],
+        car_data['mileage'],
+        car_data['location'],
+        car_data['price'],
+        now,
+        scraping_run_id,
+        car_id
+    )
+
+def car_insert_values(car_data, scraping_run_id, now):
+    return (
+        car_data['title'],
+        car_data['make'],
+        car_data['model'],
+        car_data['year'],
+        car_data['mileage'],
+        car_data['location'],
+        car_data['price'],
+        car_data['url'],
+        car_data.get('registration_number'),
+        car_data.get('color'),
+        car_data.get('drive_type'),
+        car_data.get('gearbox'),
+        car_data.get('bodytype'),
+        now,
+        now,
+        scraping_run_id
+    )
+
+def store_car(conn, car_data, c, scraping_run_id):
+    result = find_existing_car(c, car_data)
+    now = datetime.now()
     
     if result:
         #Car found, update it
@@ -158,183 +546,542 @@ def store_car(conn, car_data, c, scraping_run_id):
         
         # Only store price history if price has changed
         if current_price != new_price:
-            c.execute('''
-                INSERT INTO price_history (car_id, price, timestamp)
-                VALUES (?, ?, ?)
-            ''', (car_id, current_price, datetime.now()))
+            c.execute(INSERT_PRICE_HISTORY_SQL, (car_id, current_price, now))
+            c.execute(CLOSE_PRICE_INTERVAL_SQL, (now, car_id))
             print(f" -- Price change detected for car {car_data.get('registration_number')}: {current_price} -> {new_price}")
         
-        # Update only the fields we have
-        update_fields = {
-            'title': car_data['title'],
-            'make': car_data['make'],
-            'model': car_data['model'],
-            'year': car_data['year'],
-            'mileage': car_data['mileage'],
-            'location': car_data['location'],
-            'price': car_data['price'],
-            'last_seen': datetime.now(),
-            'scraping_run_id': scraping_run_id
-        }
-        
-        # Build dynamic update query
-        fields = ', '.join(f"{key}=?" for key in update_fields.keys())
-        query = f'UPDATE cars SET {fields} WHERE id=?'
-        
-        # Execute update with values
-        values = list(update_fields.values()) + [car_id]
-        c.execute(query, values)
+        c.execute(UPDATE_CAR_SQL, car_update_values(car_data, car_id, scraping_run_id, now))
+        c.execute(OPEN_PRICE_INTERVAL_SQL, (new_price, now, car_id))
     else:
         # Insert new car
-        now = datetime.now()
-        c.execute('''
-            INSERT INTO cars (
-                title, make, model, year, mileage, location, price, url, 
-                registration_number, color, drive_type, gearbox, bodytype,
-                first_seen, last_seen, scraping_run_id
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            car_data['title'],
-            car_data['make'],
-            car_data['model'],
-            car_data['year'],
-            car_data['mileage'],
-            car_data['location'],
-            car_data['price'],
-            car_data['url'],
-            car_data.get('registration_number'),
-            car_data.get('color'),
-            car_data.get('drive_type'),
-            car_data.get('gearbox'),
-            car_data.get('bodytype'),
-            now,
-            now,
-            scraping_run_id
-        ))
+        c.execute(INSERT_CAR_SQL, car_insert_values(car_data, scraping_run_id, now))
+        c.execute(OPEN_PRICE_INTERVAL_SQL, (car_data['price'], now, c.lastrowid))
+    c.executemany(INSERT_REJECT_SQL, reject_values(car_data, scraping_run_id, now))
     
     conn.commit()
 
-async def parse_cars(html_content, conn, session, headers, counters, make, model, stop_flag, scraping_run_id):
-    if stop_flag.is_set():
+class CarWriter:
+    # Buffers stored cars and writes them in a single transaction with executemany,
+    # a page at a time or when max_rows or max_seconds is reached, whichever comes first.
+    # A crash loses at most the cars of the batch that has not been flushed yet.
+    def __init__(self, conn, scraping_run_id, max_rows=100, max_seconds=30, index=None, clock=None, metrics=None):
+        self.conn = conn
+        self.metrics = metrics or NoMetrics()
+        self.scraping_run_id = scraping_run_id
+        self.index = index
+        self.clock = clock or datetime.now
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.buffer = []
+        self.first_added = None
+        # Cars written so far, by what the lookup found
+        self.inserted = 0
+        self.updated = 0
+
+    def add(self, car_data):
+        if not self.buffer:
+            self.first_added = time.monotonic()
+        self.buffer.append((car_data, self.clock()))
+        if (len(self.buffer) >= self.max_rows or
+                time.monotonic() - self.first_added >= self.max_seconds):
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        
+        c = self.conn.cursor()
+        updates, inserts, history, relistings = [], [], [], []
+        missing_details = []
+        rejects = []
+        batch_keys = set()
+        inserted = updated = 0
+        
+        with self.metrics.timer('store_seconds'), self.conn:  # One transaction, rolled back if anything fails
+            # Takes the write lock before the first read, so the lookups and the MAX(id)
+            # the new rows are found by can't race another writer (crawl_workers.py)
+            if not self.conn.in_transaction:
+                c.execute('BEGIN IMMEDIATE')
+            for car_data, now in self.buffer:
+                # A car seen twice in the same batch must see the first write
+                key = car_data['registration_number'] if has_registration_number(car_data) else car_data['url']
+                if key in batch_keys:
+                    self._write(c, updates, inserts, history, relistings)
+                    batch_keys.clear()
+                batch_keys.add(key)
+                
+                relisted_id = car_data.get('relisted_id')
+                if relisted_id is not None:
+                    # Matched by fingerprint in parse_cars, there are no details to look it up by
+                    c.execute('SELECT id, price FROM cars WHERE id = ?', (relisted_id,))
+                    result = c.fetchone()
+                else:
+                    result = find_existing_car(c, car_data, self.index)
+                if result:
+                    car_id, current_price = result
+                    new_price = car_data['price']
+                    
+                    # Only store price history if price has changed
+                    if current_price != new_price:
+                        history.append((car_id, current_price, new_price, now))
+                        self.metrics.count('price_changes_total')
+                        print(f" -- Price change detected for car {car_data.get('registration_number')}: {current_price} -> {new_price}")
+                    
+                    updates.append(car_update_values(car_data, car_id, self.scraping_run_id, now))
+                    updated += 1
+                    if car_data.get('url_unknown'):
+                        # A car listed before under another url, it keeps its history and gets the new url
+                        matched_by = 'fingerprint' if relisted_id is not None else 'registration_number'
+                        relistings.append((car_data['url'], matched_by, car_data.get('relist_confidence'),
+                                           self.scraping_run_id, now, car_id, car_data['url'], car_data['price']))
+                else:
+                    inserts.append(car_insert_values(car_data, self.scraping_run_id, now))
+                    inserted += 1
+                rejects += reject_values(car_data, self.scraping_run_id, now)
+                if car_data.get('details_missing'):
+                    missing_details.append((car_data['url'], car_data['make'], car_data['model'], now, now,
+                                            self.scraping_run_id))
+            
+            self._write(c, updates, inserts, history, relistings)
+            if missing_details:
+                c.executemany(QUEUE_DETAIL_RETRY_SQL, missing_details)
+            if rejects:
+                c.executemany(INSERT_REJECT_SQL, rejects)
+        
+        self.inserted += inserted
+        self.updated += updated
+        self.buffer = []
+
+    def _write(self, c, updates, inserts, history, relistings=()):
+        if history:
+            c.executemany(INSERT_PRICE_HISTORY_SQL, [(car_id, old_price, now) for car_id, old_price, _, now in history])
+            c.executemany(CLOSE_PRICE_INTERVAL_SQL, [(now, car_id) for car_id, _, _, now in history])
+        if updates:
+            c.executemany(UPDATE_CAR_SQL, updates)
+            # The new price of a changed car, or the price of a car back on the market
+            c.executemany(OPEN_PRICE_INTERVAL_SQL, [(values[6], values[7], values[-1]) for values in updates])
+            if self.index:
+                for values in updates:
+                    self.index.set_price(values[-1], values[6])
+        for url, matched_by, confidence, scraping_run_id, now, car_id, _, price in relistings:
+            c.execute(RECORD_RELISTING_SQL, (url, matched_by, confidence, scraping_run_id, now, car_id, url))
+            c.execute(LINK_URL_SQL, (url, car_id, url))
+            if c.rowcount:
+                self.metrics.count('relistings_total', matched_by=matched_by)
+                if self.index:
+                    self.index.add(car_id, url, None, price)
+        if inserts:
+            c.execute('SELECT MAX(id) FROM cars')
+            last_id = c.fetchone()[0] or 0
+            c.executemany(INSERT_CAR_SQL, inserts)
+            open_new_car_intervals(c, last_id)
+            if self.index:
+                # Keep the index up to date with the ids of the new rows
+                c.execute('SELECT id, url, registration_number, price FROM cars WHERE id > ?', (last_id,))
+                for row in c.fetchall():
+                    self.index.add(*row)
+        history.clear()
+        updates.clear()
+        inserts.clear()
+        if relistings:
+            relistings.clear()
+
+# Confidence at which a listing is taken for a relisted car, see listing_index.py
+DEFAULT_RELIST_THRESHOLD = 0.8
+
+# A car whose detail page failed in this many runs is left without details
+DETAIL_RETRY_MAX_ATTEMPTS = 5
+
+async def retry_failed_details(conn, session, headers, limiter, parser, metrics, make, model, scraping_run_id,
+                               stop_flag):
+    # Fetches the details of cars that earlier runs stored without them. Only the cars
+    # this run saw again are tried, the others may not be listed any more.
+    c = conn.cursor()
+    c.execute('''
+        SELECT queue.url, queue.attempts FROM detail_retry_queue queue JOIN cars ON cars.url = queue.url
+        WHERE queue.make = ? AND queue.model = ? AND cars.scraping_run_id = ? AND queue.scraping_run_id != ?
+        ORDER BY queue.last_attempt
+    ''', (make, model, scraping_run_id, scraping_run_id))
+    queued = c.fetchall()
+    if not queued:
         return 0
     
-    soup = BeautifulSoup(html_content, 'html.parser')
-    car_list = soup.find('ul', {'class': 'result-list'})
-    if not car_list:
-        print("No more cars found")
-        return 0
-        
-    car_items = car_list.find_all('li', {'class': 'result-list-item'})
-    if not car_items:
-        print("No cars found")
+    print(f"Fetching the details of {len(queued)} cars stored without them by earlier runs")
+    fetched = 0
+    for url, attempts in queued:
+        if stop_flag.is_set():
+            break
+        details = await fetch_car_details(session, url, headers, limiter, parser, metrics)
+        with conn:
+            if details is not None:
+                c.execute('''
+                    UPDATE cars SET registration_number = COALESCE(?, registration_number),
+                                    color = COALESCE(?, color), drive_type = COALESCE(?, drive_type),
+                                    gearbox = COALESCE(?, gearbox), bodytype = COALESCE(?, bodytype)
+                    WHERE url = ?
+                ''', (details.get('registration_number'), details.get('color'), details.get('drive_type'),
+                      details.get('gearbox'), details.get('bodytype'), url))
+                c.execute('DELETE FROM detail_retry_queue WHERE url = ?', (url,))
+                fetched += 1
+            elif attempts + 1 >= DETAIL_RETRY_MAX_ATTEMPTS:
+                print(f"Giving up on the details of {url} after {attempts + 1} attempts")
+                c.execute('DELETE FROM detail_retry_queue WHERE url = ?', (url,))
+            else:
+                c.execute('''
+                    UPDATE detail_retry_queue SET attempts = attempts + 1, last_attempt = ?, scraping_run_id = ?
+                    WHERE url = ?
+                ''', (datetime.now(), scraping_run_id, url))
+    
+    metrics.count('details_refetched_total', fetched)
+    print(f"Fetched the details of {fetched} of {len(queued)} queued cars")
+    return fetched
+
+async def settle_relistings(conn, session, headers, limiter, parser, metrics, writer, relist_index, counters,
+                            scraping_run_id, stop_flag, complete):
+    # Stores the listings parse_cars held back as relistings. Only at the end of a complete
+    # full sweep is it known that the old listing is gone: a car this run saw under any url
+    # is still listed, and a car matched by two listings can't be told apart from its
+    # lookalike. Those listings are new cars and get their detail page after all.
+    held = relist_index.take_held()
+    if not held:
         return 0
     
-    page_cars = 0
-    c = conn.cursor()  # Create cursor once for all checks
+    claims = Counter(car_data['relisted_id'] for car_data in held)
+    placeholders = ', '.join('?' for _ in claims)
+    seen = {row[0] for row in conn.execute(f'''
+        SELECT id FROM cars WHERE id IN ({placeholders}) AND scraping_run_id = ?
+    ''', [*claims, scraping_run_id])}
     
-    for car in car_items:
-        if stop_flag.is_set():
-            return page_cars
-        
-        # Get price
-        price_elem = car.find('span', {'class': 'car-price-main'})
-        if price_elem:
-            price_text = clean_text(price_elem.text)
-            if any(variant in price_text.lower() for variant in ['/mån', '/månad']):
-                continue  # Skip this car, it's a leasing offer
-            price = price_text.replace('kr', '').replace(' ', '')
+    linked = 0
+    for car_data in held:
+        car_id, confidence = car_data['relisted_id'], car_data['relist_confidence']
+        if complete and claims[car_id] == 1 and car_id not in seen:
+            linked += 1
+            counters['updated'] += 1
+            metrics.count('detail_fetches_avoided_total')
+            print(f" -- Relisted car {car_id} (confidence {confidence:.2f}), not fetching {car_data['url']}")
         else:
-            continue  # Skip if no price found
+            del car_data['relisted_id'], car_data['relist_confidence']
+            # A stopped run stores it without details, a later run fetches them
+            details = None
+            if not stop_flag.is_set():
+                details = await fetch_car_details(session, car_data['url'], headers, limiter, parser, metrics)
+            add_details(car_data, details)
+            counters['new'] += 1
+        writer.add(car_data)
+        counters['total'] += 1
+    writer.flush()
+    
+    counters['relisted'] = counters.get('relisted', 0) + linked
+    print(f"Linked {linked} of {len(held)} listings that looked relisted, the others are new cars")
+    return linked
 
-        # Get title
-        title_elem = car.find('h3', {'class': 'car-list-header'})
-        if not title_elem or not title_elem.find('a'):
-            continue
-        title = title_elem.find('a').text.strip()
+def find_listing(c, car_data, make, model, index=None):
+    # The id of the car listed under the listing's url, None for a new listing. A new
+    # listing is marked url_unknown, the writer links it to a car with the same
+    # registration number.
+    car_data['make'] = make
+    car_data['model'] = model
+    url = car_data['url']
+    exists = index.id_for_url(url) if index else None
+    if exists is None:
+        row = c.execute('SELECT id FROM cars WHERE url = ?', (url,)).fetchone()
+        exists = row[0] if row else None
+    if exists is None:
+        car_data['url_unknown'] = True
+    return exists
 
-        #Get URL
-        relative_url = title_elem.find('a')['href']
-        url = urljoin('https://www.bytbil.com', relative_url)
+def add_details(car_data, details):
+    # details as fetch_car_details returns them
+    if details:
+        car_data.update(details)
+    elif details is None:
+        # Stored without details for now, a later run fetches them again
+        car_data['details_missing'] = True
 
+async def read_result_page(html_content, parser=None, base_url=BASE_URL, metrics=None):
+    # The listings of a result page as plain dicts, None past the last page. The
+    # parse tree is gone when this returns, the caller can drop the html too.
+    parser = parser or PageParser()
+    metrics = metrics or NoMetrics()
+    # Listing links are resolved against the site the page came from
+    with metrics.timer('parse_seconds', page='result'):
+        page_listings = await parser.result_page(html_content, base_url)
+    if page_listings is None:
+        print("No more cars found")
+    elif not page_listings:
+        print("No cars found")
+    return page_listings
+
+async def parse_cars(page_listings, conn, session, headers, counters, make, model, stop_flag, scraping_run_id,
+                     limiter=None, max_inflight=1, writer=None, index=None, parser=None,
+                     metrics=None, pending_urls=None, budget=None, relist_index=None, relist_threshold=None):
+    # Stores the listings of a result page, with the details of the new cars.
+    # pending_urls, if given, gets the new cars of the page that were not stored because the run was stopped.
+    # A new url that relist_index matches to a known car with at least relist_threshold
+    # confidence is held back, settle_relistings stores it at the end of the sweep.
+    if stop_flag.is_set() or not page_listings:
+        return 0
+    
+    parser = parser or PageParser()
+    metrics = metrics or NoMetrics()
+    
+    page_cars = 0
+    c = conn.cursor()  # Create cursor once for all checks
+    listings = []
+    
+    for car_data in page_listings:
         # Check if car exists before fetching details
-        c.execute('SELECT id FROM cars WHERE url = ?', (url,))
-        exists = c.fetchone()
-
-        # Get year, mileage and location
-        details = car.find('p', {'class': 'uk-text-truncate'})
-        if not details:
-            continue        
-        details_text = [d.strip() for d in details.text.split('|')]
-        year = clean_text(details_text[0])
-        mileage = clean_text(details_text[1]).replace('mil', '') if len(details_text) > 1 else 'N/A'
-        location = clean_text(details_text[2]) if len(details_text) > 2 else 'N/A'
-        
-        # Data to store in database
-        car_data = {
-            'title': title,
-            'make': make,
-            'model': model,
-            'year': year,
-            'mileage': mileage,
-            'location': location,
-            'price': price,
-            'url': url
-        }
+        exists = find_listing(c, car_data, make, model, index)
+        normalize_numbers(car_data, counters)
         
-        # Only fetch additional details if car doesn't exist
-        if not exists:
-            more_car_data = await fetch_car_details(session, url, headers)
-            if more_car_data:
-                car_data.update(more_car_data)
-        
-        store_car(conn, car_data, c, scraping_run_id)
-        counters['total'] += 1
-        page_cars += 1
+        # A known listing with the same price as last time, incremental runs stop after a run of these
+        unchanged = exists is not None and index is not None and index.price(exists) == price_to_int(car_data['price'])
         
-        if exists:
-            counters['updated'] += 1
-        else:
-            counters['new'] += 1
+        if exists is None:
+            match = relist_index.match(car_data) if relist_index and relist_threshold else None
+            if match and match[1] >= relist_threshold:
+                # Not marked seen, a second listing matching the same car makes both new cars
+                car_data['relisted_id'], car_data['relist_confidence'] = match
+                relist_index.hold(car_data)
+        elif relist_index:
+            relist_index.seen(exists)
+        listings.append((car_data, exists, unchanged))
+    
+    # In concurrent mode the detail requests for new cars are started up front,
+    # at most max_inflight at a time, while the cars are still stored in page order
+    detail_tasks = [None] * len(listings)
+    if max_inflight > 1:
+        semaphore = asyncio.Semaphore(max_inflight)
+        for i, (car_data, exists, unchanged) in enumerate(listings):
+            if not exists and 'relisted_id' not in car_data:
+                detail_tasks[i] = asyncio.create_task(
+                    fetch_car_details_bounded(semaphore, session, car_data['url'], headers, limiter, parser, metrics,
+                                              budget))
+    
+    try:
+        for (car_data, exists, unchanged), detail_task in zip(listings, detail_tasks):
+            if stop_flag.is_set():
+                return page_cars
+            
+            if 'relisted_id' in car_data:
+                # Held by relist_index
+                page_cars += 1
+                counters['known_streak'] = 0
+                continue
+            
+            # Only fetch additional details if car doesn't exist
+            if not exists:
+                if detail_task:
+                    more_car_data = await wait_unless_stopped(detail_task, stop_flag)
+                    if stop_flag.is_set():
+                        return page_cars
+                else:
+                    more_car_data = await fetch_car_details(session, car_data['url'], headers, limiter, parser, metrics,
+                                                            budget)
+                add_details(car_data, more_car_data)
+            
+            if writer:
+                writer.add(car_data)
+            else:
+                store_car(conn, car_data, c, scraping_run_id)
+            counters['total'] += 1
+            page_cars += 1
+            
+            if exists:
+                counters['updated'] += 1
+            else:
+                counters['new'] += 1
+            counters['known_streak'] = counters.get('known_streak', 0) + 1 if unchanged else 0
+            
+            reg_num = car_data.get('registration_number', '')
+            print(f"#{counters['total']} Processed: {car_data['title']} {car_data['year']}  {car_data['mileage']} mil [{reg_num}] {car_data['price']}kr")
+    finally:
+        # Cancel detail fetches that are still pending when the run is stopped
+        pending = [task for task in detail_tasks if task and not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        if pending_urls is not None:
+            pending_urls.extend(car_data['url'] for car_data, exists, unchanged in listings[page_cars:]
+                                if not exists and 'relisted_id' not in car_data)
         
-        reg_num = car_data.get('registration_number', '')
-        print(f"#{counters['total']} Processed: {title} {year}  {mileage} mil [{reg_num}] {price}kr")
+        # Write the page in one transaction, also when the run is being stopped
+        if writer:
+            writer.flush()
     
     return page_cars
 
+async def fetch_result_page(session, base_url, params, headers, page, limiter=None, delay=True, metrics=None):
+    if delay:
+        print(f".Fetching result page {page}")
+    return await fetch_page(session, base_url, headers, limiter, metrics, 'result', params, delay)
+
 def log_scraping_run(conn, search_params):
     c = conn.cursor()
     c.execute('''
-        INSERT INTO scraping_logs (timestamp, search_params)
-        VALUES (?, ?)
+        INSERT INTO scraping_logs (timestamp, search_params, status)
+        VALUES (?, ?, 'running')
     ''', (datetime.now(), str(search_params)))
     scraping_run_id = c.lastrowid
     conn.commit()
     return scraping_run_id
     
 
-def update_scraping_run(conn, scraping_run_id, cars_found):
+def update_scraping_run(conn, scraping_run_id, cars_found, mode='full', pages_fetched=None, pages_skipped=None,
+                        cars_removed=None, status='completed'):
     c = conn.cursor()
-    c.execute('UPDATE scraping_logs SET cars_found = ? WHERE id = ?', (cars_found, scraping_run_id))
+    c.execute('''
+        UPDATE scraping_logs
+        SET cars_found = ?, mode = ?, pages_fetched = ?, pages_skipped = ?, cars_removed = ?, status = ?
+        WHERE id = ?
+    ''', (cars_found, mode, pages_fetched, pages_skipped, cars_removed, status, scraping_run_id))
     conn.commit()
 
-async def run_search(make, model):
-    stop_flag = asyncio.Event()
+def finish_scraping_run(conn, scraping_run_id, make, model, mode, run_started, complete, filters, previous_full,
+                        total_cars, pages_fetched, pages_skipped, counters, counted, metrics):
+    # The end of a run of run_search or crawl_workers: removed listings, summary tables,
+    # the run's log entry and metrics. counted are the counters a resumed run started with,
+    # its metrics already hold those. previous_full is last_full_sweep from before the run.
+    cars_removed = None
+    if mode == 'full' and complete and previous_full and not filters:
+        cars_removed = count_removed_cars(conn, make, model, run_started, previous_full[0])
+        print(f"Listings removed since the last full sweep: {cars_removed}")
     
-    def signal_handler():
-        print("\nStopping gracefully... Please wait for current operations to complete.")
-        stop_flag.set()
+    # Only a complete full sweep tells which listings are gone
+    update_market_summary(conn, scraping_run_id, make, model, run_started,
+                          detect_removed=mode == 'full' and complete and not filters)
+    
+    # An incomplete full sweep didn't see every page, don't use it for the next comparison.
+    # It keeps its checkpoint and can be continued with resume.
+    update_scraping_run(conn, scraping_run_id, total_cars, mode,
+                        pages_fetched if complete else None, pages_skipped, cars_removed,
+                        'completed' if complete else 'interrupted')
+    if complete:
+        delete_checkpoint(conn, scraping_run_id)
+    
+    metrics.count('cars_total', counters['new'] - counted.get('new', 0), status='new')
+    metrics.count('cars_total', counters['updated'] - counted.get('updated', 0), status='updated')
+    if counters.get('unparseable', 0) > counted.get('unparseable', 0):
+        metrics.count('unparseable_values_total', counters['unparseable'] - counted.get('unparseable', 0))
+    metrics.save(conn)
+    
+    print(f"\nFinal Summary for {make} {model}:")
+    print(f"Total cars processed: {counters['total']}")
+    print(f"New cars added: {counters['new']}")
+    print(f"Existing cars updated: {counters['updated']}")
+    if counters.get('unparseable'):
+        print(f"Values that could not be read: {counters['unparseable']} (see ingest_rejects)")
+    if counters.get('relisted'):
+        print(f"Relisted cars linked without a detail request: {counters['relisted']} (see car_relistings)")
 
-    # Setup signal handlers
-    loop = asyncio.get_running_loop()
-    for sig in (signal.SIGINT, signal.SIGTERM):
-        loop.add_signal_handler(sig, signal_handler)
+# --- Checkpoints: where an unfinished run stopped ---
 
-    conn = setup_database()
-    base_url = 'https://www.bytbil.com/bil'
-    
-    # Initial params
-    first_page_params = {
+def save_checkpoint(conn, scraping_run_id, search_params, mode, run_started, crawl_started, page, pages_fetched,
+                    total_cars, counters, pending_urls=()):
+    # page is the last result page whose cars are all stored. pending_urls are the
+    # new cars of the next page that were found but not stored when the run stopped.
+    with conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO scrape_checkpoints (
+                scraping_run_id, search_params, mode, run_started, crawl_started, page, pages_fetched,
+                total_cars, counters, pending_urls, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (scraping_run_id, str(search_params), mode, run_started, crawl_started, page, pages_fetched,
+              total_cars, json.dumps(counters), json.dumps(list(pending_urls)), datetime.now()))
+
+def find_checkpoint(conn, search_params):
+    # The checkpoint of the latest unfinished run of a search. A run that crashed is still 'running'.
+    row = conn.execute('''
+        SELECT cp.scraping_run_id, cp.mode, cp.run_started, cp.crawl_started, cp.page, cp.pages_fetched,
+               cp.total_cars, cp.counters, cp.pending_urls
+        FROM scrape_checkpoints cp JOIN scraping_logs runs ON runs.id = cp.scraping_run_id
+        WHERE cp.search_params = ? AND runs.status IN ('running', 'interrupted')
+        ORDER BY cp.scraping_run_id DESC LIMIT 1
+    ''', (str(search_params),)).fetchone()
+    if row is None:
+        return None
+    return {
+        'scraping_run_id': row[0],
+        'mode': row[1],
+        'run_started': datetime.fromisoformat(str(row[2])),
+        'crawl_started': datetime.fromisoformat(str(row[3])),
+        'page': row[4],
+        'pages_fetched': row[5],
+        'total_cars': row[6],
+        'counters': json.loads(row[7]),
+        'pending_urls': json.loads(row[8]),
+    }
+
+def reopen_scraping_run(conn, scraping_run_id):
+    with conn:
+        conn.execute("UPDATE scraping_logs SET status = 'running', cars_found = NULL WHERE id = ?",
+                     (scraping_run_id,))
+
+def delete_checkpoint(conn, scraping_run_id):
+    with conn:
+        conn.execute('DELETE FROM scrape_checkpoints WHERE scraping_run_id = ?', (scraping_run_id,))
+
+def completed_in_crawl(conn, search_params, crawl_started):
+    # Whether the search already completed a run in the crawl that started at crawl_started
+    row = conn.execute('''
+        SELECT 1 FROM scraping_logs WHERE search_params = ? AND status = 'completed' AND timestamp >= ?
+    ''', (str(search_params), crawl_started)).fetchone()
+    return row is not None
+
+def last_full_sweep(conn, search_params):
+    # Start time and number of pages of the last completed full sweep of the same search
+    c = conn.cursor()
+    c.execute('''
+        SELECT timestamp, pages_fetched FROM scraping_logs
+        WHERE search_params = ? AND mode = 'full' AND pages_fetched IS NOT NULL
+        ORDER BY id DESC LIMIT 1
+    ''', (str(search_params),))
+    return c.fetchone()
+
+def choose_crawl_mode(conn, search_params, incremental_stop, full, full_every_days):
+    if not incremental_stop or full:
+        return 'full'
+    last_full = last_full_sweep(conn, search_params)
+    if last_full is None:
+        print("No earlier full sweep of this search, running a full sweep")
+        return 'full'
+    last_full_time = datetime.fromisoformat(str(last_full[0]))
+    if (datetime.now() - last_full_time).days >= full_every_days:
+        print(f"Last full sweep was {last_full_time:%Y-%m-%d}, running a full sweep")
+        return 'full'
+    return 'incremental'
+
+def count_removed_cars(conn, make, model, run_started, previous_sweep_started):
+    # Cars that were seen by the previous full sweep but not by this one
+    c = conn.cursor()
+    c.execute('''
+        SELECT COUNT(*) FROM cars
+        WHERE make = ? AND model = ? AND last_seen < ? AND last_seen >= ?
+    ''', (make, model, run_started, previous_sweep_started))
+    return c.fetchone()[0]
+
+# A sample of fake_useragent's agents. UserAgent() parses its whole data set, about
+# 10 MB in memory and a tenth of a second, so that is done once and not kept.
+USER_AGENTS = []
+
+def random_user_agent():
+    if not USER_AGENTS:
+        ua = UserAgent()
+        USER_AGENTS.extend(sorted({ua.random for _ in range(100)}))
+    return random.choice(USER_AGENTS)
+
+def request_headers():
+    return {
+        'User-Agent': random_user_agent(),
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Referer': 'https://www.bytbil.com/'
+    }
+
+def first_page_params(make, model, filters=None):
+    # Params of the first result page, also the key of a search in scraping_logs
+    params = {
         'VehicleType': 'bil',
         'Makes': make,
         'Models': model,
@@ -360,8 +1107,14 @@ async def run_search(make, model):
         'IgnoreSortFiltering': 'false'
     }
     
+    # Extra search filters, e.g. {'PriceRange.To': '300000', 'Fuels': 'El'}
+    if filters:
+        params.update(filters)
+    return params
+
+def paginated_params(make, model, filters=None):
     # Params format for subsequent pages
-    paginated_params = {
+    params = {
         'Makes[0]': make,
         'Models[0]': model,
         'OnlyNew': 'False',
@@ -381,58 +1134,307 @@ async def run_search(make, model):
         'IgnoreSortFiltering': 'False'
     }
     
-    ua = UserAgent()
-    headers = {
-        'User-Agent': ua.random,
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'Referer': 'https://www.bytbil.com/'
-    }
+    if filters:
+        params.update(filters)
+    return params
+
+def setup_stop_flag():
+    stop_flag = asyncio.Event()
+    
+    def signal_handler():
+        print("\nStopping gracefully... Please wait for current operations to complete.")
+        stop_flag.set()
+
+    # Setup signal handlers
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, signal_handler)
+    return stop_flag
+
+async def run_search(make, model, max_inflight=1, limiter=None, batch_rows=100, batch_seconds=30,
+                     parser=None, filters=None, session=None, conn=None, stop_flag=None,
+                     incremental_stop=None, full=False, full_every_days=7, archive=None, mode=None, clock=None,
+                     base_url=None, resume=False, crawl_started=None, memory_budget=None, profiler=None,
+                     relist_threshold=None):
+    # When run by the scheduler the session, database connection and stop flag are shared
+    if stop_flag is None:
+        stop_flag = setup_stop_flag()
+    own_conn = conn is None
+    if own_conn:
+        conn = setup_database()
+    if limiter:
+        limiter = limiter.for_owner(f"{make} {model}")
+    # Another base_url points the scraper at e.g. the stand-in server in stand_in_server.py
+    base_url = base_url or f"{BASE_URL}/bil"
+    profiler = profiler or NoProfiler()
+    search_label = f"{make} {model}"
+    
+    first_params = first_page_params(make, model, filters)
+    next_params = paginated_params(make, model, filters)
+    
+    headers = request_headers()
 
     counters = {
         'total': 0,
         'new': 0,
         'updated': 0
     }
-
-    scraping_run_id = log_scraping_run(conn, first_page_params)
+    total_cars = 0
+    pages_fetched = 0
+    page = 1
+    
+    # With resume an unfinished run of the same search continues where it stopped,
+    # in the same scraping_run_id. Replays are not checkpointed.
+    checkpoint = find_checkpoint(conn, first_params) if resume and mode != 'replay' else None
+    previous_full = last_full_sweep(conn, first_params)
+    if checkpoint:
+        scraping_run_id = checkpoint['scraping_run_id']
+        mode = checkpoint['mode']
+        run_started = checkpoint['run_started']
+        crawl_started = checkpoint['crawl_started']
+        counters = checkpoint['counters']
+        total_cars = checkpoint['total_cars']
+        pages_fetched = checkpoint['pages_fetched']
+        page = checkpoint['page'] + 1
+        reopen_scraping_run(conn, scraping_run_id)
+        print(f"Resuming run {scraping_run_id} of {make} {model} at result page {page}, "
+              f"{counters['total']} cars processed so far")
+        if checkpoint['pending_urls']:
+            print(f"{len(checkpoint['pending_urls'])} new cars of page {page} were not stored yet, "
+                  f"the page is fetched again")
+    else:
+        # Incremental runs stop paginating after incremental_stop known, unchanged listings in a row.
+        # A full sweep walks every page, refreshes last_seen and detects removed listings.
+        if mode is None:
+            mode = choose_crawl_mode(conn, first_params, incremental_stop, full, full_every_days)
+        run_started = datetime.now()
+        scraping_run_id = log_scraping_run(conn, first_params)
+    crawl_started = crawl_started or run_started
+    counted = dict(counters)
+    print(f"Crawl mode: {mode}")
+    metrics = new_run_metrics(scraping_run_id, make, model, conn if checkpoint else None)
+    
+    # Known cars of this make/model, replaces the per-car SELECTs
+    index = ListingIndex.load(conn, make, model)
+    print(f"Loaded {len(index)} known cars into the listing index ({index.memory_bytes() / 1024:,.0f} KB)")
+    writer = CarWriter(conn, scraping_run_id, batch_rows, batch_seconds, index, clock, metrics)
+    
+    # Recently seen cars that may come back under a new url. Only a full sweep of the whole
+    # make/model can tell the old listing is gone, and replays don't pay for detail pages.
+    relist_index = None
+    if relist_threshold and mode == 'full' and not filters:
+        relist_index = RelistIndex.load(conn, make, model, run_started)
+        print(f"Loaded {len(relist_index)} relisting candidates")
+    
+    own_parser = parser is None
+    if own_parser:
+        parser = PageParser()
+    
+    own_session = session is None
+    if own_session:
+        session = create_session(max_inflight + 2)
+    http_session = session
+    if archive:
+        # Every page read from bytbil.com is also stored in the archive
+        session = archive.session(session, scraping_run_id, make, model)
     
-    async with aiohttp.ClientSession() as session:
-        # First page uses different param format
-        response = await session.get(base_url, params=first_page_params, headers=headers)
-        if response.status == 200:
-            html_content = await response.text()
-            cars_found = await parse_cars(html_content, conn, session, headers, counters, make, model, stop_flag, scraping_run_id)
-            total_cars = cars_found
+    def page_params(page):
+        # First page uses different param format, subsequent pages use paginated format
+        return first_params if page == 1 else dict(next_params, Page=str(page))
+    
+    # Counts up to the last completed page, a stopped page is counted again when it is fetched again
+    last_page_done = (page - 1, pages_fetched, total_cars, dict(counters))
+    
+    def checkpoint(pending_urls=()):
+        # Stored cars first, so the checkpoint never points past what is in the database
+        writer.flush()
+        if mode != 'replay':
+            save_checkpoint(conn, scraping_run_id, first_params, mode, run_started, crawl_started, *last_page_done,
+                            pending_urls)
+    
+    fetch_failed = False
+    try:
+        next_page = asyncio.create_task(fetch_result_page(
+            session, base_url, page_params(page), headers, page, limiter, delay=limiter is not None, metrics=metrics))
+        while True:
+            try:
+                html_content = await next_page
+            except FetchFailed:
+                # Every retry failed, the pages after this one were not seen
+                print(f"Result page {page} could not be fetched, ending the run early")
+                fetch_failed = True
+                break
+            if html_content is None:
+                break
+            profiler.snapshot(search_label, page, 'fetched')
             
-            # Subsequent pages use paginated format
-            page = 2
-            while True:
-                print(f".Fetching result page {page}")
-                paginated_params['Page'] = str(page)
-                await human_like_delay()
-                response = await session.get(base_url, params=paginated_params, headers=headers)
-                if response.status == 200:
-                    html_content = await response.text()
-                    cars_found = await parse_cars(html_content, conn, session, headers, counters, make, model, stop_flag, scraping_run_id)
-                    if cars_found == 0:
-                        break
-                    total_cars += cars_found
-                    print(f"Processed page {page}, found {cars_found} cars")
-                    page += 1
-                else:
-                    print(f"Error fetching page {page}: {response.status}")
-                    break
+            # With a shared rate limiter the next result page downloads while this one
+            # is parsed and its detail pages are fetched
+            next_page = None
+            if limiter and not stop_flag.is_set():
+                next_page = asyncio.create_task(fetch_result_page(
+                    session, base_url, page_params(page + 1), headers, page + 1, limiter, metrics=metrics))
+            
+            page_listings = await read_result_page(html_content, parser, base_url, metrics)
+            # Only the listings are kept while the detail pages of the page are fetched
+            html_content = None
+            profiler.snapshot(search_label, page, 'parsed')
+            
+            pending_urls = []
+            cars_found = await parse_cars(page_listings, conn, session, headers, counters, make, model, stop_flag,
+                                          scraping_run_id, limiter, max_inflight, writer, index, parser, metrics,
+                                          pending_urls, memory_budget, relist_index, relist_threshold)
+            if cars_found:
+                total_cars += cars_found
+                pages_fetched = page
+            if stop_flag.is_set():
+                # This page may not be done, a resumed run fetches it again
+                checkpoint(pending_urls)
+            elif cars_found:
+                last_page_done = (page, pages_fetched, total_cars, dict(counters))
+                checkpoint()
+            profiler.snapshot(search_label, page, 'stored')
+            
+            caught_up = mode == 'incremental' and counters.get('known_streak', 0) >= incremental_stop
+            if caught_up:
+                print(f"Reached {counters['known_streak']} known listings in a row, stopping incremental run")
+            if cars_found == 0 or stop_flag.is_set() or caught_up:
+                if next_page:
+                    next_page.cancel()
+                    await asyncio.gather(next_page, return_exceptions=True)
+                break
+            print(f"Processed page {page}, found {cars_found} cars")
+            page += 1
+            
+            if next_page is None:
+                next_page = asyncio.create_task(fetch_result_page(
+                    session, base_url, page_params(page), headers, page, limiter, metrics=metrics))
+        
+        writer.flush()
+        if relist_index:
+            await settle_relistings(conn, session, headers, limiter, parser, metrics, writer, relist_index, counters,
+                                    scraping_run_id, stop_flag, not stop_flag.is_set() and not fetch_failed)
+        if not stop_flag.is_set():
+            await retry_failed_details(conn, session, headers, limiter, parser, metrics, make, model,
+                                       scraping_run_id, stop_flag)
+    finally:
+        if own_session:
+            await http_session.close()
     
-    update_scraping_run(conn, scraping_run_id, total_cars)
+    writer.flush()
+    # A stopped run or one that lost a result page didn't see every listing
+    complete = not stop_flag.is_set() and not fetch_failed
     
-    print(f"\nFinal Summary:")
-    print(f"Total cars processed: {counters['total']}")
-    print(f"New cars added: {counters['new']}")
-    print(f"Existing cars updated: {counters['updated']}")
+    pages_skipped = None
+    if mode == 'incremental' and previous_full:
+        # Compared to the last full sweep of the same search
+        pages_skipped = max(0, previous_full[1] - pages_fetched)
+        seconds_per_request = limiter.interval if limiter else 60 / DEFAULT_RATE
+        print(f"Incremental run fetched {pages_fetched} result pages and skipped about {pages_skipped}, "
+              f"saving about {pages_skipped * seconds_per_request / 60:.1f} minutes")
+    finish_scraping_run(conn, scraping_run_id, make, model, mode, run_started, complete, filters, previous_full,
+                        total_cars, pages_fetched, pages_skipped, counters, counted, metrics)
+    if own_parser:
+        for line in parser.summary():
+            print(f"Parse latency ({parser.mode}): {line}")
+    for line in metrics.summary():
+        print(f"Metrics: {line}")
 
+    if own_conn:
+        conn.close()
+    return counters
+
+async def run_searches(searches, concurrent_searches=1, **options):
+    # Runs several searches at the same time over one session and one database
+    # connection. The rate limiter in options is shared, each search gets a fair share.
+    stop_flag = setup_stop_flag()
+    conn = setup_database()
+    semaphore = asyncio.Semaphore(concurrent_searches)
+    
+    # A resumed crawl continues the unfinished runs and skips the searches that
+    # completed after the crawl started, the others run from the start
+    crawl_started = datetime.now()
+    done = set()
+    if options.get('resume'):
+        params = [first_page_params(search['make'], search['model'], search.get('filters')) for search in searches]
+        checkpoints = [find_checkpoint(conn, search_params) for search_params in params]
+        started = [checkpoint['crawl_started'] for checkpoint in checkpoints if checkpoint]
+        if started:
+            crawl_started = min(started)
+            done = {i for i, (search_params, checkpoint) in enumerate(zip(params, checkpoints))
+                    if not checkpoint and completed_in_crawl(conn, search_params, crawl_started)}
+            print(f"Resuming the crawl started {crawl_started:%Y-%m-%d %H:%M}: {len(started)} unfinished runs, "
+                  f"{len(done)} searches already completed")
+        else:
+            print("No unfinished runs to resume, starting a new crawl")
+    
+    async def run_one(i, search, session):
+        async with semaphore:
+            if stop_flag.is_set() or i in done:
+                return None
+            print(f"\nStarting search for {search['make']} {search['model']}")
+            return await run_search(search['make'], search['model'], filters=search.get('filters'),
+                                    session=session, conn=conn, stop_flag=stop_flag, crawl_started=crawl_started,
+                                    **options)
+    
+    # Enough connections for every search's detail requests and next result page
+    async with create_session(concurrent_searches * (options.get('max_inflight', 1) + 2)) as session:
+        results = await asyncio.gather(*(run_one(i, search, session) for i, search in enumerate(searches)))
+    conn.close()
+    
+    print("\n=== Combined Summary ===")
+    totals = {'total': 0, 'new': 0, 'updated': 0}
+    for search, counters in zip(searches, results):
+        if counters is None:
+            print(f"{search['make']} {search['model']}: not run")
+            continue
+        print(f"{search['make']} {search['model']}: {counters['total']} cars, "
+              f"{counters['new']} new, {counters['updated']} updated")
+        for key in totals:
+            totals[key] += counters[key]
+    print(f"All searches: {totals['total']} cars, {totals['new']} new, {totals['updated']} updated")
+    if options.get('parser'):
+        for line in options['parser'].summary():
+            print(f"Parse latency ({options['parser'].mode}): {line}")
+    return results
+
+async def replay_searches(searches, archive, since=None, **options):
+    # Feeds every archived run of each search, oldest first, through the normal
+    # parse and store pipeline. No network and no delays, cars are stored with the
+    # time the archived run started.
+    conn = setup_database()
+    stop_flag = setup_stop_flag()
+    options['limiter'] = NoDelay()
+    
+    for search in searches:
+        crawls = archive.crawls(search['make'], search['model'], since)
+        print(f"\nReplaying {len(crawls)} archived runs of {search['make']} {search['model']}")
+        for scraping_run_id, started in crawls:
+            if stop_flag.is_set():
+                break
+            print(f"\nReplaying run {scraping_run_id} from {started:%Y-%m-%d %H:%M}")
+            session = ReplaySession(archive, search['make'], search['model'], scraping_run_id)
+            await run_search(search['make'], search['model'], filters=search.get('filters'),
+                             session=session, conn=conn, stop_flag=stop_flag, mode='replay',
+                             clock=lambda started=started: started, **options)
     conn.close()
 
+def load_searches(path):
+    # A JSON list, or a TOML file with [[search]] tables, of
+    # {"make": ..., "model": ..., "filters": {...}}
+    if path.endswith('.toml'):
+        with open(path, 'rb') as f:
+            searches = tomllib.load(f).get('search', [])
+    else:
+        with open(path, encoding='utf-8') as f:
+            searches = json.load(f)
+    for search in searches:
+        if not search.get('make') or not search.get('model'):
+            raise ValueError(f"Search without make and model in {path}: {search}")
+    return searches
+
 async def main():
+    global MAX_RETRIES, MAX_PAGE_BYTES
 
     start_time = time.time() 
 
@@ -449,22 +1451,113 @@ async def main():
     parser = argparse.ArgumentParser(description='Scrape car listings from bytbil.com')
     parser.add_argument('--make', type=str, help='Car manufacturer')
     parser.add_argument('--model', type=str, help='Car model')
+    parser.add_argument('--max-inflight', type=int, default=1,
+                        help='Max number of detail pages fetched in parallel (default 1, no concurrency)')
+    parser.add_argument('--rate', type=float,
+                        help=f'Average requests per minute shared by all requests (default {DEFAULT_RATE} when --max-inflight > 1)')
+    parser.add_argument('--batch-rows', type=int, default=100,
+                        help='Max number of cars written in one transaction (default 100)')
+    parser.add_argument('--batch-seconds', type=float, default=30,
+                        help='Max seconds a car waits in the write buffer (default 30)')
+    parser.add_argument('--parser', choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help=f'HTML parser backend (default {DEFAULT_BACKEND}, lxml needs the lxml package)')
+    parser.add_argument('--parse-mode', choices=PARSE_MODES, default=DEFAULT_PARSE_MODE,
+                        help=f'Parse pages on the event loop, in a thread pool or in a process pool (default {DEFAULT_PARSE_MODE})')
+    parser.add_argument('--parse-workers', type=int, help='Number of parse workers for thread/process mode')
+    parser.add_argument('--searches', type=str,
+                        help='JSON or TOML file with the searches to run (make, model and optional filters)')
+    parser.add_argument('--concurrent-searches', type=int, default=1,
+                        help='Number of searches run at the same time, sharing one rate budget (default 1)')
+    parser.add_argument('--incremental', type=int, metavar='N',
+                        help='Stop paginating after N known listings in a row with unchanged price')
+    parser.add_argument('--full', action='store_true', help='Force a full sweep of every page in incremental mode')
+    parser.add_argument('--full-every-days', type=int, default=7,
+                        help='In incremental mode, run a full sweep when the last one is this old (default 7)')
+    parser.add_argument('--archive', type=str, metavar='DIR',
+                        help='Store every fetched page in a compressed archive in DIR')
+    parser.add_argument('--archive-max-days', type=int, help='Remove archived pages older than this')
+    parser.add_argument('--archive-max-mb', type=int, help='Remove the oldest archived pages above this size')
+    parser.add_argument('--replay', action='store_true',
+                        help='Reprocess the archived pages in --archive instead of fetching from bytbil.com')
+    parser.add_argument('--replay-since', type=str, metavar='YYYY-MM-DD', help='Only replay runs since this date')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue unfinished runs from their last checkpoint and skip searches '
+                             'that completed since the interrupted crawl started')
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                        help='Cap on the detail pages held in memory at once across all searches (default: no cap)')
+    parser.add_argument('--max-page-kb', type=int, default=MAX_PAGE_BYTES // 1024,
+                        help=f'Drop pages larger than this (default {MAX_PAGE_BYTES // 1024})')
+    parser.add_argument('--memory-profile', type=str, metavar='REPORT',
+                        help='Take tracemalloc snapshots at every stage of every page and write a report to REPORT')
+    parser.add_argument('--relist-threshold', type=float, default=DEFAULT_RELIST_THRESHOLD,
+                        help='In a full sweep, link a new url to a recently seen car without fetching its detail '
+                             'page when the listing matches it with this confidence and the car is not listed '
+                             f'under its old url any more (default {DEFAULT_RELIST_THRESHOLD}, 0 to always fetch)')
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES,
+                        help=f'Retries of a failed request, with exponential backoff (default {MAX_RETRIES})')
+    parser.add_argument('--no-metrics', action='store_true',
+                        help='Do not time requests, parsing and writes or store them in scraping_metrics')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve the metrics of the runs on this port (/metrics for Prometheus, /metrics.json)')
+    parser.add_argument('--base-url', type=str,
+                        help=f'Search page to scrape (default {BASE_URL}/bil, e.g. http://127.0.0.1:8081/bil for stand_in_server.py)')
     args = parser.parse_args()
+    MAX_RETRIES = args.retries
+    MAX_PAGE_BYTES = args.max_page_kb * 1024
+
+    # A shared rate limiter replaces the per request human_like_delay
+    rate = args.rate
+    if rate is None and (args.max_inflight > 1 or args.concurrent_searches > 1):
+        rate = DEFAULT_RATE
+    limiter = RateLimiter(rate) if rate else None
+    page_parser = PageParser(args.parser, args.parse_mode, args.parse_workers)
+    if args.no_metrics:
+        disable_metrics()
+    metrics_runner = None
+    if args.metrics_port and not args.no_metrics:
+        metrics_runner = await serve_metrics(args.metrics_port)
+    memory_budget = MemoryBudget(args.memory_budget * 1024 * 1024) if args.memory_budget else None
+    profiler = MemoryProfiler(args.memory_profile) if args.memory_profile else NoProfiler()
 
     if args.make and args.model:
         # Single search with provided arguments
-        await run_search(args.make, args.model)
+        searches = [{'make': args.make, 'model': args.model}]
+    elif args.searches:
+        searches = load_searches(args.searches)
     else:
-        # Run all default searches
-        for search in default_searches:
-            print(f"\nStarting search for {search['make']} {search['model']}")
-            await run_search(search['make'], search['model'])
+        searches = default_searches
+    
+    archive = None
+    if args.archive:
+        archive = ResponseArchive(args.archive, args.archive_max_days, args.archive_max_mb)
+    elif args.replay:
+        parser.error('--replay needs --archive')
+    
+    if args.replay:
+        await replay_searches(searches, archive, args.replay_since,
+                              max_inflight=args.max_inflight, batch_rows=args.batch_rows,
+                              batch_seconds=args.batch_seconds, parser=page_parser, profiler=profiler)
+    else:
+        await run_searches(searches, args.concurrent_searches,
+                           max_inflight=args.max_inflight, limiter=limiter, batch_rows=args.batch_rows,
+                           batch_seconds=args.batch_seconds, parser=page_parser,
+                           incremental_stop=args.incremental, full=args.full, full_every_days=args.full_every_days,
+                           archive=archive, base_url=args.base_url, resume=args.resume,
+                           memory_budget=memory_budget, profiler=profiler, relist_threshold=args.relist_threshold)
+    page_parser.close()
+    profiler.write_report()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    if archive:
+        archive.prune()
+        archive.close()
     
     execution_time = time.time() - start_time
     hours = execution_time // 3600
     minutes = (execution_time % 3600) // 60
     seconds = execution_time % 60
     print(f"{int(hours)}h {int(minutes)}m {seconds:.2f}s")
+    print(f"Peak RSS: {peak_rss_mb():.1f} MB")
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
@@ -0,0 +1,86 @@
+import statistics
+from price_intervals import close_removed_intervals, update_weekly_prices, to_datetime
+
+# Summary tables for market reports, kept up to date at the end of every run so
+# the reports in Analysis.py don't have to scan cars and price_history.
+#
+# car_market_stats   one row per car: days on market, first and current price,
+#                    number of price drops and increases, and the run that found
+#                    it gone (removed_run_id) if it disappeared
+# model_year_prices  listings and median/mean/min/max asking price of the cars
+#                    still for sale, per make, model and year
+#
+# update_market_summary only reads the cars stored by the run (by scraping_run_id)
+# and recomputes the model years they belong to. It also closes the price intervals
+# of the cars found gone and recomputes the run's weeks (price_intervals.py).
+# The tables are created and backfilled by migration 6 in migrate_database.py.
+
+def update_model_year_prices(c, groups, scraping_run_id):
+    # Recomputes the given (make, model, year) groups from the cars still for sale
+    for make, model, year in groups:
+        c.execute('''
+            SELECT current_price FROM car_market_stats
+            WHERE make = ? AND model = ? AND year = ? AND removed_run_id IS NULL AND current_price IS NOT NULL
+        ''', (make, model, year))
+        prices = [price for price, in c.fetchall()]
+        if not prices:
+            c.execute('DELETE FROM model_year_prices WHERE make = ? AND model = ? AND year = ?', (make, model, year))
+            continue
+        c.execute('''
+            INSERT OR REPLACE INTO model_year_prices
+                (make, model, year, listings, median_price, mean_price, min_price, max_price, updated_run_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (make, model, year, len(prices), statistics.median(prices), statistics.fmean(prices),
+              min(prices), max(prices), scraping_run_id))
+
+def update_market_summary(conn, scraping_run_id, make, model, run_started, detect_removed=False):
+    # Brings the summary tables up to date with one run. detect_removed is for complete
+    # full sweeps: cars of the make/model not seen since the run started are gone.
+    c = conn.cursor()
+    with conn:
+        # A price different from the one counted last time is one drop or increase
+        c.execute('''
+            INSERT INTO car_market_stats (
+                car_id, make, model, year, first_seen, last_seen, days_on_market,
+                first_price, current_price, price_drops, price_increases, last_run_id
+            )
+            SELECT id, make, model, year, first_seen, last_seen, julianday(last_seen) - julianday(first_seen),
+                   price, price, 0, 0, scraping_run_id
+            FROM cars WHERE scraping_run_id = ?
+            ON CONFLICT (car_id) DO UPDATE SET
+                year = excluded.year,
+                last_seen = excluded.last_seen,
+                days_on_market = excluded.days_on_market,
+                price_drops = price_drops + COALESCE(excluded.current_price < current_price, 0),
+                price_increases = price_increases + COALESCE(excluded.current_price > current_price, 0),
+                current_price = excluded.current_price,
+                last_run_id = excluded.last_run_id,
+                removed_run_id = NULL,
+                removed_at = NULL
+        ''', (scraping_run_id,))
+        cars_updated = c.rowcount
+
+        removed = 0
+        if detect_removed:
+            c.execute('''
+                UPDATE car_market_stats SET removed_run_id = ?, removed_at = last_seen
+                WHERE make = ? AND model = ? AND last_seen < ? AND removed_run_id IS NULL
+            ''', (scraping_run_id, make, model, run_started))
+            removed = c.rowcount
+            close_removed_intervals(c, scraping_run_id, run_started)
+
+        c.execute('''
+            SELECT make, model, year FROM cars WHERE scraping_run_id = ? AND year IS NOT NULL
+            UNION
+            SELECT make, model, year FROM car_market_stats WHERE removed_run_id = ? AND year IS NOT NULL
+        ''', (scraping_run_id, scraping_run_id))
+        groups = c.fetchall()
+        update_model_year_prices(c, groups, scraping_run_id)
+
+        # The weeks the run changed prices in, replays store cars with the archived time
+        c.execute('SELECT MIN(last_seen), MAX(last_seen) FROM cars WHERE scraping_run_id = ?', (scraping_run_id,))
+        earliest, latest = [to_datetime(value) if value else run_started for value in c.fetchone()]
+        update_weekly_prices(c, make, model, min(run_started, earliest), max(run_started, latest))
+
+    print(f"Market summary: {cars_updated} cars updated, {removed} marked as removed, "
+          f"{len(groups)} model years recomputed")
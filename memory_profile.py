@@ -0,0 +1,79 @@
+import os
+import resource
+import tracemalloc
+from datetime import datetime
+
+# Opt-in memory profiling of scraping runs (main.py --memory-profile REPORT).
+# run_search takes a tracemalloc snapshot at every stage of every result page:
+#   fetched - the result page html is read
+#   parsed  - the listings are extracted and the html and tree are gone
+#   stored  - the page's detail pages are fetched and its cars written
+# and records the traced memory, the traced peak since the previous stage and the
+# RSS. The report lists them per page, with the top allocation sites at the largest
+# snapshot of each stage. Snapshots are slow, don't use this for timing.
+
+TOP_SITES = 15
+
+def peak_rss_mb():
+    # Highest resident set size of this process so far, ru_maxrss is KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if os.uname().sysname == 'Darwin' else peak / 1024
+
+def rss_mb():
+    # Current resident set size, the peak where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+class MemoryProfiler:
+    def __init__(self, report_path, frames=1):
+        self.report_path = report_path
+        self.records = []  # (search, page, stage, traced KB, peak KB, RSS MB)
+        self.largest = {}  # stage -> (traced bytes, search, page, top statistics)
+        tracemalloc.start(frames)
+
+    def snapshot(self, search, page, stage):
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        self.records.append((search, page, stage, current / 1024, peak / 1024, rss_mb()))
+        if current > self.largest.get(stage, (0,))[0]:
+            # Only the top sites are kept, a snapshot holds every live allocation
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ])
+            self.largest[stage] = (current, search, page, snapshot.statistics('lineno')[:TOP_SITES])
+
+    def report(self):
+        # The traced peak is reset at every stage, the highest of them is the peak of the run
+        traced_peak = max([record[4] for record in self.records] + [tracemalloc.get_traced_memory()[1] / 1024])
+        lines = [f"Memory profile {datetime.now():%Y-%m-%d %H:%M}",
+                 f"Peak RSS {peak_rss_mb():.1f} MB, traced peak {traced_peak / 1024:.1f} MB",
+                 "",
+                 f"{'search':30} {'page':>5} {'stage':8} {'traced KB':>10} {'peak KB':>10} {'RSS MB':>8}"]
+        for search, page, stage, current, peak, rss in self.records:
+            lines.append(f"{search[:30]:30} {page:5} {stage:8} {current:10,.0f} {peak:10,.0f} {rss:8.1f}")
+        for stage, (current, search, page, statistics) in self.largest.items():
+            lines.append("")
+            lines.append(f"Top allocation sites at the largest '{stage}' snapshot "
+                         f"({search} page {page}, {current / 1024:,.0f} KB traced):")
+            for stat in statistics:
+                frame = stat.traceback[0]
+                lines.append(f"  {stat.size / 1024:10,.1f} KB {stat.count:8} blocks  {frame.filename}:{frame.lineno}")
+        return lines
+
+    def write_report(self):
+        with open(self.report_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.report()) + '\n')
+        print(f"Memory profile written to {self.report_path}")
+        tracemalloc.stop()
+
+class NoProfiler:
+    # Stands in for MemoryProfiler when memory isn't profiled
+    def snapshot(self, search, page, stage):
+        pass
+
+    def write_report(self):
+        pass
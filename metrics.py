@@ -0,0 +1,283 @@
+import ast
+import json
+import time
+import bisect
+import sqlite3
+import argparse
+from collections import deque
+
+# Timings and counters of scraping runs. Each run gets a RunMetrics with latency
+# histograms and counters, which run_search stores in scraping_metrics at the end
+# of the run. Recent runs can be served while they are running in the Prometheus
+# text format or as JSON (serve_metrics), and stored runs dumped from the database.
+#
+# Histograms (seconds):           Counters:
+#   fetch_seconds{page}             http_requests_total{page}
+#   parse_seconds{page}             http_responses_total{status}
+#   store_seconds (a batch write)   http_errors_total{page} (no response)
+#   delay_seconds                   retries_total{page}
+#   backoff_seconds                 cars_total{status} (new, updated)
+#                                   price_changes_total
+#                                   unparseable_values_total
+#                                   details_refetched_total
+#                                   relistings_total{matched_by}
+#                                   detail_fetches_avoided_total
+#
+# Recording is a perf_counter call, a bisect and a dict update. disable_metrics()
+# (main.py --no-metrics) switches it all off: runs get a NoMetrics that does nothing.
+
+# Upper bounds of the histogram buckets in seconds, the last bucket is +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+ENABLED = True
+
+# The runs served by serve_metrics, newest last
+RECENT_RUNS = deque(maxlen=50)
+
+def disable_metrics():
+    global ENABLED
+    ENABLED = False
+
+def label_text(labels):
+    # (('page', 'detail'),) -> 'page=detail'
+    return ','.join(f"{name}={value}" for name, value in labels)
+
+def series_name(name, labels):
+    return f"{name}{{{label_text(labels)}}}" if labels else name
+
+def parse_labels(text):
+    return tuple(tuple(pair.split('=', 1)) for pair in text.split(',')) if text else ()
+
+class Histogram:
+    def __init__(self, counts=None, total=0.0):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)
+        self.sum = total
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q quantile
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS + (float('inf'),), self.counts):
+            seen += n
+            if seen >= rank and n:
+                return bound
+        return float('nan')
+
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+class RunMetrics:
+    def __init__(self, scraping_run_id=None, make=None, model=None):
+        self.scraping_run_id = scraping_run_id
+        self.make = make
+        self.model = model
+        self.counters = {}  # (name, labels) -> count
+        self.histograms = {}  # (name, labels) -> Histogram
+
+    def count(self, name, n=1, **labels):
+        # Label values are kept as text, the same as when loaded from scraping_metrics
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def summary(self):
+        lines = []
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            lines.append(f"{series_name(name, labels)}: {histogram.count} in {histogram.sum:.2f} s, "
+                         f"avg {histogram.sum / histogram.count * 1000:.1f} ms, "
+                         f"p50 <= {histogram.quantile(0.5) * 1000:g} ms, p99 <= {histogram.quantile(0.99) * 1000:g} ms")
+        counters = ', '.join(f"{series_name(name, labels)} {value}"
+                             for (name, labels), value in sorted(self.counters.items(), key=lambda item: str(item[0])))
+        if counters:
+            lines.append(counters)
+        return lines
+
+    def save(self, conn):
+        rows = [(self.scraping_run_id, name, label_text(labels), 'counter', value, None, None)
+                for (name, labels), value in self.counters.items()]
+        rows += [(self.scraping_run_id, name, label_text(labels), 'histogram', histogram.sum, histogram.count,
+                  json.dumps(histogram.counts))
+                 for (name, labels), histogram in self.histograms.items()]
+        with conn:
+            conn.execute('DELETE FROM scraping_metrics WHERE scraping_run_id = ?', (self.scraping_run_id,))
+            conn.executemany('''
+                INSERT INTO scraping_metrics (scraping_run_id, name, labels, type, value, count, buckets)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+    def to_dict(self):
+        return {
+            'scraping_run_id': self.scraping_run_id, 'make': self.make, 'model': self.model,
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(self.counters.items(), key=lambda item: str(item[0]))],
+            'histograms': [{'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                            'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'], histogram.counts))}
+                           for (name, labels), histogram in sorted(self.histograms.items())],
+        }
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = NullTimer()
+
+class NoMetrics:
+    # Stands in for RunMetrics when metrics are switched off
+    scraping_run_id = None
+
+    def count(self, name, n=1, **labels):
+        pass
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return NULL_TIMER
+
+    def summary(self):
+        return []
+
+    def save(self, conn):
+        pass
+
+def new_run_metrics(scraping_run_id, make=None, model=None, conn=None):
+    # With conn, a resumed run carries on from the metrics stored by its earlier part
+    if not ENABLED:
+        return NoMetrics()
+    if conn is not None:
+        metrics = load_run_metrics(conn, scraping_run_id)
+        metrics.make, metrics.model = make, model
+    else:
+        metrics = RunMetrics(scraping_run_id, make, model)
+    RECENT_RUNS.append(metrics)
+    return metrics
+
+def load_run_metrics(conn, scraping_run_id):
+    row = conn.execute('SELECT search_params FROM scraping_logs WHERE id = ?', (scraping_run_id,)).fetchone()
+    make = model = None
+    if row:
+        # search_params is the str() of the first page params
+        try:
+            params = ast.literal_eval(row[0])
+            make, model = params.get('Makes'), params.get('Models')
+        except (ValueError, SyntaxError):
+            pass
+    metrics = RunMetrics(scraping_run_id, make, model)
+    for name, labels, kind, value, count, buckets in conn.execute('''
+        SELECT name, labels, type, value, count, buckets FROM scraping_metrics WHERE scraping_run_id = ?
+    ''', (scraping_run_id,)):
+        if kind == 'counter':
+            metrics.counters[(name, parse_labels(labels))] = int(value)
+        else:
+            metrics.histograms[(name, parse_labels(labels))] = Histogram(json.loads(buckets), value)
+    return metrics
+
+# --- Export ---
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_labels(run, labels, extra=()):
+    pairs = [('run', run.scraping_run_id), ('make', run.make), ('model', run.model)] + list(labels) + list(extra)
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs if value is not None) + '}'
+
+def prometheus_text(runs):
+    # All runs in the text exposition format, one series per run and label set
+    series = {}
+    for run in runs:
+        for (name, labels), value in run.counters.items():
+            series.setdefault(('counter', f"scraper_{name}"), []).append(
+                f"scraper_{name}{prometheus_labels(run, labels)} {value}")
+        for (name, labels), histogram in run.histograms.items():
+            lines = series.setdefault(('histogram', f"scraper_{name}"), [])
+            cumulative = 0
+            for bound, n in zip([str(b) for b in BUCKETS] + ['+Inf'], histogram.counts):
+                cumulative += n
+                lines.append(f"scraper_{name}_bucket{prometheus_labels(run, labels, [('le', bound)])} {cumulative}")
+            lines.append(f"scraper_{name}_sum{prometheus_labels(run, labels)} {histogram.sum}")
+            lines.append(f"scraper_{name}_count{prometheus_labels(run, labels)} {histogram.count}")
+    text = []
+    for (kind, name), lines in sorted(series.items(), key=lambda item: item[0][1]):
+        text.append(f"# TYPE {name} {kind}")
+        text.extend(lines)
+    return '\n'.join(text) + '\n'
+
+def json_text(runs):
+    return json.dumps([run.to_dict() for run in runs], indent=2)
+
+async def serve_metrics(port, host='127.0.0.1'):
+    # /metrics (Prometheus text) and /metrics.json for the recent runs of this process.
+    # Returns the aiohttp runner, to be cleaned up when the scraper is done.
+    from aiohttp import web
+
+    async def prometheus(request):
+        return web.Response(text=prometheus_text(list(RECENT_RUNS)), content_type='text/plain',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def as_json(request):
+        return web.Response(text=json_text(list(RECENT_RUNS)), content_type='application/json')
+
+    app = web.Application()
+    app.router.add_get('/metrics', prometheus)
+    app.router.add_get('/metrics.json', as_json)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Dump the stored metrics of scraping runs')
+    parser.add_argument('--db', type=str, default='cars.db', help='Database file (default: cars.db)')
+    parser.add_argument('--run', type=int, action='append',
+                        help='scraping_run_id to dump, can be repeated (default: the latest run with metrics)')
+    parser.add_argument('--format', choices=('prometheus', 'json', 'summary'), default='summary',
+                        help='Output format (default: summary)')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    run_ids = args.run or [row[0] for row in conn.execute('SELECT MAX(scraping_run_id) FROM scraping_metrics')
+                           if row[0] is not None]
+    runs = [load_run_metrics(conn, run_id) for run_id in run_ids]
+    conn.close()
+
+    if args.format == 'prometheus':
+        print(prometheus_text(runs), end='')
+    elif args.format == 'json':
+        print(json_text(runs))
+    else:
+        for run in runs:
+            print(f"Run {run.scraping_run_id} ({run.make} {run.model}):")
+            for line in run.summary():
+                print(f"  {line}")
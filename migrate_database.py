@@ -0,0 +1,605 @@
+import sqlite3
+import statistics
+from datetime import datetime, timedelta
+from itertools import groupby
+
+# Versioned schema migrations for cars.db.
+# PRAGMA user_version holds the number of the last migration applied to a database,
+# so each migration runs exactly once and existing databases are upgraded in place.
+# Add new migrations at the end of MIGRATIONS, never change one that has been released.
+# A migration carries its own DDL and backfill instead of calling the modules that use
+# the tables, so replaying it on an old database later does what it did when released.
+
+def add_indexes(c):
+    # A listing can only be stored once per url. Older databases may have
+    # duplicates, keep the first row and move the price history over to it.
+    c.execute('''
+        CREATE TEMP TABLE duplicate_urls AS
+        SELECT c.id AS duplicate_id, first.id AS keep_id
+        FROM cars c
+        JOIN (SELECT url, MIN(id) AS id FROM cars WHERE url IS NOT NULL GROUP BY url HAVING COUNT(*) > 1) first
+          ON c.url = first.url AND c.id != first.id
+    ''')
+    c.execute('''
+        UPDATE price_history
+        SET car_id = (SELECT keep_id FROM duplicate_urls WHERE duplicate_id = price_history.car_id)
+        WHERE car_id IN (SELECT duplicate_id FROM duplicate_urls)
+    ''')
+    c.execute('DELETE FROM cars WHERE id IN (SELECT duplicate_id FROM duplicate_urls)')
+    removed = c.rowcount
+    c.execute('DROP TABLE duplicate_urls')
+    if removed:
+        print(f"Removed {removed} duplicate cars with the same url")
+    
+    create_indexes(c)
+
+def create_indexes(c):
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_cars_url ON cars(url)')
+    
+    # Only real registration numbers are looked up, 'N/A' and '-' are placeholders
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_cars_registration_number ON cars(registration_number)
+        WHERE registration_number NOT IN ('N/A', '-')
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_cars_make_model ON cars(make, model)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_price_history_car_id ON price_history(car_id, timestamp)')
+
+def add_crawl_mode_to_scraping_logs(c):
+    # Which mode ran, how many result pages it fetched and, for incremental runs,
+    # how many it skipped compared to the last full sweep
+    c.execute('ALTER TABLE scraping_logs ADD COLUMN mode TEXT')
+    c.execute('ALTER TABLE scraping_logs ADD COLUMN pages_fetched INTEGER')
+    c.execute('ALTER TABLE scraping_logs ADD COLUMN pages_skipped INTEGER')
+    c.execute('ALTER TABLE scraping_logs ADD COLUMN cars_removed INTEGER')
+
+CHUNK_SIZE = 50000
+
+def clean_number_sql(column):
+    # The text with spaces, non-breaking spaces and units removed, as in parse_cars
+    return (f"REPLACE(REPLACE(REPLACE(REPLACE(TRIM(CAST({column} AS TEXT)), ' ', ''), char(160), ''), "
+            f"'kr', ''), 'mil', '')")
+
+def to_integer_sql(column):
+    cleaned = clean_number_sql(column)
+    return (f"CASE WHEN {cleaned} != '' AND {cleaned} NOT GLOB '*[^0-9]*' "
+            f"THEN CAST({cleaned} AS INTEGER) END")
+
+def unparseable_sql(column):
+    # Values that are there but are not a number. Missing values ('N/A') are not counted.
+    return f"({column} IS NOT NULL AND {column} NOT IN ('N/A', '') AND {to_integer_sql(column)} IS NULL)"
+
+# Listings without a mileage had their location parsed into mileage, a text with no
+# digits in mileage is the location
+MISPLACED_LOCATION_SQL = "(location = 'N/A' AND mileage NOT GLOB '*[0-9]*' AND mileage NOT IN ('N/A', ''))"
+
+def copy_in_chunks(c, table, new_table, columns, integer_columns, expressions=None):
+    # Set-based copy of one id range at a time, converting the integer columns on the way.
+    # Values that can't be converted are logged in ingest_rejects before they become NULL.
+    # expressions replaces the value copied into a column with an SQL expression.
+    c.execute(f'SELECT MIN(id), MAX(id) FROM {table}')
+    low, high = c.fetchone()
+    if low is None:
+        return 0
+    
+    expressions = expressions or {}
+    select = ', '.join(expressions.get(col) or (to_integer_sql(col) if col in integer_columns else col)
+                       for col in columns)
+    rejected = 0
+    for start in range(low - 1, high, CHUNK_SIZE):
+        end = start + CHUNK_SIZE
+        for col in integer_columns:
+            c.execute(f'''
+                INSERT INTO ingest_rejects (table_name, row_id, field, raw_value, timestamp)
+                SELECT '{table}', id, '{col}', {col}, datetime('now') FROM {table}
+                WHERE id > ? AND id <= ? AND {unparseable_sql(col)}
+            ''', (start, end))
+            rejected += c.rowcount
+        c.execute(f'''
+            INSERT INTO {new_table} ({', '.join(columns)})
+            SELECT {select} FROM {table} WHERE id > ? AND id <= ?
+        ''', (start, end))
+        print(f"  {table}: converted rows up to id {min(end, high)} of {high}")
+    return rejected
+
+CARS_COLUMNS = ['id', 'title', 'make', 'model', 'year', 'mileage', 'location', 'price', 'registration_number',
+                'color', 'drive_type', 'gearbox', 'bodytype', 'first_seen', 'last_seen', 'url', 'scraping_run_id']
+PRICE_HISTORY_COLUMNS = ['id', 'car_id', 'price', 'timestamp']
+
+def integer_price_and_mileage(c):
+    # price, mileage and price_history.price were TEXT and year held whatever text the
+    # page had. SQLite only changes a column type by rebuilding the table.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_rejects (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT,
+            row_id INTEGER,
+            scraping_run_id INTEGER,
+            url TEXT,
+            field TEXT,
+            raw_value TEXT,
+            timestamp DATETIME
+        )
+    ''')
+    
+    c.execute('''
+        CREATE TABLE cars_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            make TEXT,
+            model TEXT,
+            year INTEGER,
+            mileage INTEGER,
+            location TEXT,
+            price INTEGER,
+            registration_number TEXT,
+            color TEXT,
+            drive_type TEXT,
+            gearbox TEXT,
+            bodytype TEXT,
+            first_seen DATETIME,
+            last_seen DATETIME,
+            url TEXT,
+            scraping_run_id INTEGER REFERENCES scraping_logs(id)
+        )
+    ''')
+    rejected = copy_in_chunks(c, 'cars', 'cars_new', CARS_COLUMNS, ('year', 'mileage', 'price'),
+                              {'location': f"CASE WHEN {MISPLACED_LOCATION_SQL} THEN mileage ELSE location END"})
+    
+    c.execute('''
+        CREATE TABLE price_history_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            car_id INTEGER,
+            price INTEGER,
+            timestamp DATETIME,
+            FOREIGN KEY (car_id) REFERENCES cars(id)
+        )
+    ''')
+    rejected += copy_in_chunks(c, 'price_history', 'price_history_new', PRICE_HISTORY_COLUMNS, ('price',))
+    
+    c.execute('DROP TABLE cars')
+    c.execute('ALTER TABLE cars_new RENAME TO cars')
+    c.execute('DROP TABLE price_history')
+    c.execute('ALTER TABLE price_history_new RENAME TO price_history')
+    create_indexes(c)
+    
+    if rejected:
+        print(f"  {rejected} values could not be converted to numbers, see the ingest_rejects table")
+
+def add_price_models(c):
+    # Trained price models per make/model, with the data they were trained on. A model
+    # for all makes or all models of a make is stored with an empty make or model.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS price_models (
+            make TEXT NOT NULL,
+            model TEXT NOT NULL,
+            intercept REAL,
+            mileage_coef REAL,
+            age_coef REAL,
+            residual_std REAL,
+            r2 REAL,
+            training_rows INTEGER,
+            reference_year INTEGER,
+            max_id INTEGER,
+            max_last_seen DATETIME,
+            row_count INTEGER,
+            trained_at DATETIME,
+            PRIMARY KEY (make, model)
+        )
+    ''')
+
+def add_price_model_statistics(c):
+    # Sufficient statistics of the price models (see model_statistics.py), and how far
+    # into cars and price_history they have been updated
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS price_model_statistics (
+            make TEXT NOT NULL,
+            model TEXT NOT NULL,
+            max_car_id INTEGER,
+            max_history_id INTEGER,
+            cells TEXT,
+            PRIMARY KEY (make, model)
+        )
+    ''')
+
+def add_market_summary_tables(c):
+    # Summary tables for the market reports (market_summary.py), filled from the cars and
+    # price history so far
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS car_market_stats (
+            car_id INTEGER PRIMARY KEY REFERENCES cars(id),
+            make TEXT,
+            model TEXT,
+            year INTEGER,
+            first_seen DATETIME,
+            last_seen DATETIME,
+            days_on_market REAL,
+            first_price INTEGER,
+            current_price INTEGER,
+            price_drops INTEGER,
+            price_increases INTEGER,
+            last_run_id INTEGER,
+            removed_run_id INTEGER,
+            removed_at DATETIME
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_car_market_stats_make_model ON car_market_stats(make, model, year)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_car_market_stats_removed ON car_market_stats(removed_run_id)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS model_year_prices (
+            make TEXT NOT NULL,
+            model TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            listings INTEGER,
+            median_price REAL,
+            mean_price REAL,
+            min_price INTEGER,
+            max_price INTEGER,
+            updated_run_id INTEGER,
+            PRIMARY KEY (make, model, year)
+        )
+    ''')
+    # Finds the cars stored by one run
+    c.execute('CREATE INDEX IF NOT EXISTS idx_cars_scraping_run_id ON cars(scraping_run_id)')
+    
+    # Every car with its price changes counted from price_history. Each history row holds
+    # the price before a change, the price after it is the next row's or the current one.
+    c.execute('''
+        INSERT OR REPLACE INTO car_market_stats (
+            car_id, make, model, year, first_seen, last_seen, days_on_market,
+            first_price, current_price, price_drops, price_increases, last_run_id
+        )
+        SELECT cars.id, make, model, year, first_seen, last_seen,
+               julianday(last_seen) - julianday(first_seen),
+               COALESCE(changes.first_price, cars.price), cars.price,
+               COALESCE(changes.drops, 0), COALESCE(changes.increases, 0), scraping_run_id
+        FROM cars LEFT JOIN (
+            SELECT car_id,
+                   SUM(after < before) AS drops, SUM(after > before) AS increases,
+                   MAX(CASE WHEN position = 1 THEN before END) AS first_price
+            FROM (
+                SELECT history.car_id, history.price AS before,
+                       COALESCE(LEAD(history.price) OVER (PARTITION BY history.car_id ORDER BY history.id),
+                                cars.price) AS after,
+                       ROW_NUMBER() OVER (PARTITION BY history.car_id ORDER BY history.id) AS position
+                FROM price_history history JOIN cars ON cars.id = history.car_id
+            )
+            GROUP BY car_id
+        ) changes ON changes.car_id = cars.id
+    ''')
+    
+    # Asking prices per model year of the cars still for sale
+    c.execute('''
+        SELECT make, model, year, current_price FROM car_market_stats
+        WHERE year IS NOT NULL AND removed_run_id IS NULL AND current_price IS NOT NULL
+        ORDER BY make, model, year
+    ''')
+    groups = {}
+    for make, model, year, price in c.fetchall():
+        groups.setdefault((make, model, year), []).append(price)
+    c.executemany('''
+        INSERT OR REPLACE INTO model_year_prices
+            (make, model, year, listings, median_price, mean_price, min_price, max_price, updated_run_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL)
+    ''', [(make, model, year, len(prices), statistics.median(prices), statistics.fmean(prices),
+           min(prices), max(prices)) for (make, model, year), prices in groups.items()])
+
+def add_scraping_metrics(c):
+    # Counters and latency histograms of every run (metrics.py)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS scraping_metrics (
+            scraping_run_id INTEGER NOT NULL REFERENCES scraping_logs(id),
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            type TEXT NOT NULL,
+            value REAL,
+            count INTEGER,
+            buckets TEXT,
+            PRIMARY KEY (scraping_run_id, name, labels)
+        )
+    ''')
+
+def add_detail_retry_queue(c):
+    # Cars stored without details because their detail page failed, fetched again by later runs
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS detail_retry_queue (
+            url TEXT PRIMARY KEY,
+            make TEXT,
+            model TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            first_failed DATETIME,
+            last_attempt DATETIME,
+            scraping_run_id INTEGER REFERENCES scraping_logs(id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_detail_retry_queue_make_model ON detail_retry_queue(make, model)')
+
+def add_scrape_checkpoints(c):
+    # Runs are 'running' until they end 'completed' or 'interrupted' (stopped, or a result
+    # page failed). Older runs without cars_found never finished.
+    c.execute('ALTER TABLE scraping_logs ADD COLUMN status TEXT')
+    c.execute("UPDATE scraping_logs SET status = CASE WHEN cars_found IS NULL THEN 'interrupted' ELSE 'completed' END")
+    
+    # Where an unfinished run is, written after every result page, for main.py --resume
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS scrape_checkpoints (
+            scraping_run_id INTEGER PRIMARY KEY REFERENCES scraping_logs(id),
+            search_params TEXT NOT NULL,
+            mode TEXT,
+            run_started DATETIME,
+            crawl_started DATETIME,
+            page INTEGER NOT NULL,
+            pages_fetched INTEGER,
+            total_cars INTEGER,
+            counters TEXT,
+            pending_urls TEXT,
+            updated_at DATETIME
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scrape_checkpoints_search_params ON scrape_checkpoints(search_params)')
+
+def add_car_relistings(c):
+    # Listings linked to a car that was listed before under another url: matched by
+    # registration number after the detail page, or by fingerprint instead of fetching it
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS car_relistings (
+            url TEXT PRIMARY KEY,
+            car_id INTEGER NOT NULL REFERENCES cars(id),
+            previous_url TEXT,
+            matched_by TEXT NOT NULL,
+            confidence REAL,
+            scraping_run_id INTEGER REFERENCES scraping_logs(id),
+            linked_at DATETIME
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_car_relistings_car_id ON car_relistings(car_id)')
+
+def add_crawl_jobs(c):
+    # Job queue of crawl_workers.py: result pages and detail pages of the runs, leased
+    # by worker processes. Fetched jobs hold their result until the writer stores it.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS crawl_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scraping_run_id INTEGER NOT NULL REFERENCES scraping_logs(id),
+            kind TEXT NOT NULL,
+            url TEXT NOT NULL,
+            page INTEGER NOT NULL DEFAULT 0,
+            payload TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            leased_by TEXT,
+            lease_expires DATETIME,
+            heartbeat_at DATETIME,
+            result TEXT,
+            error TEXT,
+            created_at DATETIME,
+            finished_at DATETIME
+        )
+    ''')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_crawl_jobs_key ON crawl_jobs(scraping_run_id, kind, url, page)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_crawl_jobs_status ON crawl_jobs(status, kind, id)')
+
+def to_datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+
+def week_start(when):
+    # The Monday of the week
+    return (when - timedelta(days=when.weekday())).date()
+
+def add_price_intervals(c):
+    # Prices as valid_from/valid_to intervals and weekly price rollups (price_intervals.py),
+    # built from the price history so far. make and model are copied from cars so
+    # snapshots of a make/model use one index.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS price_intervals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            car_id INTEGER NOT NULL REFERENCES cars(id),
+            make TEXT,
+            model TEXT,
+            price INTEGER,
+            valid_from DATETIME NOT NULL,
+            valid_to DATETIME
+        )
+    ''')
+    # Covers the snapshot and weekly queries. A snapshot matches every interval that
+    # started before it, so looking those up in the table would cost more than a scan.
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_price_intervals_make_model
+        ON price_intervals(make, model, valid_from, valid_to, price, car_id)
+    ''')
+    # Finds the open interval of a car
+    c.execute('CREATE INDEX IF NOT EXISTS idx_price_intervals_car_id ON price_intervals(car_id, valid_to)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS weekly_prices (
+            make TEXT NOT NULL,
+            model TEXT NOT NULL,
+            week DATE NOT NULL,
+            listings INTEGER,
+            median_price REAL,
+            mean_price REAL,
+            min_price INTEGER,
+            max_price INTEGER,
+            PRIMARY KEY (make, model, week)
+        )
+    ''')
+    
+    # Each price_history row holds the price before a change, valid from the change
+    # before it (or first_seen) until its own timestamp. The current price is valid
+    # from the last change, until the sweep that found the car gone if one did. Time a
+    # car spent off the market before this migration isn't in price_history, so it
+    # counts as for sale in between.
+    c.execute('''
+        WITH changes AS (
+            SELECT car_id, price, timestamp AS changed_at,
+                   LAG(timestamp) OVER history AS previous_change,
+                   LEAD(id) OVER history IS NULL AS last_change
+            FROM price_history
+            WINDOW history AS (PARTITION BY car_id ORDER BY id)
+        )
+        INSERT INTO price_intervals (car_id, make, model, price, valid_from, valid_to)
+        SELECT cars.id, cars.make, cars.model, changes.price,
+               COALESCE(changes.previous_change, cars.first_seen), changes.changed_at
+        FROM changes JOIN cars ON cars.id = changes.car_id
+        UNION ALL
+        SELECT cars.id, cars.make, cars.model, cars.price, COALESCE(changes.changed_at, cars.first_seen),
+               (SELECT runs.timestamp FROM car_market_stats s JOIN scraping_logs runs ON runs.id = s.removed_run_id
+                WHERE s.car_id = cars.id)
+        FROM cars LEFT JOIN changes ON changes.car_id = cars.id AND changes.last_change
+        WHERE cars.first_seen IS NOT NULL
+    ''')
+    
+    # Every week of every make/model: the last price in the week of each car for sale in it
+    c.execute('''
+        SELECT make, model, car_id, price, valid_from, valid_to FROM price_intervals
+        WHERE make IS NOT NULL AND model IS NOT NULL
+        ORDER BY make, model, valid_from, id
+    ''')
+    rows = []
+    for (make, model), intervals in groupby(c.fetchall(), key=lambda row: row[:2]):
+        intervals = [(car_id, price, to_datetime(valid_from), valid_to and to_datetime(valid_to))
+                     for _, _, car_id, price, valid_from, valid_to in intervals]
+        first = week_start(intervals[0][2])
+        last = week_start(max(valid_to or valid_from for _, _, valid_from, valid_to in intervals))
+        latest = {}  # car_id -> (price, valid_to)
+        position = 0
+        week = first
+        while week <= last:
+            week_end = week + timedelta(days=7)
+            while position < len(intervals) and intervals[position][2].date() < week_end:
+                car_id, price, valid_from, valid_to = intervals[position]
+                latest[car_id] = (price, valid_to)
+                position += 1
+            for car_id in [car_id for car_id, (price, valid_to) in latest.items()
+                           if valid_to is not None and valid_to.date() < week]:
+                del latest[car_id]
+            prices = [price for price, valid_to in latest.values() if price is not None]
+            if prices:
+                rows.append((make, model, week, len(prices), statistics.median(prices), statistics.fmean(prices),
+                             min(prices), max(prices)))
+            week = week_end
+    c.executemany('''
+        INSERT OR REPLACE INTO weekly_prices
+            (make, model, week, listings, median_price, mean_price, min_price, max_price)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+def restore_misplaced_locations(c):
+    # Cars without a mileage that were converted by migration 3 before it kept their
+    # location, or stored by the old parser since, have it only in ingest_rejects,
+    # logged by row or url
+    c.execute('''
+        UPDATE cars SET location = (
+            SELECT raw_value FROM ingest_rejects r
+            WHERE r.table_name = 'cars' AND r.field = 'mileage' AND (r.row_id = cars.id OR r.url = cars.url)
+                  AND r.raw_value NOT GLOB '*[0-9]*'
+            ORDER BY r.id DESC LIMIT 1
+        )
+        WHERE location = 'N/A' AND mileage IS NULL AND EXISTS (
+            SELECT 1 FROM ingest_rejects r
+            WHERE r.table_name = 'cars' AND r.field = 'mileage' AND (r.row_id = cars.id OR r.url = cars.url)
+                  AND r.raw_value NOT GLOB '*[0-9]*'
+        )
+    ''')
+    if c.rowcount:
+        print(f"  Restored the location of {c.rowcount} cars")
+
+def add_cars_revisions(c):
+    # A revision per make/model, counting the updates that leave last_seen as it was
+    # (details fetched later, relinked urls, corrections). Those are the changes that
+    # a watermark of MAX(id) and MAX(last_seen) doesn't see, see analysis_cache.py.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS cars_revisions (
+            make TEXT NOT NULL,
+            model TEXT NOT NULL,
+            revision INTEGER NOT NULL,
+            PRIMARY KEY (make, model)
+        )
+    ''')
+    # A car moved to another make/model changes both
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS cars_revised AFTER UPDATE ON cars
+        WHEN NEW.last_seen IS OLD.last_seen
+        BEGIN
+            INSERT INTO cars_revisions (make, model, revision)
+            SELECT NEW.make, NEW.model, 1 WHERE NEW.make IS NOT NULL AND NEW.model IS NOT NULL
+            ON CONFLICT (make, model) DO UPDATE SET revision = revision + 1;
+            INSERT INTO cars_revisions (make, model, revision)
+            SELECT OLD.make, OLD.model, 1 WHERE OLD.make IS NOT NULL AND OLD.model IS NOT NULL
+                                                AND (OLD.make, OLD.model) IS NOT (NEW.make, NEW.model)
+            ON CONFLICT (make, model) DO UPDATE SET revision = revision + 1;
+        END
+    ''')
+
+def add_price_model_counted(c):
+    # The price, mileage and year each car was counted with in price_model_statistics,
+    # so an update takes a car out with exactly the values it added. The statistics so
+    # far have no such record and are rebuilt from every car by the next training.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS price_model_counted (
+            make TEXT NOT NULL,
+            model TEXT NOT NULL,
+            car_id INTEGER NOT NULL,
+            price INTEGER NOT NULL,
+            mileage INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            PRIMARY KEY (make, model, car_id)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('DELETE FROM price_model_statistics')
+
+MIGRATIONS = [
+    (1, 'indexes on url, registration number, make/model and price history', add_indexes),
+    (2, 'crawl mode and page counts in scraping_logs', add_crawl_mode_to_scraping_logs),
+    (3, 'integer price, mileage and year', integer_price_and_mileage),
+    (4, 'price_models table', add_price_models),
+    (5, 'price_model_statistics table', add_price_model_statistics),
+    (6, 'market summary tables', add_market_summary_tables),
+    (7, 'scraping_metrics table', add_scraping_metrics),
+    (8, 'detail_retry_queue table', add_detail_retry_queue),
+    (9, 'scraping_logs status and scrape_checkpoints table', add_scrape_checkpoints),
+    (10, 'car_relistings table', add_car_relistings),
+    (11, 'crawl_jobs table', add_crawl_jobs),
+    (12, 'price_intervals and weekly_prices tables', add_price_intervals),
+    (13, 'locations parsed into mileage', restore_misplaced_locations),
+    (14, 'cars_revisions table', add_cars_revisions),
+    (15, 'price_model_counted table', add_price_model_counted),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def require_schema(conn, db_name='cars.db'):
+    # For code that only reads the database: it is upgraded by the scraper or this
+    # script, never from a report that may run next to a scrape
+    version = get_schema_version(conn)
+    if version < SCHEMA_VERSION:
+        conn.close()
+        raise SystemExit(f"{db_name} is at schema version {version}, this code needs version {SCHEMA_VERSION}. "
+                         f"Upgrade it with: python migrate_database.py")
+
+def migrate(conn):
+    version = get_schema_version(conn)
+    
+    for number, description, migration in MIGRATIONS:
+        if number <= version:
+            continue
+        print(f"Migrating database to version {number}: {description}")
+        
+        # Each migration and its version bump are committed together
+        conn.execute('BEGIN')
+        try:
+            migration(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = number
+    
+    return version
+
+if __name__ == "__main__":
+    conn = sqlite3.connect('cars.db')
+    print(f"Database is at version {migrate(conn)}")
+    conn.close()
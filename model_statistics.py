@@ -0,0 +1,236 @@
+import math
+import json
+import numpy as np
+import pandas as pd
+
+# Sufficient statistics for the per make/model price models, so a model can be
+# updated with the cars added or changed since it was last trained instead of
+# being refit on every car.
+#
+# The regression price ~ 1 + mileage + (year - YEAR_OFFSET) only needs the sums
+# in X'X, X'y and y'y. They are kept per cell of a log-bucketed histogram of
+# price and mileage (buckets are RELATIVE_ACCURACY wide, as in DDSketch). The
+# marginals of the cells give the quartiles for the IQR outlier bounds, and the
+# cells inside the bounds are summed for the fit. All sums are integers, so
+# adding and removing cars never drifts.
+#
+# price_model_counted holds the price, mileage and year every car was counted
+# with. An update takes out the cars whose values changed (or that left the
+# make/model) with exactly those values and counts them again with the current
+# ones, so the cells are always the sums over the counted cars.
+#
+# Compared to price_models.train, which filters outliers on the exact quartiles,
+# a car is in or out by the middle of its bucket. Only cars within
+# RELATIVE_ACCURACY of a bound can end up on the other side.
+
+RELATIVE_ACCURACY = 0.005
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+ZERO_KEY = -1000000
+YEAR_OFFSET = 2000
+
+# n, Σm, Σa, Σm², Σma, Σa², Σp, Σmp, Σap, Σp² with m mileage, a year - YEAR_OFFSET, p price
+SUM_COLUMNS = ['n', 'm', 'a', 'mm', 'ma', 'aa', 'p', 'mp', 'ap', 'pp']
+
+def bucket_keys(values):
+    values = np.asarray(values, dtype='float64')
+    keys = np.full(len(values), ZERO_KEY, dtype='int64')
+    positive = values > 0
+    keys[positive] = np.ceil(np.log(values[positive]) / LOG_GAMMA).astype('int64')
+    return keys
+
+def bucket_value(key):
+    # Middle of the bucket, within RELATIVE_ACCURACY of every value in it
+    if key == ZERO_KEY:
+        return 0.0
+    return 2 * GAMMA ** key / (GAMMA + 1)
+
+def quantile(histogram, q):
+    # Linear interpolation between ranks as pandas does, on bucket values.
+    # histogram is a list of (key, count) sorted by key.
+    total = sum(count for _, count in histogram)
+    position = (total - 1) * q
+    below = math.floor(position)
+
+    def value_at(rank):
+        seen = 0
+        for key, count in histogram:
+            seen += count
+            if rank < seen:
+                return bucket_value(key)
+        return bucket_value(histogram[-1][0])
+    
+    low = value_at(below)
+    if position == below:
+        return low
+    return low + (position - below) * (value_at(below + 1) - low)
+
+def iqr_bounds(histogram):
+    q1 = quantile(histogram, 0.25)
+    q3 = quantile(histogram, 0.75)
+    return q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+
+def marginal(cells, axis):
+    counts = {}
+    for key, sums in cells.items():
+        counts[key[axis]] = counts.get(key[axis], 0) + sums[0]
+    return sorted((k, n) for k, n in counts.items() if n > 0)
+
+class SegmentStatistics:
+    def __init__(self, make='', model='', max_car_id=0, max_history_id=0, cells=None):
+        self.make = make
+        self.model = model
+        self.max_car_id = max_car_id
+        self.max_history_id = max_history_id
+        # (price key, mileage key) -> list of SUM_COLUMNS
+        self.cells = cells or {}
+        # Changes to price_model_counted, stored with the cells by save_statistics
+        self.clear_counted = False
+        self.counted_removed = []  # car ids
+        self.counted_added = []  # (car_id, price, mileage, year)
+
+    def rows(self):
+        return sum(sums[0] for sums in self.cells.values())
+
+    def add(self, price, mileage, year, sign=1):
+        # Adds (or with sign=-1 removes) the cars in the arrays in one pass per cell
+        price = np.asarray(price, dtype='int64')
+        mileage = np.asarray(mileage, dtype='int64')
+        age = np.asarray(year, dtype='int64') - YEAR_OFFSET
+        if len(price) == 0:
+            return
+        frame = pd.DataFrame({
+            'price_key': bucket_keys(price), 'mileage_key': bucket_keys(mileage),
+            'n': np.ones(len(price), dtype='int64'), 'm': mileage, 'a': age,
+            'mm': mileage * mileage, 'ma': mileage * age, 'aa': age * age,
+            'p': price, 'mp': mileage * price, 'ap': age * price, 'pp': price * price,
+        })
+        for (price_key, mileage_key), sums in frame.groupby(['price_key', 'mileage_key'])[SUM_COLUMNS].sum().iterrows():
+            key = (int(price_key), int(mileage_key))
+            cell = self.cells.setdefault(key, [0] * len(SUM_COLUMNS))
+            for i, value in enumerate(sums):
+                cell[i] += sign * int(value)
+            if cell[0] == 0:
+                del self.cells[key]
+
+    def consistent(self):
+        # A cell can only go negative if a car was taken out with other values than it was added with
+        return all(sums[0] > 0 and sums[3] >= 0 and sums[5] >= 0 and sums[9] >= 0 for sums in self.cells.values())
+
+    def fit(self, reference_year, min_rows=10):
+        # Coefficients in the form price_models uses (intercept, per mil, per year of age),
+        # or None when fewer than min_rows cars are left after removing outliers
+        if not self.cells:
+            return None
+        low, high = iqr_bounds(marginal(self.cells, 0))
+        cells = {k: s for k, s in self.cells.items() if low <= bucket_value(k[0]) <= high}
+        if not cells:
+            return None
+        low, high = iqr_bounds(marginal(cells, 1))
+        cells = [s for k, s in cells.items() if low <= bucket_value(k[1]) <= high]
+        
+        n, m, a, mm, ma, aa, p, mp, ap, pp = (sum(s[i] for s in cells) for i in range(len(SUM_COLUMNS)))
+        if n < min_rows:
+            return None
+        xtx = np.array([[n, m, a], [m, mm, ma], [a, ma, aa]], dtype='float64')
+        xty = np.array([p, mp, ap], dtype='float64')
+        coef = np.linalg.lstsq(xtx, xty, rcond=None)[0]
+        
+        residual_ss = max(float(pp - 2 * coef @ xty + coef @ xtx @ coef), 0.0)
+        total_ss = pp - p * p / n
+        return {
+            # price = b0 + b1 * mileage + b2 * (year - YEAR_OFFSET), with year = reference_year - age
+            'intercept': float(coef[0] + coef[2] * (reference_year - YEAR_OFFSET)),
+            'mileage_coef': float(coef[1]),
+            'age_coef': float(-coef[2]),
+            'residual_std': math.sqrt(residual_ss / n),
+            'r2': 1 - residual_ss / total_ss if total_ss > 0 else 0.0,
+            'training_rows': n,
+        }
+
+    def cells_json(self):
+        return json.dumps([[*key, *sums] for key, sums in sorted(self.cells.items())])
+
+    @classmethod
+    def from_row(cls, make, model, max_car_id, max_history_id, cells_json):
+        cells = {(row[0], row[1]): row[2:] for row in json.loads(cells_json)}
+        return cls(make, model, max_car_id, max_history_id, cells)
+
+def load_statistics(conn, make='', model=''):
+    row = conn.execute('''
+        SELECT make, model, max_car_id, max_history_id, cells FROM price_model_statistics
+        WHERE make = ? AND model = ?
+    ''', (make, model)).fetchone()
+    return SegmentStatistics.from_row(*row) if row else None
+
+def save_statistics(conn, statistics):
+    # The cells and the cars they count, in the caller's transaction
+    key = (statistics.make, statistics.model)
+    conn.execute('''
+        INSERT OR REPLACE INTO price_model_statistics (make, model, max_car_id, max_history_id, cells)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (*key, statistics.max_car_id, statistics.max_history_id, statistics.cells_json()))
+    if statistics.clear_counted:
+        conn.execute('DELETE FROM price_model_counted WHERE make = ? AND model = ?', key)
+    conn.executemany('DELETE FROM price_model_counted WHERE make = ? AND model = ? AND car_id = ?',
+                     [(*key, car_id) for car_id in statistics.counted_removed])
+    conn.executemany('''
+        INSERT OR REPLACE INTO price_model_counted (make, model, car_id, price, mileage, year)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(*key, *row) for row in statistics.counted_added])
+    statistics.clear_counted = False
+    statistics.counted_removed, statistics.counted_added = [], []
+
+def segment_condition(statistics):
+    # The cars of the statistics' make/model, an empty make or model is all of them.
+    # IS instead of = so a car without a make/model is out rather than unknown.
+    conditions, params = [], []
+    for column in ('make', 'model'):
+        value = getattr(statistics, column)
+        if value:
+            conditions.append(f'cars.{column} IS ?')
+            params.append(value)
+    return ' AND '.join(conditions) or '1=1', params
+
+def update_statistics(conn, statistics, rebuild=False):
+    # Takes out the counted cars whose price, mileage or year changed since, or that are
+    # gone from the make/model, with the values they were counted with. Then counts the
+    # cars of the make/model that aren't counted with their current values: new cars and
+    # the ones just taken out. With rebuild every car is counted from scratch. Only reads,
+    # save_statistics stores the cells and price_model_counted together.
+    # Returns (new cars, changed cars).
+    segment, params = segment_condition(statistics)
+    counted_key = [statistics.make, statistics.model]
+    complete = 'cars.price IS NOT NULL AND cars.mileage IS NOT NULL AND cars.year IS NOT NULL'
+    unchanged = 'cars.price IS counted.price AND cars.mileage IS counted.mileage AND cars.year IS counted.year'
+    
+    if rebuild:
+        statistics.cells = {}
+        statistics.clear_counted = True
+        statistics.counted_removed, statistics.counted_added = [], []
+        removed = pd.DataFrame({'car_id': [], 'price': [], 'mileage': [], 'year': []})
+    else:
+        removed = pd.read_sql_query(f'''
+            SELECT counted.car_id, counted.price, counted.mileage, counted.year
+            FROM price_model_counted counted LEFT JOIN cars ON cars.id = counted.car_id
+            WHERE counted.make = ? AND counted.model = ?
+              AND NOT (cars.id IS NOT NULL AND {segment} AND {unchanged})
+        ''', conn, params=counted_key + params)
+        statistics.add(removed['price'], removed['mileage'], removed['year'], sign=-1)
+    
+    not_counted = '' if rebuild else f'''
+        AND NOT EXISTS (SELECT 1 FROM price_model_counted counted
+                        WHERE counted.make = ? AND counted.model = ? AND counted.car_id = cars.id AND {unchanged})
+    '''
+    added = pd.read_sql_query(f'''
+        SELECT cars.id AS car_id, cars.price, cars.mileage, cars.year FROM cars
+        WHERE {segment} AND {complete} {not_counted}
+    ''', conn, params=params + ([] if rebuild else counted_key))
+    statistics.add(added['price'], added['mileage'], added['year'])
+    
+    statistics.counted_removed += [int(car_id) for car_id in removed['car_id']]
+    statistics.counted_added += [tuple(int(value) for value in row) for row in added.itertuples(index=False)]
+    statistics.max_car_id = max(statistics.max_car_id, int(added['car_id'].max()) if len(added) else 0)
+    statistics.max_history_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM price_history').fetchone()[0]
+    recounted = len(set(removed['car_id']) & set(added['car_id']))
+    return len(added) - recounted, len(removed)
@@ -0,0 +1,270 @@
+import re
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urljoin
+from bs4 import BeautifulSoup, SoupStrainer
+
+# Extraction of listings from bytbil.com result pages and specs from detail pages.
+# The work is done by a pluggable backend, all backends return the same plain dicts:
+#   'bs4'      - BeautifulSoup with html.parser, builds the whole page (the original parser)
+#   'strainer' - BeautifulSoup with html.parser, only builds ul.result-list and the spec dl
+#   'lxml'     - lxml.html, much faster, needs the optional lxml package
+
+BACKENDS = ('bs4', 'strainer', 'lxml')
+DEFAULT_BACKEND = 'bs4'
+
+BASE_URL = 'https://www.bytbil.com'
+
+# dt label on the detail page -> column in the cars table
+DETAIL_FIELDS = {
+    'Regnr': 'registration_number',
+    'Färg': 'color',
+    'Drivhjul': 'drive_type',
+    'Växellåda': 'gearbox',
+    'Karosseri': 'bodytype',
+}
+
+# '15072mil' after clean_text, the unit is optional
+MILEAGE_PATTERN = re.compile(r'\d+(?:mil)?')
+
+def clean_text(text):
+    # Remove HTML entities and all whitespace including non-breaking spaces
+    return re.sub(r'(?:&#xA0;|\xa0|\s+)', '', text).strip()
+
+def build_listing(price_text, title, relative_url, details_text, base_url=BASE_URL):
+    # Turns the raw texts of a result-list item into car data, None if the item should be skipped
+    if price_text is None:
+        return None  # Skip if no price found
+    price_text = clean_text(price_text)
+    if any(variant in price_text.lower() for variant in ['/mån', '/månad']):
+        return None  # Skip this car, it's a leasing offer
+    price = price_text.replace('kr', '').replace(' ', '')
+    
+    if title is None or relative_url is None or details_text is None:
+        return None
+    
+    # Get year, mileage and location. Cars without a mileage leave it out, so it is
+    # told apart from the location by being a number and not by its position.
+    details_text = [clean_text(d) for d in details_text.split('|')]
+    year = details_text[0]
+    mileage = location = 'N/A'
+    for text in details_text[1:]:
+        if mileage == 'N/A' and MILEAGE_PATTERN.fullmatch(text):
+            mileage = text.replace('mil', '')
+        elif location == 'N/A':
+            location = text
+    
+    return {
+        'title': title.strip(),
+        'year': year,
+        'mileage': mileage,
+        'location': location,
+        'price': price,
+        'url': urljoin(base_url, relative_url)
+    }
+
+def pick_details(pairs):
+    # Walk the dt/dd pairs once. Like soup.find('dt', string=...) only the first dt
+    # with a label counts, even if it has no dd.
+    labels = {}
+    for label, value in pairs:
+        if label in DETAIL_FIELDS and label not in labels:
+            labels[label] = value
+    return {DETAIL_FIELDS[label]: value for label, value in labels.items() if value is not None}
+
+# --- BeautifulSoup backends ---
+
+def soup_result_items(soup):
+    car_list = soup.find('ul', {'class': 'result-list'})
+    if not car_list:
+        return None
+    return car_list.find_all('li', {'class': 'result-list-item'})
+
+def soup_listing(car, base_url):
+    price_elem = car.find('span', {'class': 'car-price-main'})
+    title_elem = car.find('h3', {'class': 'car-list-header'})
+    link = title_elem.find('a') if title_elem else None
+    details = car.find('p', {'class': 'uk-text-truncate'})
+    return build_listing(
+        price_elem.text if price_elem else None,
+        link.text if link else None,
+        link.get('href') if link else None,
+        details.text if details else None,
+        base_url)
+
+def soup_detail_pairs(soup):
+    for dt in soup.find_all('dt'):
+        dd = dt.find_next_sibling('dd')
+        yield dt.string, dd.text.strip() if dd else None
+
+def decompose_tree(soup):
+    # soup.decompose() on the BeautifulSoup object only clears the root, the tags stay
+    # linked to each other and wait for the cyclic garbage collector. Decomposing the
+    # top-level elements unlinks every tag, so the tree is freed right away.
+    for element in list(soup.contents):
+        element.decompose()
+    soup.decompose()
+
+def parse_result_page_soup(html_content, base_url, parse_only=None):
+    soup = BeautifulSoup(html_content, 'html.parser', parse_only=parse_only)
+    try:
+        car_items = soup_result_items(soup)
+        if car_items is None:
+            return None
+        return [listing for listing in (soup_listing(car, base_url) for car in car_items) if listing]
+    finally:
+        decompose_tree(soup)
+
+def parse_car_details_soup(html_content, parse_only=None):
+    soup = BeautifulSoup(html_content, 'html.parser', parse_only=parse_only)
+    try:
+        return pick_details(soup_detail_pairs(soup))
+    finally:
+        decompose_tree(soup)
+
+# --- lxml backend ---
+
+def lxml_document(html_content):
+    try:
+        import lxml.html
+    except ImportError:
+        raise RuntimeError("The lxml parser backend needs the lxml package: pip install lxml")
+    return lxml.html.document_fromstring(html_content)
+
+def has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+def lxml_string(elem):
+    # Same as BeautifulSoup's .string: the text if there is exactly one child to take it from
+    children = list(elem)
+    if not children:
+        return elem.text or None
+    if len(children) == 1 and not elem.text and not children[0].tail:
+        return lxml_string(children[0])
+    return None
+
+def first(elements):
+    return elements[0] if elements else None
+
+def parse_result_page_lxml(html_content, base_url):
+    doc = lxml_document(html_content)
+    car_list = first(doc.xpath(f"//ul[{has_class('result-list')}]"))
+    if car_list is None:
+        return None
+    
+    listings = []
+    for car in car_list.xpath(f".//li[{has_class('result-list-item')}]"):
+        price_elem = first(car.xpath(f".//span[{has_class('car-price-main')}]"))
+        title_elem = first(car.xpath(f".//h3[{has_class('car-list-header')}]"))
+        link = first(title_elem.xpath('.//a')) if title_elem is not None else None
+        details = first(car.xpath(f".//p[{has_class('uk-text-truncate')}]"))
+        listing = build_listing(
+            price_elem.text_content() if price_elem is not None else None,
+            link.text_content() if link is not None else None,
+            link.get('href') if link is not None else None,
+            details.text_content() if details is not None else None,
+            base_url)
+        if listing:
+            listings.append(listing)
+    return listings
+
+def parse_car_details_lxml(html_content):
+    doc = lxml_document(html_content)
+    
+    def pairs():
+        for dt in doc.iter('dt'):
+            dd = next(dt.itersiblings('dd'), None)
+            yield lxml_string(dt), dd.text_content().strip() if dd is not None else None
+    
+    return pick_details(pairs())
+
+# --- Entry points ---
+
+def has_result_list_class(value):
+    # While parsing the class attribute can still be the raw "result-list uk-list" string
+    if value is None:
+        return False
+    classes = value.split() if isinstance(value, str) else value
+    return 'result-list' in classes
+
+RESULT_LIST_STRAINER = SoupStrainer('ul', class_=has_result_list_class)
+SPEC_LIST_STRAINER = SoupStrainer('dl')
+
+def parse_result_page(html_content, backend=DEFAULT_BACKEND, base_url=BASE_URL):
+    # Returns the listings of a result page, or None if the page has no result list
+    if backend == 'lxml':
+        return parse_result_page_lxml(html_content, base_url)
+    if backend == 'strainer':
+        return parse_result_page_soup(html_content, base_url, RESULT_LIST_STRAINER)
+    return parse_result_page_soup(html_content, base_url)
+
+def parse_car_details(html_content, backend=DEFAULT_BACKEND):
+    if backend == 'lxml':
+        return parse_car_details_lxml(html_content)
+    if backend == 'strainer':
+        return parse_car_details_soup(html_content, SPEC_LIST_STRAINER)
+    return parse_car_details_soup(html_content)
+
+# --- Running the parsing off the event loop ---
+
+PARSE_MODES = ('inline', 'thread', 'process')
+DEFAULT_PARSE_MODE = 'inline'
+
+# Latencies kept for the percentiles, so a long run doesn't grow the parser
+LATENCY_SAMPLES = 10000
+
+class PageParser:
+    # Parses pages inline on the event loop, or in a thread or process pool so the
+    # event loop keeps downloading while a page is parsed. Only the html string goes
+    # to the worker and only plain dicts come back. Records the latency of every
+    # parse, from handing over the html to getting the result back: count, total
+    # and max of all of them and the last LATENCY_SAMPLES for the median.
+    def __init__(self, backend=DEFAULT_BACKEND, mode=DEFAULT_PARSE_MODE, workers=None):
+        self.backend = backend
+        self.mode = mode
+        if mode == 'thread':
+            self.executor = ThreadPoolExecutor(workers)
+        elif mode == 'process':
+            self.executor = ProcessPoolExecutor(workers)
+        else:
+            self.executor = None
+        self.latencies = {'result': deque(maxlen=LATENCY_SAMPLES), 'detail': deque(maxlen=LATENCY_SAMPLES)}
+        self.parsed = {'result': 0, 'detail': 0}
+        self.seconds = {'result': 0.0, 'detail': 0.0}
+        self.max_seconds = {'result': 0.0, 'detail': 0.0}
+
+    async def _run(self, kind, func, *args):
+        start = time.perf_counter()
+        if self.executor:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        else:
+            result = func(*args)
+        seconds = time.perf_counter() - start
+        self.latencies[kind].append(seconds)
+        self.parsed[kind] += 1
+        self.seconds[kind] += seconds
+        self.max_seconds[kind] = max(self.max_seconds[kind], seconds)
+        return result
+
+    async def result_page(self, html_content, base_url=BASE_URL):
+        return await self._run('result', parse_result_page, html_content, self.backend, base_url)
+
+    async def car_details(self, html_content):
+        return await self._run('detail', parse_car_details, html_content, self.backend)
+
+    def summary(self):
+        lines = []
+        for kind, latencies in self.latencies.items():
+            if latencies:
+                ordered = sorted(latencies)
+                lines.append(f"{kind} pages: {self.parsed[kind]} parsed, "
+                             f"avg {self.seconds[kind] / self.parsed[kind] * 1000:.1f} ms, "
+                             f"p50 {ordered[len(ordered) // 2] * 1000:.1f} ms, "
+                             f"max {self.max_seconds[kind] * 1000:.1f} ms")
+        return lines
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
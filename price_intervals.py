@@ -0,0 +1,88 @@
+import statistics
+from datetime import datetime, timedelta
+
+# Prices over time as intervals, so the market at any point in time is one indexed
+# query instead of replaying price_history per car.
+#
+# price_intervals  one row per car and asking price, valid from valid_from until
+#                  valid_to (exclusive). valid_to is NULL while the price is current
+#                  and the car is for sale. A price change closes the interval and
+#                  opens one with the new price at the same time, a full sweep that
+#                  finds the car gone closes it at the start of that sweep, and a car
+#                  that comes back gets a new interval.
+# weekly_prices    listings and median/mean/min/max asking price per make, model and
+#                  week (starting Monday) of the cars for sale during the week, each
+#                  at the last price it had in the week
+#
+# The store path (CarWriter, store_car) keeps the intervals up to date, the end of a
+# run (update_market_summary) closes the removed cars and recomputes its weeks.
+# The tables are created and backfilled by migration 12 in migrate_database.py.
+
+# A price change: the old price's interval ends where the new one starts
+CLOSE_PRICE_INTERVAL_SQL = '''
+    UPDATE price_intervals SET valid_to = ? WHERE car_id = ? AND valid_to IS NULL
+'''
+
+# A car seen with no open interval, new, with a new price or back on the market
+OPEN_PRICE_INTERVAL_SQL = '''
+    INSERT INTO price_intervals (car_id, make, model, price, valid_from)
+    SELECT id, make, model, ?, ? FROM cars
+    WHERE id = ? AND NOT EXISTS (SELECT 1 FROM price_intervals WHERE car_id = cars.id AND valid_to IS NULL)
+'''
+
+def open_new_car_intervals(c, last_id):
+    # The cars inserted after last_id
+    c.execute('''
+        INSERT INTO price_intervals (car_id, make, model, price, valid_from)
+        SELECT id, make, model, price, first_seen FROM cars WHERE id > ?
+    ''', (last_id,))
+
+def close_removed_intervals(c, scraping_run_id, run_started):
+    # The cars the run found gone were for sale at most until it started
+    c.execute('''
+        UPDATE price_intervals SET valid_to = ?
+        WHERE valid_to IS NULL AND car_id IN (SELECT car_id FROM car_market_stats WHERE removed_run_id = ?)
+    ''', (run_started, scraping_run_id))
+
+def to_datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+
+def week_start(when):
+    return (when - timedelta(days=when.weekday())).date()
+
+def update_weekly_prices(c, make, model, since, until):
+    # Recomputes the weeks from the one with since to the one with until. A run only
+    # changes intervals from its start on, so it recomputes its own week(s).
+    first_week, last_week = week_start(since), week_start(until)
+    c.execute('''
+        SELECT car_id, price, valid_from, valid_to FROM price_intervals
+        WHERE make = ? AND model = ? AND valid_from < ? AND (valid_to IS NULL OR valid_to > ?)
+        ORDER BY valid_from, id
+    ''', (make, model, last_week + timedelta(days=7), first_week))
+    intervals = c.fetchall()
+
+    # Swept in valid_from order, keeping the latest interval of every car that may still be for sale
+    latest = {}  # car_id -> (price, valid_to)
+    position = 0
+    week = first_week
+    while week <= last_week:
+        week_end = week + timedelta(days=7)
+        while position < len(intervals) and str(intervals[position][2]) < str(week_end):
+            car_id, price, valid_from, valid_to = intervals[position]
+            latest[car_id] = (price, valid_to)
+            position += 1
+        for car_id in [car_id for car_id, (price, valid_to) in latest.items()
+                       if valid_to is not None and str(valid_to) <= str(week)]:
+            del latest[car_id]
+        # The last price of every car for sale in the week
+        prices = [price for price, valid_to in latest.values() if price is not None]
+        if prices:
+            c.execute('''
+                INSERT OR REPLACE INTO weekly_prices
+                    (make, model, week, listings, median_price, mean_price, min_price, max_price)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (make, model, week, len(prices), statistics.median(prices), statistics.fmean(prices),
+                  min(prices), max(prices)))
+        else:
+            c.execute('DELETE FROM weekly_prices WHERE make = ? AND model = ? AND week = ?', (make, model, week))
+        week = week_end
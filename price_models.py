@@ -0,0 +1,287 @@
+import os
+import sys
+import json
+import sqlite3
+import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LinearRegression
+from migrate_database import migrate
+import model_statistics
+
+# Linear price models (price from mileage and age) per make/model, stored in the
+# price_models table with the watermark of the data they were trained on. A model
+# is only retrained when cars were added or updated since, or the year changed
+# (age is counted from the year the model was trained in).
+#
+# predict_batch values a whole file of cars with one vectorized pass per make/model.
+#
+# Models are trained from the sufficient statistics in model_statistics.py, so
+# after a scrape only the cars it added or changed are read. get_model does this
+# for one make/model when it is asked for, train_all for every make/model in a
+# process pool. train is the full refit on the exact quartiles.
+
+MIN_TRAINING_ROWS = 10
+
+MODEL_COLUMNS = ['make', 'model', 'intercept', 'mileage_coef', 'age_coef', 'residual_std', 'r2',
+                 'training_rows', 'reference_year', 'max_id', 'max_last_seen', 'row_count', 'trained_at']
+
+class PriceModel:
+    def __init__(self, **values):
+        for column in MODEL_COLUMNS:
+            setattr(self, column, values[column])
+
+    def watermark(self):
+        return (self.max_id, self.max_last_seen, self.row_count, self.reference_year)
+
+    def predict(self, mileage, age):
+        # Works on numbers and on arrays alike
+        return self.intercept + self.mileage_coef * np.asarray(mileage) + self.age_coef * np.asarray(age)
+
+    def interval(self, predicted):
+        # Same simplified interval as predict_car_price: two residual standard deviations
+        return predicted - 2 * self.residual_std, predicted + 2 * self.residual_std
+
+def segment_filter(make=None, model=None):
+    where = "WHERE 1=1"
+    params = []
+    if make:
+        where += " AND make = ?"
+        params.append(make)
+    if model:
+        where += " AND model = ?"
+        params.append(model)
+    return where, params
+
+def data_watermark(conn, make=None, model=None, reference_year=None):
+    where, params = segment_filter(make, model)
+    max_id, max_last_seen, row_count = conn.execute(
+        f'SELECT MAX(id), MAX(last_seen), COUNT(*) FROM cars {where}', params).fetchone()
+    return (max_id, max_last_seen, row_count, reference_year or datetime.now().year)
+
+def remove_outliers(df, column):
+    Q1 = df[column].quantile(0.25)
+    Q3 = df[column].quantile(0.75)
+    IQR = Q3 - Q1
+    return df[~((df[column] < (Q1 - 1.5 * IQR)) | (df[column] > (Q3 + 1.5 * IQR)))]
+
+def training_data(conn, make=None, model=None, reference_year=None):
+    # Cars with price, mileage and year, without price and mileage outliers
+    where, params = segment_filter(make, model)
+    df = pd.read_sql_query(f'''
+        SELECT mileage, year, price FROM cars {where}
+        AND price IS NOT NULL AND mileage IS NOT NULL AND year IS NOT NULL
+    ''', conn, params=params)
+    return training_frame(df, reference_year)
+
+def training_frame(cars, reference_year=None):
+    # training_data from a frame of cars that is already loaded, e.g. from the analysis cache
+    df = cars[['mileage', 'year', 'price']].dropna()
+    df = df.assign(age=(reference_year or datetime.now().year) - df['year'])
+    df = remove_outliers(df, 'price')
+    df = remove_outliers(df, 'mileage')
+    return df
+
+def new_model(make, model, coefficients, watermark):
+    max_id, max_last_seen, row_count, reference_year = watermark
+    return PriceModel(make=make or '', model=model or '', reference_year=reference_year, max_id=max_id,
+                      max_last_seen=max_last_seen, row_count=row_count,
+                      trained_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'), **coefficients)
+
+def train(conn, make=None, model=None, reference_year=None):
+    # None when there are too few cars for a reliable model
+    watermark = data_watermark(conn, make, model, reference_year)
+    df = training_data(conn, make, model, watermark[3])
+    if len(df) < MIN_TRAINING_ROWS:
+        return None
+    
+    X = df[['mileage', 'age']]
+    y = df['price']
+    regression = LinearRegression()
+    regression.fit(X, y)
+    residuals = y - regression.predict(X)
+    
+    return new_model(make, model, {
+        'intercept': float(regression.intercept_), 'mileage_coef': float(regression.coef_[0]),
+        'age_coef': float(regression.coef_[1]), 'residual_std': float(np.std(residuals)),
+        'r2': float(regression.score(X, y)), 'training_rows': len(df),
+    }, watermark)
+
+def train_incremental(conn, make=None, model=None, reference_year=None, full=False):
+    # (model or None, updated statistics, new cars, changed cars). Only reads the cars
+    # added or changed since the stored statistics, all of them with full=True.
+    statistics = None if full else model_statistics.load_statistics(conn, make or '', model or '')
+    rebuild = statistics is None
+    statistics = statistics or model_statistics.SegmentStatistics(make or '', model or '')
+    
+    conn.execute('BEGIN')  # One snapshot for the statistics and the watermark
+    try:
+        new_cars, changed_cars = model_statistics.update_statistics(conn, statistics, rebuild)
+        if not statistics.consistent():
+            print(f'Statistics of {make or "all"} {model or ""} went negative, rebuilding them from every car',
+                  file=sys.stderr)
+            new_cars, changed_cars = model_statistics.update_statistics(conn, statistics, rebuild=True)
+        watermark = data_watermark(conn, make, model, reference_year)
+    finally:
+        conn.rollback()
+    
+    coefficients = statistics.fit(watermark[3], MIN_TRAINING_ROWS)
+    price_model = new_model(make, model, coefficients, watermark) if coefficients else None
+    return price_model, statistics, new_cars, changed_cars
+
+def load_model(conn, make=None, model=None):
+    row = conn.execute(f"SELECT {', '.join(MODEL_COLUMNS)} FROM price_models WHERE make = ? AND model = ?",
+                       (make or '', model or '')).fetchone()
+    return PriceModel(**dict(zip(MODEL_COLUMNS, row))) if row else None
+
+def save_model(conn, price_model):
+    conn.execute(f'''
+        INSERT OR REPLACE INTO price_models ({', '.join(MODEL_COLUMNS)})
+        VALUES ({', '.join('?' for _ in MODEL_COLUMNS)})
+    ''', [getattr(price_model, column) for column in MODEL_COLUMNS])
+    conn.commit()
+
+def get_model(conn, make=None, model=None, incremental=True):
+    # The stored model, retrained first if the data changed since it was trained. From
+    # the stored statistics unless incremental is False, then with a full refit.
+    price_model = load_model(conn, make, model)
+    if price_model and price_model.watermark() == data_watermark(conn, make, model):
+        return price_model
+    
+    if incremental:
+        price_model, statistics, _, _ = train_incremental(conn, make, model)
+        model_statistics.save_statistics(conn, statistics)
+        conn.commit()
+    else:
+        price_model = train(conn, make, model)
+    if price_model is None:
+        conn.execute('DELETE FROM price_models WHERE make = ? AND model = ?', (make or '', model or ''))
+        conn.commit()
+        return None
+    save_model(conn, price_model)
+    # On stderr, batch predictions may be going to stdout
+    print(f"Trained price model for {make or 'all makes'} {model or ''} on {price_model.training_rows} cars",
+          file=sys.stderr)
+    return price_model
+
+def predict_batch(conn, cars):
+    # Adds predicted_price, price_low and price_high to a frame of make, model, mileage
+    # and year. Cars of a make/model without a model get NaN.
+    cars = cars.copy()
+    cars['mileage'] = pd.to_numeric(cars['mileage'], errors='coerce')
+    cars['year'] = pd.to_numeric(cars['year'], errors='coerce')
+    predicted = np.full(len(cars), np.nan)
+    low = np.full(len(cars), np.nan)
+    high = np.full(len(cars), np.nan)
+    
+    for (make, model), positions in cars.groupby(['make', 'model'], sort=False).indices.items():
+        price_model = get_model(conn, make, model)
+        if price_model is None:
+            print(f"No price model for {make} {model}, too few cars in the database", file=sys.stderr)
+            continue
+        segment = cars.iloc[positions]
+        age = price_model.reference_year - segment['year'].to_numpy(dtype='float64')
+        predicted[positions] = price_model.predict(segment['mileage'].to_numpy(dtype='float64'), age)
+        low[positions], high[positions] = price_model.interval(predicted[positions])
+    
+    cars['predicted_price'] = predicted.round()
+    cars['price_low'] = low.round()
+    cars['price_high'] = high.round()
+    return cars
+
+def read_cars(path):
+    # CSV with a header line, or JSON lines (.jsonl)
+    if path.endswith('.jsonl'):
+        return pd.read_json(path, lines=True, dtype={'make': str, 'model': str})
+    return pd.read_csv(path, dtype={'make': str, 'model': str})
+
+def write_predictions(cars, path=None):
+    # Same format as the input file, to stdout without a path
+    if path and path.endswith('.jsonl'):
+        with open(path, 'w', encoding='utf-8') as f:
+            for record in cars.to_dict(orient='records'):
+                f.write(json.dumps({k: None if pd.isna(v) else v for k, v in record.items()},
+                                   ensure_ascii=False) + '\n')
+    else:
+        cars.to_csv(path or sys.stdout, index=False)
+
+def train_segment(db_path, make, model, full=False, compare=False):
+    # Runs in a worker process, only reads the database
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        price_model, statistics, new_cars, changed_cars = train_incremental(conn, make, model, full=full)
+        refit = train(conn, make, model) if compare else None
+    finally:
+        conn.close()
+    return make, model, price_model, statistics, new_cars, changed_cars, refit
+
+def compare_to_refit(price_model, refit, mileage, age):
+    # Largest relative difference of the coefficients, and largest difference of the
+    # predicted prices in residual standard deviations of the refit
+    coefficients = max(abs(getattr(price_model, c) - getattr(refit, c)) / abs(getattr(refit, c))
+                       for c in ('intercept', 'mileage_coef', 'age_coef'))
+    predictions = np.max(np.abs(price_model.predict(mileage, age) - refit.predict(mileage, age)))
+    return coefficients, float(predictions / refit.residual_std)
+
+def train_all(db_path='cars.db', workers=None, full=False, compare=False):
+    # Trains every make/model in parallel. Models and statistics are saved here,
+    # the workers only read.
+    conn = sqlite3.connect(db_path)
+    migrate(conn)
+    segments = conn.execute('''
+        SELECT DISTINCT make, model FROM cars WHERE make IS NOT NULL AND model IS NOT NULL ORDER BY make, model
+    ''').fetchall()
+    
+    trained = 0
+    worst = (0.0, 0.0)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = [pool.submit(train_segment, db_path, make, model, full, compare) for make, model in segments]
+        for future in futures:
+            make, model, price_model, statistics, new_cars, changed_cars, refit = future.result()
+            with conn:
+                model_statistics.save_statistics(conn, statistics)
+                if price_model:
+                    save_model(conn, price_model)
+                    trained += 1
+                else:
+                    conn.execute('DELETE FROM price_models WHERE make = ? AND model = ?', (make, model))
+            
+            line = f"{make} {model}: {new_cars} new and {changed_cars} changed cars"
+            if price_model:
+                line += f", trained on {price_model.training_rows} cars"
+            if price_model and refit:
+                # Typical cars: 0 to 30000 mil, 0 to 15 years old
+                mileage, age = np.meshgrid(np.linspace(0, 30000, 7), np.linspace(0, 15, 6))
+                difference = compare_to_refit(price_model, refit, mileage, age)
+                worst = max(worst[0], difference[0]), max(worst[1], difference[1])
+                line += (f", {difference[0]:.2%} from a full refit in coefficients, "
+                         f"{difference[1]:.2f} residual std in prices")
+            print(line)
+    conn.close()
+    
+    print(f"\nTrained {trained} of {len(segments)} price models")
+    if compare:
+        print(f"Largest difference from a full refit: {worst[0]:.2%} in coefficients, "
+              f"{worst[1]:.2f} residual std in predicted prices")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train the stored price models')
+    parser.add_argument('--db', type=str, default='cars.db', help='Database file (default: cars.db)')
+    parser.add_argument('--train-all', action='store_true',
+                        help='Train every make/model in parallel from the stored sufficient statistics')
+    parser.add_argument('--workers', type=int, help='Processes used by --train-all (default: one per CPU)')
+    parser.add_argument('--full', action='store_true', help='Rebuild the statistics from every car')
+    parser.add_argument('--compare', action='store_true', help='Report the difference from a full refit')
+    args = parser.parse_args()
+    
+    if args.train_all:
+        train_all(args.db, args.workers, args.full, args.compare)
+    else:
+        # Retrain the stored models that are out of date
+        conn = sqlite3.connect(args.db)
+        migrate(conn)
+        for make, model in conn.execute('SELECT make, model FROM price_models').fetchall():
+            get_model(conn, make or None, model or None)
+        conn.close()
@@ -0,0 +1,120 @@
+import random
+
+# Generates pages that look like bytbil.com result and detail pages: the same
+# markup around the fields the scraper reads, plus the navigation, filters and
+# scripts that make up most of a real page. Used as a parser fixture corpus and
+# by the stand-in server.
+
+REGIONS = ['stockholms-lan', 'vastra-gotalands-lan', 'skane-lan', 'uppsala-lan', 'orebro-lan']
+LOCATIONS = ['Stockholm', 'Göteborg', 'Malmö', 'Uppsala', 'Örebro', 'Växjö', 'Täby', 'Kristianstad']
+COLORS = ['Vit', 'Svart', 'Grå', 'Mörkblå', 'Röd', 'Silver']
+BODYTYPES = ['SUV', 'Sedan', 'Kombi', 'Halvkombi', 'Cab']
+
+def make_car(car_id, make='Tesla', model='Model Y', rng=None):
+    rng = rng or random.Random(car_id)
+    year = rng.randint(2005, 2025)
+    return {
+        'id': car_id,
+        'make': make,
+        'model': model,
+        'title': f"{make} {model} {rng.choice(['Long Range', 'Performance', 'AWD', 'Standard'])} {rng.randint(1, 999)}",
+        'year': year,
+        'mileage': rng.randint(0, 30000) if rng.random() > 0.03 else None,
+        'location': rng.choice(LOCATIONS),
+        'price': rng.randint(50, 1500) * 1000 - rng.choice([0, 100, 1]),
+        'leasing': rng.random() < 0.05,
+        'region': rng.choice(REGIONS),
+        'registration_number': f"{''.join(rng.choice('ABCDEFGHJKLMNPRSTUWXYZ') for _ in range(3))}{rng.randint(0, 999):03d}",
+        'color': rng.choice(COLORS),
+        'drive_type': rng.choice(['2WD', '4WD']),
+        'gearbox': rng.choice(['Automatisk', 'Manuell']),
+        'bodytype': rng.choice(BODYTYPES),
+    }
+
+def car_path(car):
+    slug = car['title'].lower().replace(' ', '-')
+    return f"/{car['region']}/personbil-{slug}-{car['id'] % 9000 + 1000}-{car['id']}"
+
+def format_number(n):
+    return f"{n:,}".replace(',', '&#xA0;')
+
+PAGE_HEAD = '''<!DOCTYPE html>
+<html lang="sv">
+<head>
+<meta charset="utf-8">
+<title>Bytbil - Begagnade bilar</title>
+<link rel="stylesheet" href="/dist/css/main.css">
+<script>window.dataLayer = window.dataLayer || []; {padding}</script>
+</head>
+<body>
+<header class="site-header"><nav class="uk-navbar"><ul class="uk-navbar-nav">
+<li><a href="/bil">Bil</a></li><li><a href="/mc">MC</a></li><li><a href="/husvagn">Husvagn</a></li>
+</ul></nav></header>
+'''
+
+PAGE_FOOT = '''<footer class="site-footer"><p>Bytbil är en del av Schibsted</p></footer>
+<script src="/dist/js/vendor.js"></script>
+<script>var config = {{"recaptcha": "6Lfq1aQUAAAAAFEQDUblSI0TQm2Zp5Q9VK4tJoE7", "data": "{padding}"}};</script>
+</body>
+</html>
+'''
+
+def padding(rng, size):
+    return ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=size))
+
+def result_item_html(car):
+    if car['leasing']:
+        price = f"{format_number(car['price'] // 300)} kr/mån"
+    else:
+        price = f"{format_number(car['price'])} kr"
+    details = [str(car['year'])]
+    if car['mileage'] is not None:
+        details.append(f"{format_number(car['mileage'])} mil")
+    details.append(car['location'])
+    return f'''<li class="result-list-item uk-width-1-1" data-id="{car['id']}">
+  <div class="car-list-item uk-grid uk-grid-small">
+    <div class="uk-width-1-3 car-image"><a href="{car_path(car)}"><img src="https://pictures.bytbil.com/{car['id']}.jpg" alt="{car['title']}" loading="lazy"></a></div>
+    <div class="uk-width-2-3 car-info">
+      <h3 class="car-list-header uk-text-truncate"><a href="{car_path(car)}">{car['title']}</a></h3>
+      <p class="uk-text-truncate uk-margin-remove">{' | '.join(details)}</p>
+      <div class="car-price-details"><span class="car-price-main">{price}</span>
+      <span class="car-dealer-name uk-text-muted">Bilhandlare {car['id'] % 97}</span></div>
+      <ul class="car-tags"><li class="car-tag">{car['gearbox']}</li><li class="car-tag">{car['drive_type']}</li></ul>
+    </div>
+  </div>
+</li>
+'''
+
+def result_page_html(cars, seed=0):
+    rng = random.Random(seed)
+    filters = ''.join(f'<li><label><input type="checkbox" name="BodyTypes" value="{b}"> {b}</label></li>'
+                      for b in BODYTYPES * 8)
+    items = ''.join(result_item_html(car) for car in cars)
+    result_list = f'<ul class="result-list uk-list">\n{items}</ul>\n' if cars else '<p class="no-results">Inga bilar hittades</p>\n'
+    return (PAGE_HEAD.format(padding=padding(rng, 20000)) +
+            f'<main class="uk-container"><aside class="filters"><ul class="filter-list">{filters}</ul></aside>\n'
+            f'<section class="search-result"><h1>{len(cars)} bilar</h1>\n{result_list}</section></main>\n' +
+            PAGE_FOOT.format(padding=padding(rng, 30000)))
+
+def detail_page_html(car, seed=0):
+    rng = random.Random(seed or car['id'])
+    specs = [
+        ('Märke', car['make']), ('Modell', car['model']), ('Modellår', car['year']),
+        ('Miltal', f"{format_number(car['mileage'] or 0)} mil"), ('Regnr', car['registration_number']),
+        ('Färg', car['color']), ('Drivhjul', car['drive_type']), ('Växellåda', car['gearbox']),
+        ('Karosseri', car['bodytype']), ('Bränsle', rng.choice(['El', 'Bensin', 'Diesel'])),
+    ]
+    spec_list = ''.join(f'<dt>{label}</dt>\n<dd>\n  {value}\n</dd>\n' for label, value in specs)
+    equipment = ''.join(f'<li>Utrustning {i}</li>' for i in range(rng.randint(20, 60)))
+    return (PAGE_HEAD.format(padding=padding(rng, 20000)) +
+            f'''<main class="uk-container"><article class="vehicle-detail">
+<h1 class="vehicle-title">{car['title']}</h1>
+<div class="vehicle-price"><span class="car-price-main">{format_number(car['price'])} kr</span></div>
+<div class="vehicle-gallery">{''.join(f'<img src="https://pictures.bytbil.com/{car["id"]}-{i}.jpg">' for i in range(20))}</div>
+<dl class="vehicle-detail-spec uk-description-list">
+{spec_list}</dl>
+<dl class="dealer-info"><dt>Säljare</dt><dd>Bilhandlare {car['id'] % 97}</dd><dt>Telefon</dt><dd>08-{rng.randint(100000, 999999)}</dd></dl>
+<ul class="equipment-list">{equipment}</ul>
+<div class="vehicle-description"><p>{padding(rng, 2000)}</p></div>
+</article></main>
+''' + PAGE_FOOT.format(padding=padding(rng, 30000)))
@@ -0,0 +1,206 @@
+import time
+import zlib
+import random
+import asyncio
+from collections import deque
+import argparse
+from aiohttp import web
+import sample_pages
+
+# A local stand-in for bytbil.com built on sample_pages.py, so the scraper can be
+# run and measured without touching the real site. Serves /bil search results in
+# both param formats run_search uses (Makes/Models for the first page,
+# Makes[0]/Models[0] and Page=N after that) and the detail pages linked from them.
+# Every make/model gets its own generated inventory, newest first. Latency and
+# error rates are configurable, and above rate_limit requests per second it answers
+# 429 like a server pushing back. Pages are rendered once and then served from memory.
+
+DEFAULT_PAGE_SIZE = 24
+
+class Inventory:
+    def __init__(self, cars_per_search=500, page_size=DEFAULT_PAGE_SIZE, seed=0):
+        self.cars_per_search = cars_per_search
+        self.page_size = page_size
+        self.seed = seed
+        self.searches = {}  # (make, model) -> cars, newest first
+        self.cars = {}  # id -> car
+        self.pages = {}  # ('result', make, model, page) or ('detail', id) -> encoded html
+
+    def search(self, make, model):
+        key = (make, model)
+        if key not in self.searches:
+            # Ids are unique across make/models and stay the same between runs
+            first_id = (zlib.crc32(f"{make}/{model}".encode()) % 100000) * 100000
+            cars = [sample_pages.make_car(first_id + i, make, model, random.Random(self.seed * 7919 + first_id + i))
+                    for i in range(self.cars_per_search)]
+            cars.reverse()
+            self.searches[key] = cars
+            for car in cars:
+                self.cars[car['id']] = car
+        return self.searches[key]
+
+    def page_count(self, make, model):
+        return -(-len(self.search(make, model)) // self.page_size)
+
+    def result_page(self, make, model, page):
+        key = ('result', make, model, page)
+        if key not in self.pages:
+            cars = self.search(make, model)[(page - 1) * self.page_size:page * self.page_size]
+            self.pages[key] = sample_pages.result_page_html(cars, seed=page).encode('utf-8')
+        return self.pages[key]
+
+    def detail_page(self, car_id):
+        car = self.cars.get(car_id)
+        if car is None:
+            return None
+        key = ('detail', car_id)
+        if key not in self.pages:
+            self.pages[key] = sample_pages.detail_page_html(car).encode('utf-8')
+        return self.pages[key]
+
+    def relist(self, make, model, fraction, seed=0):
+        # Takes a fraction of the cars down and lists them again under a new id and url, newest
+        # first. Same car and registration number, a few have a little more mileage or a lower price.
+        rng = random.Random(seed)
+        cars = self.search(make, model)
+        relisted = []
+        next_id = max(self.cars) + 1
+        for car in rng.sample(cars, int(len(cars) * fraction)):
+            cars.remove(car)
+            del self.cars[car['id']]
+            self.pages.pop(('detail', car['id']), None)
+            car = dict(car, id=next_id)
+            next_id += 1
+            if car['mileage'] is not None and rng.random() < 0.2:
+                car['mileage'] += rng.randint(1, 50)
+            if rng.random() < 0.3:
+                car['price'] -= car['price'] * rng.choice([1, 2, 5]) // 100
+            self.cars[car['id']] = car
+            relisted.append(car)
+        cars[:0] = relisted
+        for key in [key for key in self.pages if key[:3] == ('result', make, model)]:
+            del self.pages[key]
+        return relisted
+
+    def lookalikes(self, make, model, fraction, seed=0):
+        # Lists another car next to a fraction of the cars, newest first: same title, year and
+        # location, a little more mileage and about the same price, but its own registration number.
+        # The original stays listed, so none of them is a relisting.
+        rng = random.Random(seed + 1)
+        cars = self.search(make, model)
+        added = []
+        next_id = max(self.cars) + 1
+        for car in rng.sample(cars, int(len(cars) * fraction)):
+            number = (int(car['registration_number'][3:]) + rng.randint(1, 999)) % 1000
+            car = dict(car, id=next_id, registration_number=f"{car['registration_number'][:3]}{number:03d}")
+            next_id += 1
+            if car['mileage'] is not None:
+                car['mileage'] += rng.randint(0, 50)
+            self.cars[car['id']] = car
+            added.append(car)
+        cars[:0] = added
+        for key in [key for key in self.pages if key[:3] == ('result', make, model)]:
+            del self.pages[key]
+        return added
+
+    def prerender(self, make, model):
+        # Renders every page of a search up front, so it doesn't count in a benchmark
+        for page in range(1, self.page_count(make, model) + 2):
+            self.result_page(make, model, page)
+        for car in self.search(make, model):
+            self.detail_page(car['id'])
+
+class StandInServer:
+    def __init__(self, inventory, latency=0.0, jitter=0.5, error_rate=0.0, result_error_rate=0.0, seed=0,
+                 rate_limit=None, retry_after=None):
+        self.inventory = inventory
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.recent = deque()  # Times of the requests in the last second
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.result_error_rate = result_error_rate
+        self.rng = random.Random(seed)
+        self.requests = {'result': 0, 'detail': 0, 'errors': 0, 'throttled': 0}
+
+    def pushback_headers(self):
+        return {'Retry-After': str(self.retry_after)} if self.retry_after is not None else None
+
+    def throttled(self):
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        while self.recent and self.recent[0] < now - 1:
+            self.recent.popleft()
+        if len(self.recent) >= self.rate_limit:
+            return True
+        self.recent.append(now)
+        return False
+
+    async def respond(self, kind, error_rate, render):
+        self.requests[kind] += 1
+        if self.throttled():
+            self.requests['throttled'] += 1
+            return web.Response(status=429, text='Too Many Requests', headers=self.pushback_headers())
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(1 - self.jitter, 1 + self.jitter))
+        if self.rng.random() < error_rate:
+            self.requests['errors'] += 1
+            return web.Response(status=503, text='Service Unavailable', headers=self.pushback_headers())
+        body = render()
+        if body is None:
+            return web.Response(status=404, text='Not Found')
+        return web.Response(body=body, content_type='text/html', charset='utf-8')
+
+    async def search(self, request):
+        query = request.query
+        make = query.get('Makes') or query.get('Makes[0]', '')
+        model = query.get('Models') or query.get('Models[0]', '')
+        try:
+            page = max(1, int(query.get('Page', '1')))
+        except ValueError:
+            page = 1
+        return await self.respond('result', self.result_error_rate,
+                                  lambda: self.inventory.result_page(make, model, page))
+
+    async def detail(self, request):
+        # /<region>/personbil-<slug>-<n>-<id>
+        try:
+            car_id = int(request.match_info['slug'].rsplit('-', 1)[1])
+        except (IndexError, ValueError):
+            raise web.HTTPNotFound()
+        return await self.respond('detail', self.error_rate, lambda: self.inventory.detail_page(car_id))
+
+    async def stats(self, request):
+        return web.json_response(self.requests)
+
+def create_app(server):
+    app = web.Application()
+    app.router.add_get('/bil', server.search)
+    app.router.add_get('/stats', server.stats)
+    app.router.add_get('/{region}/{slug}', server.detail)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve generated bytbil.com pages locally')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8081, help='Port to listen on (default: 8081)')
+    parser.add_argument('--cars', type=int, default=500, help='Cars in the inventory of each make/model (default: 500)')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help=f'Cars per result page (default: {DEFAULT_PAGE_SIZE})')
+    parser.add_argument('--latency', type=float, default=0.0, help='Average seconds before each response (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.5, help='Latency varies by this fraction (default: 0.5)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of detail pages answered with a 503')
+    parser.add_argument('--result-error-rate', type=float, default=0.0,
+                        help='Fraction of result pages answered with a 503')
+    parser.add_argument('--rate-limit', type=float, help='Answer 429 above this many requests per second')
+    parser.add_argument('--retry-after', type=int, help='Retry-After seconds sent with 429 and 503 responses')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the inventory, latencies and errors')
+    args = parser.parse_args()
+
+    server = StandInServer(Inventory(args.cars, args.page_size, args.seed), args.latency, args.jitter,
+                           args.error_rate, args.result_error_rate, args.seed, args.rate_limit, args.retry_after)
+    print(f"Stand-in server on http://{args.host}:{args.port}/bil, e.g. "
+          f"python main.py --make Tesla --model 'Model Y' --base-url http://{args.host}:{args.port}/bil --rate 6000")
+    web.run_app(create_app(server), host=args.host, port=args.port)
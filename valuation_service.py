@@ -0,0 +1,300 @@
+import ast
+import math
+import sqlite3
+import asyncio
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from migrate_database import migrate
+import price_models
+
+# Long running HTTP service for fair-price valuations and comparable listings.
+#
+# GET  /valuation?make=Tesla&model=Model Y&mileage=5000&year=2022
+# POST /valuation with a JSON list of {"make", "model", "mileage", "year"}
+# GET  /comparables?make=Tesla&model=Model Y&mileage=5000&year=2022&limit=10
+# GET  /status
+#
+# Fitted models are kept in an LRU cache, so a valuation of a cached make/model
+# does not touch the database. scraping_logs is polled for runs that started or
+# finished since the last poll, and the make/model they scraped is dropped from
+# the cache. On a miss the stored model in price_models is used right away, and
+# retrained in the background if cars changed since it was trained.
+#
+# All database access for requests runs in one worker thread with its own
+# connection. Training runs in a second one, so it doesn't hold up the requests.
+
+DEFAULT_CACHE_SIZE = 64
+DEFAULT_POLL_SECONDS = 10
+MAX_COMPARABLES = 100
+
+class ModelCache:
+    def __init__(self, capacity=DEFAULT_CACHE_SIZE):
+        self.capacity = capacity
+        self.models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        # (True, model) on a hit, the model is None for a make/model with too few cars
+        if key not in self.models:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.models.move_to_end(key)
+        return True, self.models[key]
+
+    def put(self, key, price_model):
+        self.models[key] = price_model
+        self.models.move_to_end(key)
+        while len(self.models) > self.capacity:
+            self.models.popitem(last=False)
+            self.evictions += 1
+
+    def replace(self, key, old, new):
+        # Only if key still holds old, a make/model dropped in the meantime stays dropped
+        if key in self.models and self.models[key] is old:
+            self.models[key] = new
+
+    def invalidate(self, key):
+        return self.models.pop(key, False) is not False
+
+    def stats(self):
+        return {'size': len(self.models), 'capacity': self.capacity, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+def run_segment(search_params):
+    # (make, model) from the search_params text logged by main.log_scraping_run
+    try:
+        params = ast.literal_eval(search_params or '')
+        return params['Makes'], params['Models']
+    except (ValueError, SyntaxError, KeyError, TypeError):
+        return None
+
+class ValuationService:
+    def __init__(self, db_path='cars.db', cache_size=DEFAULT_CACHE_SIZE, poll_seconds=DEFAULT_POLL_SECONDS):
+        self.db_path = db_path
+        self.poll_seconds = poll_seconds
+        self.cache = ModelCache(cache_size)
+        self.loading = {}
+        self.retraining = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, initializer=self._connect)
+        self.trainer = ThreadPoolExecutor(max_workers=1, initializer=self._connect_trainer)
+        self.conn = None
+        self.train_conn = None
+        self.last_run_id = None
+        self.unfinished_runs = set()
+        self.watcher = None
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.db_path)
+        migrate(self.conn)
+
+    def _connect_trainer(self):
+        self.train_conn = sqlite3.connect(self.db_path)
+
+    async def db(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def train(self, make, model):
+        return await asyncio.get_running_loop().run_in_executor(self.trainer, self._get_model, make, model)
+
+    async def model_for(self, make, model):
+        key = (make, model)
+        hit, price_model = self.cache.get(key)
+        if hit:
+            return price_model
+        
+        # Requests for a make/model that is being loaded wait for the same load
+        loading = self.loading.get(key)
+        if loading is None:
+            loading = asyncio.ensure_future(self.load_model(make, model))
+            loading.add_done_callback(lambda _: self.loading.pop(key, None))
+            self.loading[key] = loading
+        price_model = await asyncio.shield(loading)
+        self.cache.put(key, price_model)
+        return price_model
+
+    async def load_model(self, make, model):
+        stored, current = await self.db(self._stored_model, make, model)
+        if stored is None:
+            # Never trained, or too few cars last time
+            return await self.train(make, model)
+        if not current:
+            self.retrain((make, model), stored)
+        return stored
+
+    def retrain(self, key, stored):
+        # The stored model is served until the retrained one replaces it in the cache
+        if key in self.retraining:
+            return
+        task = asyncio.ensure_future(self.train(*key))
+        self.retraining[key] = task
+        
+        def done(task):
+            self.retraining.pop(key, None)
+            if task.cancelled():
+                return
+            if task.exception() is not None:
+                print(f"Could not retrain the price model for {key[0]} {key[1]}: {task.exception()}")
+                return
+            self.cache.replace(key, stored, task.result())
+        task.add_done_callback(done)
+
+    def _stored_model(self, make, model):
+        # (stored model or None, whether it was trained on the current data)
+        price_model = price_models.load_model(self.conn, make, model)
+        current = price_model is not None and \
+            price_model.watermark() == price_models.data_watermark(self.conn, make, model)
+        return price_model, current
+
+    def _get_model(self, make, model):
+        return price_models.get_model(self.train_conn, make, model)
+
+    def _poll_runs(self):
+        # Runs that started or got their cars_found since the last poll
+        if self.last_run_id is None:
+            self.last_run_id = self.conn.execute('SELECT COALESCE(MAX(id), 0) FROM scraping_logs').fetchone()[0]
+            return []
+        placeholders = ', '.join('?' for _ in self.unfinished_runs)
+        # A resumed run is running again under its old id
+        rows = self.conn.execute(f'''
+            SELECT id, search_params, cars_found FROM scraping_logs
+            WHERE id > ? OR id IN ({placeholders}) OR status = 'running'
+        ''', [self.last_run_id, *self.unfinished_runs]).fetchall()
+        
+        touched = []
+        for run_id, search_params, cars_found in rows:
+            self.last_run_id = max(self.last_run_id, run_id)
+            if cars_found is None:
+                if run_id in self.unfinished_runs:
+                    continue
+                self.unfinished_runs.add(run_id)
+            else:
+                self.unfinished_runs.discard(run_id)
+            touched.append(run_segment(search_params))
+        return touched
+
+    async def watch_runs(self):
+        while True:
+            try:
+                for segment in await self.db(self._poll_runs):
+                    if segment and self.cache.invalidate(segment):
+                        print(f"Scraping run touched {segment[0]} {segment[1]}, dropped its cached model")
+            except sqlite3.Error as e:
+                print(f"Could not read scraping_logs: {e}")
+            await asyncio.sleep(self.poll_seconds)
+
+    async def start(self, app):
+        # Opens the connection and starts watching from the latest run
+        await self.db(self._poll_runs)
+        self.watcher = asyncio.create_task(self.watch_runs())
+
+    async def stop(self, app):
+        self.watcher.cancel()
+        for task in list(self.retraining.values()):
+            task.cancel()
+        self.executor.submit(lambda: self.conn.close()).result()
+        self.executor.shutdown()
+        self.trainer.submit(lambda: self.train_conn and self.train_conn.close()).result()
+        self.trainer.shutdown()
+
+    async def value(self, car):
+        try:
+            make, model = car['make'], car['model']
+            mileage, year = float(car['mileage']), float(car['year'])
+            if not (math.isfinite(mileage) and math.isfinite(year)):
+                raise ValueError
+        except (KeyError, TypeError, ValueError):
+            raise web.HTTPBadRequest(text='make, model, mileage and year are required, mileage and year as numbers')
+        price_model = await self.model_for(make, model)
+        if price_model is None:
+            return {'make': make, 'model': model, 'mileage': mileage, 'year': year,
+                    'error': 'too few cars in the database for a price model'}
+        
+        predicted = float(price_model.predict(mileage, price_model.reference_year - year))
+        low, high = price_model.interval(predicted)
+        return {'make': make, 'model': model, 'mileage': mileage, 'year': year,
+                'predicted_price': round(predicted), 'price_low': round(low), 'price_high': round(high),
+                'training_rows': price_model.training_rows, 'r2': price_model.r2,
+                'trained_at': price_model.trained_at}
+
+    async def valuation(self, request):
+        if request.method == 'POST':
+            try:
+                cars = await request.json()
+            except ValueError:
+                raise web.HTTPBadRequest(text='the body is not valid JSON')
+            if not isinstance(cars, list):
+                raise web.HTTPBadRequest(text='expected a JSON list of cars')
+            return web.json_response([await self.value(car) for car in cars])
+        
+        result = await self.value(request.query)
+        return web.json_response(result, status=404 if 'error' in result else 200)
+
+    def _comparables(self, make, model, mileage, year, limit):
+        # Listings of the same make/model and about the same year, closest in mileage first
+        query = '''
+            SELECT id, title, year, mileage, price, location, url, last_seen FROM cars
+            WHERE make = ? AND model = ? AND price IS NOT NULL
+        '''
+        params = [make, model]
+        if year is not None:
+            query += ' AND year BETWEEN ? AND ?'
+            params += [year - 1, year + 1]
+        if mileage is not None:
+            query += ' AND mileage IS NOT NULL ORDER BY ABS(mileage - ?)'
+            params.append(mileage)
+        else:
+            query += ' ORDER BY last_seen DESC'
+        rows = self.conn.execute(query + ' LIMIT ?', params + [limit]).fetchall()
+        columns = ['id', 'title', 'year', 'mileage', 'price', 'location', 'url', 'last_seen']
+        return [dict(zip(columns, row)) for row in rows]
+
+    async def comparables(self, request):
+        query = request.query
+        try:
+            make, model = query['make'], query['model']
+            mileage = int(query['mileage']) if 'mileage' in query else None
+            year = int(query['year']) if 'year' in query else None
+            limit = min(int(query.get('limit', 10)), MAX_COMPARABLES)
+            if limit < 1:
+                raise ValueError
+        except (KeyError, ValueError):
+            raise web.HTTPBadRequest(text='make and model are required, mileage, year and limit must be integers, '
+                                          'limit at least 1')
+        listings = await self.db(self._comparables, make, model, mileage, year, limit)
+        return web.json_response({'make': make, 'model': model, 'comparables': listings})
+
+    async def status(self, request):
+        return web.json_response({'model_cache': self.cache.stats(), 'last_run_id': self.last_run_id})
+
+def create_app(db_path='cars.db', cache_size=DEFAULT_CACHE_SIZE, poll_seconds=DEFAULT_POLL_SECONDS):
+    service = ValuationService(db_path, cache_size, poll_seconds)
+    app = web.Application()
+    app.router.add_get('/valuation', service.valuation)
+    app.router.add_post('/valuation', service.valuation)
+    app.router.add_get('/comparables', service.comparables)
+    app.router.add_get('/status', service.status)
+    app.on_startup.append(service.start)
+    app.on_cleanup.append(service.stop)
+    app['service'] = service
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve price valuations and comparable listings over HTTP')
+    parser.add_argument('--db', type=str, default='cars.db', help='Database file (default: cars.db)')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on (default: 8080)')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help=f'Number of make/model price models kept in memory (default: {DEFAULT_CACHE_SIZE})')
+    parser.add_argument('--poll-seconds', type=float, default=DEFAULT_POLL_SECONDS,
+                        help=f'How often to check scraping_logs for new runs (default: {DEFAULT_POLL_SECONDS})')
+    args = parser.parse_args()
+    
+    web.run_app(create_app(args.db, args.cache_size, args.poll_seconds), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()